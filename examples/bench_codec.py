@@ -0,0 +1,54 @@
+# Microbenchmark: json vs binary message bodies.
+# For every request/response type, report the encoded
+# size and the time to encode and decode one body.
+#
+#	python3 -m examples.bench_codec
+
+import timeit
+from typing import List, NamedTuple
+
+from srpc.nine.codec import Codec, JSON, BINARY
+from srpc.nine.dat import AuthRequest, AuthResponse, AttachRequest, AttachResponse, \
+    WalkRequest, WalkResponse, StatRequest, StatResponse, AppendRequest, AppendResponse, \
+    ClunkRequest, ClunkResponse, ErrorResponse
+
+SAMPLES: List[NamedTuple] = [
+    AuthRequest(1, "guest", "/"),
+    AuthResponse(),
+    AttachRequest(1, 2, "guest", "/"),
+    AttachResponse(7),
+    WalkRequest(2, 3, ["sub", "echo"]),
+    WalkResponse([7, 8], [1, 3]),
+    StatRequest(3, 2),
+    StatResponse(8, "/sub", True, [f"endpoint{i}" for i in range(16)], 3, False),
+    AppendRequest(3, b"hello, world"),
+    AppendResponse(b"hello, world"),
+    AppendRequest(3, bytes(range(256)) * 16),
+    AppendResponse(bytes(range(256)) * 16),
+    ClunkRequest(3),
+    ClunkResponse(),
+    ErrorResponse(-6),
+]
+
+def per_call(stmt: str, body: NamedTuple, codec: Codec, number: int) -> float:
+    data = codec.encode(body)
+    namespace = {"codec": codec, "body": body, "cls": type(body), "data": data}
+    return min(timeit.repeat(stmt, globals=namespace, number=number, repeat=5)) / number
+
+def main() -> None:
+    number = 20000
+    print(f"{'message':<16}{'bytes':>12}{'encode us':>20}{'decode us':>20}")
+    print(f"{'':<16}{'json/bin':>12}{'json/bin':>20}{'json/bin':>20}")
+    for body in SAMPLES:
+        sizes = [len(codec.encode(body)) for codec in (JSON, BINARY)]
+        enc = [per_call("codec.encode(body)", body, codec, number) * 1e6
+            for codec in (JSON, BINARY)]
+        dec = [per_call("codec.decode(cls, data)", body, codec, number) * 1e6
+            for codec in (JSON, BINARY)]
+        print(f"{type(body).__name__:<16}"
+            f"{sizes[0]:>6}/{sizes[1]:<5}"
+            f"{enc[0]:>10.2f}/{enc[1]:<9.2f}"
+            f"{dec[0]:>10.2f}/{dec[1]:<9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Microbenchmark: message framing.
+# Push frames through a unix socketpair, one side writing
+# and the other reading, and report frames per second for
+# small and large payloads. "legacy" is the framing as it
+# was before FrameReader/FrameWriter: a format string and a
+# packed copy per frame on the way out, a drain per frame
+# (under a lock, with concurrent writers), and an extra
+# unpack copy on the way in.
+#
+#	python3 -m examples.bench_frames
+
+import asyncio
+import socket
+import struct
+import time
+from typing import Awaitable, Callable, List, Tuple
+
+from srpc.nine.dat import MessageType
+from srpc.srv.dat import FrameReader, FrameWriter, Message
+
+PAYLOADS = [64, 1024, 64 * 1024, 1024 * 1024]
+TOTAL_BYTES = 64 * 1024 * 1024
+MIN_FRAMES = 1000
+MAX_FRAMES = 100000
+BATCH = 64
+
+def legacy_encode(message: Message) -> bytes:
+    data_len = len(message.data)
+    return struct.pack(f"!iQQ{data_len}s", message.message_type.value, message.tag,
+        data_len, message.data)
+
+async def legacy_decode(reader: asyncio.StreamReader) -> Message:
+    header_bytes = await reader.readexactly(struct.calcsize("!iQQ"))
+    message_type_id, tag, payload_length = struct.unpack("!iQQ", header_bytes)
+    data_bytes = await reader.readexactly(payload_length)
+    data, = struct.unpack(f"!{payload_length}s", data_bytes)
+    return Message(MessageType(message_type_id), tag, data)
+
+Pair = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+Sender = Callable[[asyncio.StreamWriter, List[Message]], Awaitable[None]]
+Receiver = Callable[[asyncio.StreamReader, int], Awaitable[None]]
+
+async def legacy_send(writer: asyncio.StreamWriter, messages: List[Message]) -> None:
+    for message in messages:
+        writer.write(legacy_encode(message))
+        await writer.drain()
+
+# Concurrent writers had to take a lock around write + drain
+async def legacy_send_concurrent(writer: asyncio.StreamWriter, messages: List[Message]) -> None:
+    writelock = asyncio.Lock()
+
+    async def send(message: Message) -> None:
+        async with writelock:
+            writer.write(legacy_encode(message))
+            await writer.drain()
+
+    for i in range(0, len(messages), BATCH):
+        await asyncio.gather(*(send(message) for message in messages[i:i + BATCH]))
+
+async def legacy_recv(reader: asyncio.StreamReader, count: int) -> None:
+    for _ in range(count):
+        await legacy_decode(reader)
+
+async def framed_send(writer: asyncio.StreamWriter, messages: List[Message]) -> None:
+    out = FrameWriter(writer)
+    for message in messages:
+        await out.send(message)
+
+# As responses go out of the server: from many tasks at once,
+# here in batches of up to maxinflight
+async def framed_send_concurrent(writer: asyncio.StreamWriter, messages: List[Message]) -> None:
+    out = FrameWriter(writer)
+    for i in range(0, len(messages), BATCH):
+        await asyncio.gather(*(out.send(message) for message in messages[i:i + BATCH]))
+
+async def framed_recv(reader: asyncio.StreamReader, count: int) -> None:
+    frames = FrameReader(reader)
+    for _ in range(count):
+        await frames.read()
+
+async def pair() -> Tuple[Pair, Pair]:
+    left, right = socket.socketpair()
+    return await asyncio.open_unix_connection(sock=left), \
+        await asyncio.open_unix_connection(sock=right)
+
+async def run(size: int, send: Sender, recv: Receiver) -> float:
+    count = max(MIN_FRAMES, min(MAX_FRAMES, TOTAL_BYTES // size))
+    payload = bytes(size)
+    messages = [Message(MessageType.APPENDR, tag, payload) for tag in range(count)]
+    (_, writer), (reader, other) = await pair()
+
+    start = time.perf_counter()
+    await asyncio.gather(send(writer, messages), recv(reader, count))
+    elapsed = time.perf_counter() - start
+
+    writer.close()
+    other.close()
+    return count / elapsed
+
+async def main() -> None:
+    print(f"{'':>10}{'one writer':>28}{'concurrent writers':>28}")
+    print(f"{'payload':>10}" + f"{'legacy fps':>14}{'framed fps':>14}" * 2)
+    for size in PAYLOADS:
+        results = [
+            await run(size, legacy_send, legacy_recv),
+            await run(size, framed_send, framed_recv),
+            await run(size, legacy_send_concurrent, legacy_recv),
+            await run(size, framed_send_concurrent, framed_recv),
+        ]
+        print(f"{size:>10}" + "".join(f"{fps:>14.0f}" for fps in results))
+
+if __name__ == "__main__":
+    asyncio.run(main())
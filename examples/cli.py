@@ -55,8 +55,8 @@ class Cli:
         if cmd == "walk":
             walkfid = int(splitinput[1])
             walknfid = int(splitinput[2])
-            path = splitinput[3]
-            walkreq = WalkRequest(walkfid, walknfid, path)
+            wnames = [wname for wname in splitinput[3].split("/") if wname]
+            walkreq = WalkRequest(walkfid, walknfid, wnames)
             print(f"\t> {walkreq}")
             walkresp = await self._client.walk(walkreq)
             print(f"\t< {walkresp}")
@@ -73,7 +73,7 @@ class Cli:
         if cmd == "append":
             wrfid = int(splitinput[1])
             data = splitinput[2]
-            writereq = AppendRequest(wrfid, data)
+            writereq = AppendRequest(wrfid, data.encode('utf-8'))
             print(f"\t> {writereq}")
             appendresp = await self._client.append(writereq)
             print(f"\t< {appendresp}")
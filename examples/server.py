@@ -1,9 +1,9 @@
 import asyncio
 import os
 import sys
+from typing import Set
 
-import aiofiles
-
+from srpc.lib.endpoint import Endpoint
 from srpc.lib.srv import Srv
 
 async def main() -> None:
@@ -13,22 +13,19 @@ async def main() -> None:
         os.path.join(os.path.dirname(__file__), "srpc.key"))
     await srv.announce("localhost", 42069, "/home/guest/echo")
 
+    # Every client that attaches gets an echo endpoint of
+    # its own, answering as many APPENDs at once as it sends
+    serving: Set["asyncio.Task[None]"] = set()
     async for linedir in srv.listen("/home/guest/echo"):
         print(f"New linedir: {linedir}")
-        loop = asyncio.get_event_loop()
         if linedir is not None:
-            await echo(linedir)
-
-async def echo(linedir: str) -> None:
-    send = linedir + "/echo/send"
-    recv = linedir + "/echo/recv"
+            task = asyncio.create_task(Endpoint(linedir, "echo").serve(echo))
+            serving.add(task)
+            task.add_done_callback(serving.discard)
 
-    while True:
-        async with aiofiles.open(recv, 'r') as rf:
-            print("Got data out")
-            data = await rf.read()
-            async with aiofiles.open(send, 'w') as wf:
-                await wf.write(data + "\n")
+async def echo(data: bytes) -> bytes:
+    print("Got data out")
+    return data
 
 def main2() -> None:
     if os.getuid() != 0:
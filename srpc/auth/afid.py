@@ -9,32 +9,106 @@
 # the authentication protocol, we leave that
 # to auth modules also implemented here...
 
+import asyncio
+import hashlib
+import hmac
+import os
 import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
 
 import pam
 
-from srpc.auth.dat import AFidData, AFidTable, AFidValidity
+from srpc.auth.dat import AFidCreated, AFidData, AFidTable, AFidValidity
 from srpc.nine.dat import Error, RPCException
 
+# A PAM stack may take its sweet time (LDAP, pam_faildelay...)
+# so it never runs on the event loop. At most PAM_WORKERS
+# authentications are in progress at once; the rest queue.
+PAM_WORKERS = 4
+pam_workers = PAM_WORKERS
+pam_executor = ThreadPoolExecutor(max_workers=pam_workers, thread_name_prefix="pam")
+
+# Successful authentications may be remembered for a few
+# seconds, so that a burst of reconnects doesn't turn into
+# a burst of PAM conversations. Off (0) unless configured.
+# Only a keyed hash of the credential is kept, and only
+# in memory.
+pam_ttl: float = 0.0
+pam_cache: Dict[Tuple[str, bytes], float] = {}
+pam_cache_key = os.urandom(32)
+
 def sanitize_path(rpath: str) -> str:
     return str(pathlib.Path(rpath))
 
-def authenticate(uname: str, passwd: str) -> bool:
+def configure_pam(workers: int = PAM_WORKERS, ttl: float = 0.0) -> None:
+    global pam_workers
+    global pam_executor
+    global pam_ttl
+
+    if workers != pam_workers:
+        pam_executor.shutdown(wait=False)
+        pam_workers = workers
+        pam_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pam")
+    pam_ttl = ttl
+    pam_cache.clear()
+
+def authenticate_blocking(uname: str, passwd: str) -> bool:
     p = pam.pam()
-    return p.authenticate(uname, passwd)
+    return bool(p.authenticate(uname, passwd))
+
+def credential_key(uname: str, passwd: str) -> Tuple[str, bytes]:
+    digest = hmac.new(pam_cache_key, passwd.encode('utf-8'), hashlib.sha256).digest()
+    return uname, digest
+
+async def authenticate(uname: str, passwd: str) -> bool:
+    key: Optional[Tuple[str, bytes]] = None
+    if pam_ttl > 0:
+        key = credential_key(uname, passwd)
+        expiry = pam_cache.get(key)
+        if expiry is not None:
+            if expiry > time.monotonic():
+                return True
+            del pam_cache[key]
+
+    loop = asyncio.get_running_loop()
+    ok = await loop.run_in_executor(pam_executor, authenticate_blocking, uname, passwd)
+
+    if ok and key is not None:
+        pam_cache[key] = time.monotonic() + pam_ttl
+    return ok
+
+# Forget every remembered authentication that has run
+# out, not just those that come up again; the reaper
+# calls this along with expire_afids
+def expire_pam_cache() -> None:
+    now = time.monotonic()
+    for key in [key for key, expiry in pam_cache.items() if expiry <= now]:
+        del pam_cache[key]
 
 # Attach is obviously unsupported
 # Walk is obviously unsupported
 # Stat is obviously unsupported
 
-# Good practice to dispose of your tokens
-# Maybe there can be a timeout on these
+# Good practice to dispose of your tokens. Those that
+# aren't get expired by the reaper (see srv/reaper.py)
 def clunk_afid(fidno: int) -> None:
     try:
         del AFidTable[fidno]
         del AFidValidity[fidno]
     except KeyError:
         pass
+    AFidCreated.pop(fidno, None)
+
+# Clunk every afid older than ttl seconds,
+# returning how many there were
+def expire_afids(ttl: float) -> int:
+    cutoff = time.monotonic() - ttl
+    expired = [fidno for fidno, created in AFidCreated.items() if created <= cutoff]
+    for fidno in expired:
+        clunk_afid(fidno)
+    return len(expired)
 
 # Auth itself
 # Currently returns a dummy QID
@@ -46,19 +120,29 @@ def mk_auth_afid(fidno: int, uname: str, aname: str) -> None:
     newdata = AFidData(uname, sanitize_path(aname))
     AFidTable[fidno] = newdata
     AFidValidity[fidno] = False
+    AFidCreated[fidno] = time.monotonic()
 
-# These are all simple, synchronous operations...write included
-def write_afid(fidno: int, data: str) -> str:
+# These are all simple, synchronous operations...save for write,
+# which has to wait on PAM
+async def write_afid(fidno: int, data: bytes) -> bytes:
     if fidno not in AFidTable:
         raise RPCException(Error.ENOSCHFD)
 
     # For now, we're making this simple: the password
     # is written to the clientmsg side of the afid.
     # The server authenticates this against PAM.
+    try:
+        passwd = data.decode('utf-8')
+    except UnicodeDecodeError as ex:
+        raise RPCException(Error.EAUTHENT) from ex
 
-    if authenticate(AFidTable[fidno].uname, data):
-        AFidValidity[fidno] = True
+    afid = AFidTable[fidno]
+    if await authenticate(afid.uname, passwd):
+        # The afid may have been clunked, or clunked and
+        # made anew, while we waited
+        if AFidTable.get(fidno) is afid:
+            AFidValidity[fidno] = True
 
-    if AFidValidity[fidno]:
-        return "1"
-    return "0"
+    if AFidValidity.get(fidno, False):
+        return b"1"
+    return b"0"
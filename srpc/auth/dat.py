@@ -28,6 +28,9 @@ class AFidData(NamedTuple):
 
 AFidTable: Dict[int, AFidData] = {}
 AFidValidity: Dict[int, bool] = {}
+# When each afid was made, by time.monotonic(),
+# so that forgotten ones can be expired
+AFidCreated: Dict[int, float] = {}
 
 # Mapping of users to ctls
 Relays: Dict[str, int] = {}
@@ -18,13 +18,17 @@
 # FID space is fine because we fork ahead of every
 # attachment, so these structures won't share
 # any info
-from typing import NamedTuple, Optional, List
+from typing import TYPE_CHECKING, NamedTuple, Optional, List, Tuple
+
+if TYPE_CHECKING:
+    import os
 
 class Stat(NamedTuple):
     qid: int
     fname: str  # Relative with respect to the fsroot
     isdir: bool
     children: List[str]
+    version: int
 
 # Elements of the FID<->QID mapping
 class FidData(NamedTuple):
@@ -39,3 +43,21 @@ class FidData(NamedTuple):
 class QidData(NamedTuple):
     fname: str
     isdir: bool
+
+# Everything cloning needs to know about one entry
+# of the template tree, so that it only has to be
+# looked up once. relpath is relative to the fsroot,
+# and empty for the fsroot itself.
+class TemplateEntry(NamedTuple):
+    relpath: str
+    isdir: bool
+    mode: int
+    uid: int
+    gid: int
+    atime_ns: int
+    mtime_ns: int
+    xattrs: Tuple[Tuple[str, bytes], ...]
+
+# A directory listing in progress, for READDIR: how
+# far in it is, and the scandir iterator to carry on with
+DirCursor = Tuple[int, "os._ScandirIterator[str]"]
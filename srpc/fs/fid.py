@@ -1,9 +1,11 @@
 # FID<->QID mapping logic
 
+import itertools
 import pathlib
-from typing import Dict
-from srpc.fs.dat import FidData, Stat
+from typing import Dict, List, Tuple
+from srpc.fs.dat import DirCursor, FidData, Stat
 from srpc.fs.qid import Qid
+from srpc.fs.unix import Stream, Subscription
 from srpc.auth.afid import write_afid, clunk_afid
 from srpc.nine.dat import Error, RPCException
 
@@ -32,32 +34,55 @@ def mk_attach_fid(
     fidtable[fidno] = newdata
     return aname_qid
 
+# Walk from parentfid one name at a time, 9P style,
+# returning the qid of every step taken. newfid is only
+# made if every step could be taken; should the first
+# fail, so does the walk.
 def mk_walk_fid(
     fidno: int,
     parentfid: int,
-    relpath: str,
+    wnames: List[str],
     fidtable: Dict[int, FidData],
     qid: Qid
-) -> int:
+) -> List[int]:
     try:
         olddata = fidtable[parentfid]
     except KeyError as ex:
         raise RPCException(Error.ENOSCHFD) from ex
 
-    if fidno in fidtable.keys():
+    # Walking a fid onto itself is fine, as in 9P
+    if fidno in fidtable.keys() and fidno != parentfid:
         raise RPCException(Error.EREUSEFD)
 
-    newpath = qid.qid_table[olddata.qid].fname
-    if ".." in relpath:
-        newpath = parent_path(newpath)
-    else:
-        newpath = sanitize_path(newpath + "/" + relpath)
-
-    newpath_qid = qid.qid_for_aname(newpath)
+    walkqids: List[int] = []
+    newpath_qid = olddata.qid
+    for wname in wnames:
+        try:
+            newpath_qid = walk_qid(newpath_qid, wname, qid)
+        except RPCException:
+            if not walkqids:
+                raise
+            return walkqids
+        walkqids.append(newpath_qid)
 
     newdata = FidData(olddata.uname, parentfid, newpath_qid)
     fidtable[fidno] = newdata
-    return newpath_qid
+    return walkqids
+
+# Take a single step of a walk. ".." at the root of
+# a tree stays put; anything with a slash in it, or
+# which doesn't name anything, is a bad path.
+def walk_qid(fromqid: int, wname: str, qid: Qid) -> int:
+    if wname in ("", ".") or "/" in wname:
+        raise RPCException(Error.EBADPATH)
+
+    oldpath = qid.qid_table[fromqid].fname
+    if wname == "..":
+        try:
+            return qid.qid_for_aname(parent_path(oldpath))
+        except RPCException:
+            return fromqid
+    return qid.qid_for_aname(sanitize_path(oldpath + "/" + wname))
 
 def stat_fid(fidno: int, fidtable: Dict[int, FidData], qid: Qid) -> Stat:
     try:
@@ -66,20 +91,163 @@ def stat_fid(fidno: int, fidtable: Dict[int, FidData], qid: Qid) -> Stat:
         raise RPCException(Error.ENOSCHFD) from ex
     return qid.stat_qid(qid_num)
 
+# Hand out the next count names of a directory, carrying
+# on with the fid's listing if offset is where it left off.
+# Returns the names and whether the listing is done.
+def readdir_fid(
+    fidno: int,
+    offset: int,
+    count: int,
+    fidtable: Dict[int, FidData],
+    qid: Qid,
+    cursors: Dict[int, DirCursor]
+) -> Tuple[List[str], bool]:
+    try:
+        qid_num = fidtable[fidno].qid
+    except KeyError as ex:
+        raise RPCException(Error.ENOSCHFD) from ex
+    if offset < 0 or count <= 0:
+        raise RPCException(Error.EILLEGAL)
+
+    cursor = cursors.pop(fidno, None)
+    if cursor is not None and cursor[0] == offset:
+        entries = cursor[1]
+    else:
+        if cursor is not None:
+            cursor[1].close()
+        entries = qid.scan_qid(qid_num)
+        # Skip ahead without keeping what we skip
+        for _ in itertools.islice(entries, offset):
+            pass
+
+    try:
+        names = [entry.name for entry in itertools.islice(entries, count)]
+    except OSError as ex:
+        entries.close()
+        raise RPCException(Error.EOPENRDF) from ex
+    if len(names) < count:
+        entries.close()
+        return names, True
+    cursors[fidno] = (offset + len(names), entries)
+    return names, False
+
+def close_cursors(cursors: Dict[int, DirCursor]) -> None:
+    for _, entries in cursors.values():
+        entries.close()
+    cursors.clear()
+
 async def write_fid(
     fidno: int,
-    data: str,
+    data: bytes,
     fidtable: Dict[int, FidData],
     qid: Qid
-) -> str:
+) -> bytes:
     if fidno not in fidtable:
-        return write_afid(fidno, data)
+        return await write_afid(fidno, data)
 
     return await qid.write_qid(fidtable[fidno].qid, data)
 
-def clunk_fid(fidno: int, fidtable: Dict[int, FidData]) -> None:
+# Pass the next chunk of a streamed APPEND's argument on
+# to the endpoint, starting a new call on the fid if the
+# last one's argument is done with
+async def sappend_fid(
+    fidno: int,
+    data: bytes,
+    eof: bool,
+    fidtable: Dict[int, FidData],
+    qid: Qid,
+    streams: Dict[int, Stream]
+) -> None:
+    try:
+        qid_num = fidtable[fidno].qid
+    except KeyError as ex:
+        raise RPCException(Error.ENOSCHFD) from ex
+
+    stream = streams.get(fidno)
+    if stream is None or stream.sent:
+        if stream is not None:
+            stream.close()
+        stream = streams[fidno] = qid.stream_qid(qid_num)
+    try:
+        if data:
+            await stream.write(data)
+        if eof:
+            await stream.end()
+    except RPCException:
+        del streams[fidno]
+        stream.close()
+        raise
+
+# The next chunk of the reply to the fid's streamed
+# APPEND, and whether it was the last
+async def sread_fid(fidno: int, streams: Dict[int, Stream]) -> Tuple[bytes, bool]:
+    try:
+        stream = streams[fidno]
+    except KeyError as ex:
+        raise RPCException(Error.EILLEGAL) from ex
+
+    try:
+        data, eof = await stream.read()
+    except RPCException:
+        streams.pop(fidno, None)
+        stream.close()
+        raise
+    if eof:
+        streams.pop(fidno, None)
+        stream.close()
+    return data, eof
+
+def close_streams(streams: Dict[int, Stream]) -> None:
+    for stream in streams.values():
+        stream.close()
+    streams.clear()
+
+# Subscribe to the notifications of the endpoint the fid
+# points at, one subscription per fid
+async def subscribe_fid(
+    fidno: int,
+    fidtable: Dict[int, FidData],
+    qid: Qid,
+    subscriptions: Dict[int, Subscription]
+) -> Subscription:
+    try:
+        qid_num = fidtable[fidno].qid
+    except KeyError as ex:
+        raise RPCException(Error.ENOSCHFD) from ex
+    if fidno in subscriptions:
+        raise RPCException(Error.EREUSEFD)
+
+    subscription = await qid.subscribe_qid(qid_num)
+    # Clunked while we were at it
+    if fidno not in fidtable or fidno in subscriptions:
+        subscription.close()
+        raise RPCException(Error.ENOSCHFD)
+    subscriptions[fidno] = subscription
+    return subscription
+
+def close_subscriptions(subscriptions: Dict[int, Subscription]) -> None:
+    for subscription in subscriptions.values():
+        subscription.close()
+    subscriptions.clear()
+
+def clunk_fid(
+    fidno: int,
+    fidtable: Dict[int, FidData],
+    cursors: Dict[int, DirCursor],
+    streams: Dict[int, Stream],
+    subscriptions: Dict[int, Subscription]
+) -> None:
     try:
         del fidtable[fidno]
     except KeyError:
         pass
+    cursor = cursors.pop(fidno, None)
+    if cursor is not None:
+        cursor[1].close()
+    stream = streams.pop(fidno, None)
+    if stream is not None:
+        stream.close()
+    subscription = subscriptions.pop(fidno, None)
+    if subscription is not None:
+        subscription.close()
     clunk_afid(fidno)
@@ -0,0 +1,132 @@
+# Directory change notification through inotify(7).
+
+# The standard library has no inotify bindings, so we
+# go through libc with ctypes. A worker keeps a single
+# inotify descriptor, read from the event loop, and
+# calls back whoever watches a directory as soon as an
+# entry there is made, removed or renamed, or the
+# directory itself goes away.
+#
+# Where inotify can't be had (not Linux, out of
+# instances...) watcher() returns None, and callers
+# have to go and look for themselves.
+
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from typing import Callable, Dict, List, Optional
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# Whatever changes what a directory lists
+DIR_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+EVENT = struct.Struct("iIII")
+
+READSIZE = 64 * 1024
+
+class Watcher:
+    def __init__(self, libc: ctypes.CDLL, fd: int, loop: asyncio.AbstractEventLoop) -> None:
+        self._libc = libc
+        self._fd = fd
+        self._loop = loop
+        self._callbacks: Dict[int, List[Callable[[], None]]] = {}
+        loop.add_reader(fd, self._read)
+
+    # Call callback whenever path changes, returning the
+    # watch descriptor to hand back to unwatch
+    def watch(self, path: str, callback: Callable[[], None]) -> Optional[int]:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), DIR_EVENTS)
+        if wd < 0:
+            print("9: couldn't watch", path, os.strerror(ctypes.get_errno()))
+            return None
+        # The same directory gets the same wd
+        self._callbacks.setdefault(wd, []).append(callback)
+        return int(wd)
+
+    def unwatch(self, wd: int, callback: Callable[[], None]) -> None:
+        callbacks = self._callbacks.get(wd)
+        if callbacks is None:
+            return
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            del self._callbacks[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read(self) -> None:
+        try:
+            data = os.read(self._fd, READSIZE)
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                print("9: inotify read failed:", ex)
+            return
+
+        # Coalesce: each watcher hears of a batch once
+        fired: Dict[int, None] = {}
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, namelen = EVENT.unpack_from(data, offset)
+            offset += EVENT.size + namelen
+            if mask & IN_Q_OVERFLOW:
+                # Lost track; everybody has to look again
+                fired.update(dict.fromkeys(self._callbacks))
+                continue
+            fired[wd] = None
+            if mask & IN_IGNORED:
+                # The watch is gone, with its directory
+                for callback in self._callbacks.pop(wd, []):
+                    callback()
+                fired.pop(wd)
+
+        for wd in fired:
+            for callback in list(self._callbacks.get(wd, [])):
+                callback()
+
+    def close(self) -> None:
+        self._loop.remove_reader(self._fd)
+        os.close(self._fd)
+        self._callbacks.clear()
+
+_watcher: Optional[Watcher] = None
+_unavailable = False
+
+# The process' Watcher, made on first use from within
+# the event loop, or None if there can't be one
+def watcher() -> Optional[Watcher]:
+    global _watcher
+    global _unavailable
+
+    if _watcher is not None or _unavailable:
+        return _watcher
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        init1 = libc.inotify_init1
+    except (OSError, AttributeError):
+        _unavailable = True
+        return None
+
+    fd = init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        print("9: no inotify:", os.strerror(ctypes.get_errno()))
+        _unavailable = True
+        return None
+    _watcher = Watcher(libc, fd, loop)
+    return _watcher
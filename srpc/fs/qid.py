@@ -2,149 +2,151 @@
 # Manage the mapping between QIDs
 # and socket files.
 
-import shutil
 import os
-import pwd
-import grp
-from typing import List, Dict
+from typing import Callable, List, Dict, Set, Tuple
 
-from srpc.fs.dat import QidData, Stat
-from srpc.fs.unix import write_pipe, read_pipe
+from srpc.fs.dat import QidData, Stat, TemplateEntry
+from srpc.fs.inotify import watcher
+from srpc.fs.template import TreeDirs, claim_tree, make_lazy_fifos, make_tree, manifest_for
+from srpc.fs.trees import indices, tree_path
+from srpc.fs.unix import FramedPipe, Pipe, Stream, Subscription
 from srpc.nine.dat import Error, RPCException
 
 ROOT_QID = 0
 
 class Qid:
-    def __init__(self) -> None:
+    def __init__(self, lazy: bool = False, framed: bool = True) -> None:
         # qidcount 0 is reserved for the root at the moment
         # work around this by setting the initial count to 1
         self._qidcount = 1
-        self._concount = 1
         self._qid_table: Dict[int, QidData] = {}
+        # Reverse index of the above, so that resolving a
+        # path on ATTACH and WALK doesn't scan every qid
+        self._qid_for_path: Dict[str, int] = {}
+        # Endpoint FIFOs, held open across APPENDs
+        self._pipes: Dict[int, Pipe] = {}
+        # Endpoints whose pipes are yet to be made,
+        # by qid, along with the tree they belong to and
+        # what make_tree made of it
+        self._lazy = lazy
+        # Whether endpoints speak framed pipes (see fs/unix.py)
+        self._framed = framed
+        self._pending: Dict[int, Tuple[str, TreeDirs, TemplateEntry]] = {}
+        # What STAT last returned per qid, and the qids for
+        # which it still holds: those whose directory we are
+        # watching (see fs/inotify.py), and all endpoints
+        self._stats: Dict[int, Stat] = {}
+        self._fresh: Set[int] = set()
+        self._versions: Dict[int, int] = {}
+        self._watches: Dict[int, Tuple[int, Callable[[], None]]] = {}
 
     @property
     def qid_table(self) -> Dict[int, QidData]:
         return self._qid_table
 
+    @property
+    def lazy(self) -> bool:
+        return self._lazy
+
+    @property
+    def framed(self) -> bool:
+        return self._framed
+
     # Initialization: clone the template filesystem
     # into a new tree of named pipes for a given user
     # This does NOT handle the ctl file
+    # Servers take their trees ready-made from fs/trees.py
+    # instead; this is the same thing, done on the spot.
     def clone(self, fsroot: str) -> str:
-        # Recurse through the filesystem on disk and
-        # copy sockets into a tree. By default, this
-        # winds up a directory above the fsroot in
-        # a directory numbered by concount, as such...
-        cloneroot = f"/srv/{self._concount}/"
-        while os.path.isdir(cloneroot):
-            self._concount += 1
-            cloneroot = f"/srv/{self._concount}/"
-
-        def all_templates(fsroot: str) -> List[str]:
-            fpaths: List[str] = []
-            for root, dirs, files in os.walk(fsroot):
-                for dirname in dirs:
-                    fpaths.append(os.path.join(root, dirname))
-                for filename in files:
-                    fpaths.append(os.path.join(root, filename))
-
-            return fpaths
-
-        # For every file in the directory here,
-        # instantiate two named pipes with
-        # the same name as that file, one for sending
-        # and one for receiving.
-        os.mkdir(cloneroot)
-        for fpath in all_templates(fsroot):
-            clonepath = fpath.replace(fsroot, cloneroot)
-            # If we've got a directory
-            # - mkdir
-            # - register
-            # - copystat
-            # - chown
-            if os.path.isdir(fpath):
-                os.mkdir(clonepath)
-                self.register_qid(clonepath, True)
-                shutil.copystat(fpath, clonepath)
-                shutil.chown(
-                        clonepath,
-                        user=pwd.getpwuid(os.stat(fpath).st_uid).pw_name,
-                        group=grp.getgrgid(os.stat(fpath).st_gid).gr_name
-                        )
-
-                print("Registered directory", clonepath)
-
-            # If we've got a file, make a send/recv pair
-            # - mkdir
-            # - mkfifo x 2
-            # - copystat x 2
-            # - chmod x 1 -- need to create a generic directory
-            # - chown x 3
-            else:
-                os.mkdir(clonepath)
-                os.chmod(clonepath, 0o755)
-                shutil.chown(
-                        clonepath,
-                        user=pwd.getpwuid(os.stat(fpath).st_uid).pw_name,
-                        group=grp.getgrgid(os.stat(fpath).st_gid).gr_name
-                        )
-                self.register_qid(clonepath, False)
-                print("Registered pre-file", clonepath)
-
-                os.mkfifo(clonepath + "/recv")
-                os.mkfifo(clonepath + "/send")
-
-                shutil.copystat(fpath, clonepath + "/recv")
-                shutil.chown(
-                        clonepath + "/recv",
-                        user=pwd.getpwuid(os.stat(fpath).st_uid).pw_name,
-                        group=grp.getgrgid(os.stat(fpath).st_gid).gr_name
-                        )
-                shutil.copystat(fpath, clonepath + "/send")
-                shutil.chown(
-                        clonepath + "/send",
-                        user=pwd.getpwuid(os.stat(fpath).st_uid).pw_name,
-                        group=grp.getgrgid(os.stat(fpath).st_gid).gr_name
-                        )
-
-        # Manually register the root directory
-        # since os.walk won't cover it
-        # Register this with the original fsroot perms.
-        shutil.copystat(fsroot, cloneroot)
-        shutil.chown(
-                cloneroot,
-                user=pwd.getpwuid(os.stat(fsroot).st_uid).pw_name,
-                group=grp.getgrgid(os.stat(fsroot).st_gid).gr_name
-                )
+        entries = manifest_for(fsroot)
+        cloneroot = tree_path(indices.allocate())
+        dirs = make_tree(cloneroot, entries, self._lazy)
+        claim_tree(cloneroot, entries)
+        self.adopt(cloneroot, entries, dirs)
+        return cloneroot
+
+    # Register qids for a tree cloned from entries. They are
+    # numbered in manifest order, with the root last as qid 0.
+    def adopt(self, cloneroot: str, entries: List[TemplateEntry], dirs: TreeDirs) -> None:
+        for entry in entries[1:]:
+            self.register_qid(os.path.join(cloneroot, entry.relpath), entry.isdir)
+            if self._lazy and not entry.isdir:
+                self._pending[self._qidcount - 1] = (cloneroot, dirs, entry)
 
         self.register_qid(cloneroot[:-1], True, isroot = True)
         print("Registered", cloneroot[:-1])
 
-        return cloneroot
+    # Undo adopt, for a tree that won't be used after all
+    def disown(self, cloneroot: str) -> None:
+        for qid, data in list(self._qid_table.items()):
+            if data.fname == cloneroot[:-1] or data.fname.startswith(cloneroot):
+                self.unregister_qid(qid)
+
+    # Lay down the pipes for a lazily cloned endpoint,
+    # if they aren't there already. Has to happen with
+    # the privileges clone ran with, in a tree its user
+    # has had the run of (see make_lazy_fifos).
+    def materialize(self, qid: int) -> None:
+        try:
+            cloneroot, dirs, entry = self._pending.pop(qid)
+        except KeyError:
+            return
+        make_lazy_fifos(cloneroot, dirs, entry)
 
     def qid_for_aname(self, fname: str) -> int:
-        print("Checking", fname)
-        for qid in self._qid_table:
-            if self._qid_table[qid].fname == fname:
-                return qid
+        try:
+            return self._qid_for_path[fname]
+        except KeyError as ex:
+            raise RPCException(Error.EBADPATH) from ex
 
-        raise RPCException(Error.EBADPATH)
+    # Every change to the qid table goes through here and
+    # unregister_qid, which keep the path index in step.
+    # A qid being (re)assigned loses whatever path it had.
+    def _set_qid(self, qid: int, data: QidData) -> None:
+        self.unregister_qid(qid)
+        self._qid_table[qid] = data
+        self._qid_for_path[data.fname] = qid
 
     def register_qid(self, path: str, isdir: bool, isroot: bool = False) -> None:
         # Pop the QID into the table, with
         # no associated writer/reader for the
         # time being.
         if not isroot:
-            self._qid_table[self._qidcount] = QidData(path, isdir)
+            self._set_qid(self._qidcount, QidData(path, isdir))
             self._qidcount += 1
         else:
-            self._qid_table[0] = QidData(path, isdir)
+            self._set_qid(ROOT_QID, QidData(path, isdir))
 
+    def unregister_qid(self, qid: int) -> None:
+        self._pending.pop(qid, None)
+        pipe = self._pipes.pop(qid, None)
+        if pipe is not None:
+            pipe.close()
+        self._forget_stat(qid)
+        try:
+            olddata = self._qid_table.pop(qid)
+        except KeyError:
+            return
+        if self._qid_for_path.get(olddata.fname) == qid:
+            del self._qid_for_path[olddata.fname]
+
+    # Take on a qid assigned elsewhere, i.e. by the
+    # parent process when it cloned the tree for us
+    def install_qid(self, qid: int, path: str, isdir: bool) -> None:
+        self._set_qid(qid, QidData(path, isdir))
+        self._qidcount = max(self._qidcount, qid + 1)
+
+    # STATs are answered from the last one for as long as
+    # nothing has changed in the directory since. Without
+    # inotify, directories are listed every time, which
+    # at least keeps the version right.
     def stat_qid(self, qid: int) -> Stat:
+        if qid in self._fresh:
+            return self._stats[qid]
         data = self._qid_table[qid]
 
-        # Strip off the fsroot
-        fsroot = self._qid_table[ROOT_QID]
-        userpath = data.fname.replace(fsroot.fname, "/")
+        # Watch before listing, so that nothing slips in between
+        fresh = not data.isdir or self._watch(qid, data.fname)
 
         children: List[str] = []
         try:
@@ -153,19 +155,111 @@ class Qid:
         except OSError as ex:
             raise RPCException(Error.EOPENRDF) from ex
 
-        return Stat(qid, userpath, data.isdir, children)
+        # Unless inotify has told us already
+        oldstat = self._stats.get(qid)
+        if oldstat is not None and oldstat.version == self.version(qid) \
+                and oldstat.children != children:
+            self._changed(qid)
+
+        # Strip off the fsroot
+        fsroot = self._qid_table[ROOT_QID]
+        userpath = data.fname.replace(fsroot.fname, "/")
+
+        stat = Stat(qid, userpath, data.isdir, children, self.version(qid))
+        self._stats[qid] = stat
+        if fresh:
+            self._fresh.add(qid)
+        return stat
+
+    # The version of a qid: bumped whenever a STAT of it
+    # would come out differently than the last
+    def version(self, qid: int) -> int:
+        return self._versions.setdefault(qid, 1)
+
+    def _changed(self, qid: int) -> None:
+        self._fresh.discard(qid)
+        self._versions[qid] = self.version(qid) + 1
+
+    def _watch(self, qid: int, path: str) -> bool:
+        if qid in self._watches:
+            return True
+        inotify = watcher()
+        if inotify is None:
+            return False
+
+        def changed() -> None:
+            self._changed(qid)
+            # Gone for good if the directory is; look again
+            # (and watch anew) next time
+            if not os.path.isdir(path):
+                self._unwatch(qid)
+
+        wd = inotify.watch(path, changed)
+        if wd is None:
+            return False
+        self._watches[qid] = (wd, changed)
+        return True
+
+    # The qid is going away or getting reassigned: stop
+    # watching it, and make sure whatever it becomes
+    # gets a version of its own
+    def _forget_stat(self, qid: int) -> None:
+        self._stats.pop(qid, None)
+        if qid in self._versions:
+            self._changed(qid)
+        self._unwatch(qid)
+
+    def _unwatch(self, qid: int) -> None:
+        try:
+            wd, changed = self._watches.pop(qid)
+        except KeyError:
+            return
+        inotify = watcher()
+        if inotify is not None:
+            inotify.unwatch(wd, changed)
+
+    # Start listing a directory, one entry at a time
+    def scan_qid(self, qid: int) -> "os._ScandirIterator[str]":
+        data = self._qid_table[qid]
+        if not data.isdir:
+            raise RPCException(Error.EOPENRDF)
+        # Watched from here on, like a STAT
+        self._watch(qid, data.fname)
+        try:
+            return os.scandir(data.fname)
+        except OSError as ex:
+            raise RPCException(Error.EOPENRDF) from ex
+
+    async def write_qid(self, qid: int, data: bytes) -> bytes:
+        return await self._pipe_for(qid).call(data)
 
-    async def write_qid(self, qid: int, data: str) -> str:
+    # Start a streamed call to qid's endpoint
+    def stream_qid(self, qid: int) -> Stream:
+        return self._pipe_for(qid).stream()
+
+    async def subscribe_qid(self, qid: int) -> Subscription:
+        return await self._pipe_for(qid).subscribe()
+
+    def _pipe_for(self, qid: int) -> Pipe:
         qidinfo = self._qid_table[qid]
-        qiddir = qidinfo.fname
 
         if qidinfo.isdir:
             raise RPCException(Error.EOPENWRF)
 
-        qid_server_recv = os.path.join(qiddir, "recv")
-        await write_pipe(qid_server_recv, data)
-
         # Reading a directory has (sadly) been relegated
         # to stat. Doing the thing.
-        qid_server_send = os.path.join(qiddir, "send")
-        return await read_pipe(qid_server_send)
+        try:
+            return self._pipes[qid]
+        except KeyError:
+            pipe = self._pipes[qid] = \
+                FramedPipe(qidinfo.fname) if self._framed else Pipe(qidinfo.fname)
+            return pipe
+
+    # Let go of every FIFO we are holding open, and
+    # every directory we are watching
+    def close(self) -> None:
+        for pipe in self._pipes.values():
+            pipe.close()
+        self._pipes.clear()
+        for qid in list(self._watches):
+            self._forget_stat(qid)
@@ -0,0 +1,176 @@
+# Shared memory for large payloads on framed pipes.
+
+# A big APPEND is copied into recv, back out of it, and
+# again through the StreamReader on the far side, and its
+# answer the same way through send. Both ends of a pipe
+# being on the same machine, an application may offer to
+# do without all that: lib/endpoint.py, asked to, lays
+# down a file next to each of the endpoint's pipes,
+# recv.shm and send.shm, owned and moded like the pipe,
+# and maps both. From then on, a payload of SHM_THRESHOLD
+# bytes or more is written straight into the file of the
+# pipe it would have gone over, and only where it lies
+# (SHM_REF) goes over the pipe, with a P_SHMCALL or a
+# P_SHMREPLY (see fs/unix.py). The other side reads it
+# right out of its own mapping.
+#
+# Each file has a single writer, which hands out room in
+# it (see Ring) and takes it back once the reader is done
+# with it: an argument once its call has been answered,
+# or dropped on our asking (see P_CLOSE), an answer once
+# the reader says so with a P_FREE. Whatever doesn't fit
+# goes over the pipe as it always has.
+#
+# The application makes both files anew whenever it
+# starts serving, so a mapping stays good for as long as
+# its file is there; should it be taken away or made
+# anew (e.g. by an application that no longer offers it,
+# or has restarted), the other side notices on its next
+# large payload.
+
+import mmap
+import os
+import stat
+import struct
+from typing import Dict, Optional
+
+# Where a payload lies in the file: offset, length
+SHM_REF = struct.Struct("!QI")
+
+# Payloads any smaller go over the pipe, being cheaper
+# to copy than to find room for
+SHM_THRESHOLD = 64 * 1024
+
+# How big lib/endpoint.py makes the files, by default
+SHM_SIZE = 64 * 1024 * 1024
+
+# Room in a file, handed out first fit, starting from
+# wherever the last payload ended, so that payloads go
+# around the file in turn much as they would a ring
+class Ring:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._head = 0
+        # offset -> length of everything handed out
+        self._used: Dict[int, int] = {}
+
+    def alloc(self, length: int) -> Optional[int]:
+        starts = [self._head, 0] + [offset + used for offset, used in self._used.items()]
+        for start in starts:
+            end = start + length
+            if end > self.size:
+                continue
+            if any(offset < end and start < offset + used
+                    for offset, used in self._used.items()):
+                continue
+            self._used[start] = length
+            self._head = end
+            return start
+        return None
+
+    def free(self, offset: int) -> None:
+        self._used.pop(offset, None)
+
+    # Whoever had anything of ours is gone
+    def reset(self) -> None:
+        self._head = 0
+        self._used.clear()
+
+class Shm:
+    def __init__(self, path: str, fd: int, writable: bool) -> None:
+        st = os.fstat(fd)
+        self.path = path
+        self._fd = fd
+        self._ino = st.st_ino
+        self._map = mmap.mmap(fd, st.st_size,
+            access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.ring = Ring(st.st_size)
+
+    @property
+    def size(self) -> int:
+        return len(self._map)
+
+    # Has the file been taken away (or swapped) since?
+    def stale(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != self._ino
+        except OSError:
+            return True
+
+    # Copy data in, returning the SHM_REF to send in its
+    # stead, or None should there be no room for it
+    def write(self, data: bytes) -> Optional[bytes]:
+        offset = self.ring.alloc(len(data))
+        if offset is None:
+            return None
+        self._map[offset:offset + len(data)] = data
+        return SHM_REF.pack(offset, len(data))
+
+    def free(self, ref: bytes) -> None:
+        offset, _ = SHM_REF.unpack(ref)
+        self.ring.free(offset)
+
+    # The payload ref points at, in place. ValueError if
+    # it points anywhere else.
+    def view(self, ref: bytes) -> memoryview:
+        if len(ref) != SHM_REF.size:
+            raise ValueError(f"{self.path}: garbled payload reference")
+        offset, length = SHM_REF.unpack(ref)
+        if offset + length > len(self._map):
+            raise ValueError(f"{self.path}: payload out of bounds")
+        return memoryview(self._map)[offset:offset + length]
+
+    def close(self) -> None:
+        try:
+            self._map.close()
+        except BufferError:
+            # Somebody is still looking; the mapping goes
+            # once they are done
+            pass
+        os.close(self._fd)
+
+# Map the file at path as the application left it, or
+# None if it hasn't (or we can't get at it). Nothing but
+# a plain file will do: a FIFO left there would have us
+# wait on it, a symlink lead us anywhere.
+def open_shm(path: str, writable: bool) -> Optional[Shm]:
+    flags = os.O_RDWR if writable else os.O_RDONLY
+    try:
+        fd = os.open(path, flags | os.O_NOFOLLOW | os.O_NONBLOCK | os.O_CLOEXEC)
+    except OSError:
+        return None
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            raise ValueError(f"{path}: not a regular file")
+        return Shm(path, fd, writable)
+    except (OSError, ValueError):
+        # Empty, or not a file we can map
+        os.close(fd)
+        return None
+
+# Make the file at path anew, size bytes big, with the
+# owner and mode of the pipe it goes with. The endpoint
+# directory is the user's, so whatever is there already
+# (say, a symlink to somewhere only we may write) goes,
+# and the file is only ever one we have just made.
+def make_shm(path: str, pipe: str, size: int) -> Shm:
+    st = os.stat(pipe, follow_symlinks=False)
+    if not stat.S_ISFIFO(st.st_mode):
+        raise OSError(f"{pipe}: not a named pipe")
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC,
+        0o600)
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            raise OSError(f"{path}: not a regular file")
+        os.ftruncate(fd, size)
+        os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        if os.geteuid() == 0:
+            os.fchown(fd, st.st_uid, st.st_gid)
+        return Shm(path, fd, True)
+    except BaseException:
+        os.close(fd)
+        raise
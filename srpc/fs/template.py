@@ -0,0 +1,198 @@
+# Template filesystem manifests.
+
+# Every ATTACH clones the template tree under the rpcroot
+# into a fresh tree of named pipes. Rather than walking and
+# stat'ing the template (and looking up its owners by name)
+# over again for each clone, we walk it once into a manifest
+# of everything a clone needs to know, and keep that around.
+# The manifest is revalidated against the mtimes of the
+# template's directories, which change whenever an entry is
+# added, removed or renamed. (Changing the owner or mode
+# of a template file in place doesn't bump them; restart
+# the server to pick that up.)
+#
+# Clones are then laid down relative to a descriptor for the
+# clone root (mkdirat, mkfifoat, fchownat...), with numeric
+# owners, so there's no path resolution from / and no passwd
+# or group lookups per file.
+
+import errno
+import os
+import stat
+from typing import Dict, List, Tuple
+
+from srpc.fs.dat import TemplateEntry
+
+# Template root -> (directory mtimes, manifest)
+Manifests: Dict[str, Tuple[Dict[str, int], List[TemplateEntry]]] = {}
+
+# Mode of the directory standing in for each template file
+ENDPOINT_MODE = 0o755
+
+# relpath -> (inode, owner) of every directory make_tree
+# made below the root of a lazily cloned tree, to check
+# the way to an endpoint against later (see make_lazy_fifos)
+TreeDirs = Dict[str, Tuple[int, int]]
+
+def read_xattrs(path: str) -> Tuple[Tuple[str, bytes], ...]:
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+        return tuple((name, os.getxattr(path, name, follow_symlinks=False)) for name in names)
+    except OSError as ex:
+        if ex.errno in (errno.ENOTSUP, errno.ENODATA, errno.EPERM):
+            return ()
+        raise
+
+def template_entry(fsroot: str, path: str) -> TemplateEntry:
+    st = os.stat(path)
+    return TemplateEntry(
+        os.path.relpath(path, fsroot) if path != fsroot else "",
+        stat.S_ISDIR(st.st_mode),
+        stat.S_IMODE(st.st_mode),
+        st.st_uid,
+        st.st_gid,
+        st.st_atime_ns,
+        st.st_mtime_ns,
+        read_xattrs(path)
+    )
+
+# The root comes first, then everything under it in
+# os.walk order: parents always precede their children
+def build_manifest(fsroot: str) -> Tuple[Dict[str, int], List[TemplateEntry]]:
+    dirmtimes: Dict[str, int] = {}
+    entries = [template_entry(fsroot, fsroot)]
+    for root, dirs, files in os.walk(fsroot):
+        dirmtimes[root] = os.stat(root).st_mtime_ns
+        for dirname in dirs:
+            entries.append(template_entry(fsroot, os.path.join(root, dirname)))
+        for filename in files:
+            entries.append(template_entry(fsroot, os.path.join(root, filename)))
+    return dirmtimes, entries
+
+def manifest_for(fsroot: str) -> List[TemplateEntry]:
+    try:
+        dirmtimes, entries = Manifests[fsroot]
+        if all(os.stat(path).st_mtime_ns == mtime for path, mtime in dirmtimes.items()):
+            return entries
+    except (KeyError, OSError):
+        pass
+
+    Manifests[fsroot] = build_manifest(fsroot)
+    return Manifests[fsroot][1]
+
+# Give a freshly made clone file the owner, permissions,
+# times and extended attributes of its template, much
+# as shutil.copystat and shutil.chown would
+def apply_stat(rootfd: int, relpath: str, clonepath: str, entry: TemplateEntry,
+        mode: int, times: bool = True) -> None:
+    os.chown(relpath, entry.uid, entry.gid, dir_fd=rootfd, follow_symlinks=False)
+    os.chmod(relpath, mode, dir_fd=rootfd)
+    if times:
+        os.utime(relpath, ns=(entry.atime_ns, entry.mtime_ns), dir_fd=rootfd)
+    for name, value in entry.xattrs:
+        try:
+            os.setxattr(clonepath, name, value, follow_symlinks=False)
+        except OSError as ex:
+            if ex.errno not in (errno.ENOTSUP, errno.EPERM, errno.EINVAL):
+                raise
+
+# Template directories become directories
+def make_dir(rootfd: int, cloneroot: str, entry: TemplateEntry) -> None:
+    os.mkdir(entry.relpath, dir_fd=rootfd)
+    apply_stat(rootfd, entry.relpath, os.path.join(cloneroot, entry.relpath),
+        entry, entry.mode)
+
+# Template files become a directory...
+def make_endpoint(rootfd: int, entry: TemplateEntry) -> None:
+    os.mkdir(entry.relpath, dir_fd=rootfd)
+    os.chmod(entry.relpath, ENDPOINT_MODE, dir_fd=rootfd)
+    os.chown(entry.relpath, entry.uid, entry.gid, dir_fd=rootfd, follow_symlinks=False)
+
+# ...holding a send/recv pair of named pipes
+def make_fifos(rootfd: int, cloneroot: str, entry: TemplateEntry) -> None:
+    for name in ("recv", "send"):
+        relpath = os.path.join(entry.relpath, name)
+        os.mkfifo(relpath, dir_fd=rootfd)
+        apply_stat(rootfd, relpath, os.path.join(cloneroot, relpath), entry, entry.mode)
+
+# make_fifos, for an endpoint of a tree that has been handed
+# over already. Its owner may have moved things around in
+# it since, so nothing here goes by path: the way down is
+# taken a directory at a time, none of them symlinks and
+# each the one make_tree made, and the pipes are seen to
+# through descriptors for them.
+def make_lazy_fifos(cloneroot: str, dirs: TreeDirs, entry: TemplateEntry) -> None:
+    dirfd = os.open(cloneroot, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC)
+    try:
+        parts = entry.relpath.split("/")
+        for depth in range(len(parts)):
+            nextfd = os.open(parts[depth], os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+                | os.O_CLOEXEC, dir_fd=dirfd)
+            os.close(dirfd)
+            dirfd = nextfd
+            st = os.fstat(dirfd)
+            if (st.st_ino, st.st_uid) != dirs.get("/".join(parts[:depth + 1])):
+                raise OSError(f"{cloneroot}{entry.relpath}: moved since it was made")
+
+        for name in ("recv", "send"):
+            os.mkfifo(name, 0o600, dir_fd=dirfd)
+            fd = os.open(name, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW | os.O_CLOEXEC,
+                dir_fd=dirfd)
+            try:
+                # Ours, or swapped for one of somebody else's
+                st = os.fstat(fd)
+                if not stat.S_ISFIFO(st.st_mode) or st.st_uid != os.geteuid():
+                    raise OSError(f"{cloneroot}{entry.relpath}/{name}: not the pipe we made")
+                os.chown(fd, entry.uid, entry.gid)
+                os.chmod(fd, entry.mode)
+                os.utime(fd, ns=(entry.atime_ns, entry.mtime_ns))
+                for xname, value in entry.xattrs:
+                    try:
+                        os.setxattr(fd, xname, value)
+                    except OSError as ex:
+                        if ex.errno not in (errno.ENOTSUP, errno.EPERM, errno.EINVAL):
+                            raise
+            finally:
+                os.close(fd)
+        # Put the endpoint directory's times back too
+        os.utime(dirfd, ns=(entry.atime_ns, entry.mtime_ns))
+    finally:
+        os.close(dirfd)
+
+# Lay a whole tree down under cloneroot, minus the pipes
+# when lazy, in which case what it made is returned for
+# make_lazy_fifos to go by. The root itself is left as
+# made: root's own, mode 0700, until claim_tree hands it
+# over, so nobody can go poking around a tree before it
+# has been claimed.
+def make_tree(cloneroot: str, entries: List[TemplateEntry], lazy: bool) -> TreeDirs:
+    dirs: TreeDirs = {}
+    os.mkdir(cloneroot, 0o700)
+    rootfd = os.open(cloneroot, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        # Every directory in the template is recreated as is.
+        # Every file becomes a directory holding two named
+        # pipes with the same name as that file, one for
+        # sending and one for receiving.
+        for entry in entries[1:]:
+            if entry.isdir:
+                make_dir(rootfd, cloneroot, entry)
+            else:
+                make_endpoint(rootfd, entry)
+                if not lazy:
+                    make_fifos(rootfd, cloneroot, entry)
+            if lazy:
+                st = os.stat(entry.relpath, dir_fd=rootfd, follow_symlinks=False)
+                dirs[entry.relpath] = (st.st_ino, st.st_uid)
+    finally:
+        os.close(rootfd)
+    return dirs
+
+# Give the tree's root the original fsroot perms. This goes
+# last, so that nothing made underneath changes its times.
+def claim_tree(cloneroot: str, entries: List[TemplateEntry]) -> None:
+    rootfd = os.open(cloneroot, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        apply_stat(rootfd, ".", cloneroot, entries[0], entries[0].mode)
+    finally:
+        os.close(rootfd)
@@ -0,0 +1,159 @@
+# Pool of ready-made clone trees.
+
+# Every ATTACH needs its own copy of the template tree
+# under /srv/N. Rather than cloning on the ATTACH path,
+# we keep a few trees built ahead of time for each
+# template somebody attaches to, and refill them in the
+# background. Claiming a tree is then a matter of handing
+# its root over (see claim_tree) and registering its qids,
+# however large the template happens to be.
+#
+# Trees are built from whatever manifest was current at
+# the time, so a change to the template shows up once the
+# trees built before it have been claimed.
+
+import asyncio
+import heapq
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from srpc.fs.dat import TemplateEntry
+from srpc.fs.template import TreeDirs, claim_tree, make_tree, manifest_for
+from srpc.nine.dat import Error, RPCException
+
+SRVDIR = "/srv/"
+
+# How many trees to keep on hand per template, by default
+TREEPOOLSIZE = 2
+
+# Trees are built on threads of their own rather than the
+# loop's default executor, which the application may well be
+# sharing (aiofiles, for one, opens files there, and opening
+# an endpoint's pipe can block until a client shows up)
+TREE_BUILDERS = 2
+
+def tree_path(index: int) -> str:
+    return f"{SRVDIR}{index}/"
+
+# Hands out the N in /srv/N: the lowest one free, so
+# that indices get reused as trees are removed rather
+# than probing further and further up for an unused one
+class TreeIndex:
+    def __init__(self) -> None:
+        self._next = 1
+        self._free: List[int] = []
+        self._taken: Optional[Set[int]] = None
+
+    def allocate(self) -> int:
+        # Whatever a previous server left in /srv is
+        # off limits; find out what that is just once
+        if self._taken is None:
+            self._taken = set()
+            try:
+                self._taken.update(int(name) for name in os.listdir(SRVDIR) if name.isdigit())
+            except FileNotFoundError:
+                pass
+
+        while True:
+            if self._free:
+                index = heapq.heappop(self._free)
+            else:
+                index = self._next
+                self._next += 1
+            if index not in self._taken:
+                return index
+
+    def free(self, index: int) -> None:
+        heapq.heappush(self._free, index)
+
+indices = TreeIndex()
+
+# A built tree, ready for claiming, what it was built from,
+# and what make_tree made of it
+Tree = Tuple[str, List[TemplateEntry], TreeDirs]
+
+class TreePool:
+    def __init__(self) -> None:
+        self._size = TREEPOOLSIZE
+        self._lazy = False
+        self._idle: Dict[str, List[Tree]] = {}
+        self._refill: Dict[str, asyncio.Task[None]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=TREE_BUILDERS,
+            thread_name_prefix="trees")
+
+    def configure(self, size: int = TREEPOOLSIZE, lazy: bool = False) -> None:
+        self._size = size
+        self._lazy = lazy
+
+    # Start keeping trees for fsroot, in the background
+    def start(self, fsroot: str) -> None:
+        fsroot = os.path.normpath(fsroot)
+        self._idle.setdefault(fsroot, [])
+        self._schedule_refill(fsroot)
+
+    # Take a tree for fsroot, building one on the spot if
+    # none are ready, and hand its root over to the template's
+    # owner. Returns the tree's root, its manifest and what
+    # was made of it.
+    async def claim(self, fsroot: str) -> Tree:
+        fsroot = os.path.normpath(fsroot)
+        idle = self._idle.setdefault(fsroot, [])
+        if idle:
+            tree = idle.pop()
+        else:
+            tree = await self._build(fsroot)
+        self._schedule_refill(fsroot)
+
+        cloneroot, entries, _ = tree
+        try:
+            claim_tree(cloneroot, entries)
+        except OSError:
+            self.discard(cloneroot)
+            raise
+        return tree
+
+    # Remove a tree altogether, claimed or not
+    def discard(self, cloneroot: str) -> None:
+        shutil.rmtree(cloneroot, ignore_errors=True)
+        indices.free(int(os.path.basename(cloneroot.rstrip("/"))))
+
+    async def _build(self, fsroot: str) -> Tree:
+        cloneroot = tree_path(indices.allocate())
+        try:
+            loop = asyncio.get_running_loop()
+            entries, dirs = await loop.run_in_executor(
+                self._executor, self._make, fsroot, cloneroot)
+        except OSError as ex:
+            self.discard(cloneroot)
+            raise RPCException(Error.EBADPATH) from ex
+        return cloneroot, entries, dirs
+
+    def _make(self, fsroot: str, cloneroot: str) -> Tuple[List[TemplateEntry], TreeDirs]:
+        entries = manifest_for(fsroot)
+        return entries, make_tree(cloneroot, entries, self._lazy)
+
+    def _schedule_refill(self, fsroot: str) -> None:
+        task = self._refill.get(fsroot)
+        if task is None or task.done():
+            self._refill[fsroot] = asyncio.get_running_loop().create_task(self._do_refill(fsroot))
+
+    async def _do_refill(self, fsroot: str) -> None:
+        idle = self._idle[fsroot]
+        while len(idle) < self._size:
+            try:
+                idle.append(await self._build(fsroot))
+            except RPCException:
+                # Nothing there to clone; ATTACHes will say so
+                return
+
+    # Remove whatever trees are sitting unclaimed
+    def stop(self) -> None:
+        for task in self._refill.values():
+            task.cancel()
+        self._refill.clear()
+        for idle in self._idle.values():
+            for cloneroot, _, _ in idle:
+                self.discard(cloneroot)
+            idle.clear()
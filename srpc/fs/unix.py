@@ -1,38 +1,567 @@
 # named pipe management, at the lowest level.
-# Responsible for cloning the template filesystem
-# when needed, and orchestrating asynchronous
+# Responsible for orchestrating asynchronous
 # writes and reads to the server application itself.
 
+# Every endpoint is a pair of FIFOs: we write requests
+# into recv, and read the application's answers out of
+# send. Rather than opening both for every
+# APPEND (and waiting for the application to rendezvous
+# with us each time), a Pipe keeps both ends open for as
+# long as it can and hands them to the event loop as
+# non-blocking pipe transports.
+#
+# We hold send open read/write, so the application may
+# open and close its end as it pleases without us ever
+# seeing EOF there. recv is held write-only: once the
+# application closes its reading end the transport
+# notices, even between writes, and the application is
+# taken to have gone away. Whatever it still owed us
+# fails, once what it did answer has been read, and the
+# next APPEND opens both afresh.
+#
+# Endpoints normally speak framed pipes (see FramedPipe
+# and lib/endpoint.py): every message, both ways, is a
+# PIPE_HEADER, then length bytes of payload, taken as is.
+# The header carries an id, picked by us per request and
+# echoed back with the reply, so that any number of
+# APPENDs may be in flight on an endpoint at once, and
+# be answered in any order. A streamed APPEND (SAPPEND)
+# goes over the same pipe as a run of chunks under one
+# id, each way, paced by the receiving end (see Stream).
+# The application may also speak up unasked, with a
+# P_NOTIFY, which goes to every Subscription to the pipe.
+# Large payloads may go around the pipe altogether,
+# through shared memory, should the application offer
+# it (see fs/shm.py).
+#
+# A plain Pipe is for applications that still speak one
+# line each way. Lines can only be matched to requests
+# by order, so it takes one APPEND at a time, and can't
+# carry a newline in either direction.
+
+import asyncio
+import errno
+import io
 import stat
 import os
+import struct
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Set, Tuple
+
+from srpc.fs.shm import SHM_REF, SHM_THRESHOLD, Shm, open_shm
+from srpc.nine.codec import MSIZE
+from srpc.nine.dat import Error, RPCException
 
-import aiofiles
+# How long to wait for the application to open
+# recv for reading before giving up on an APPEND
+OPEN_TIMEOUT = 5.0
+OPEN_BACKOFF_MAX = 0.1
 
+# Framed pipes: request id, kind, payload length
+PIPE_HEADER = struct.Struct("!QBI")
 
-from srpc.nine.dat import Error, RPCException
+# Kinds of pipe message
+P_CALL = 0      # us -> application: an APPEND's data
+P_REPLY = 1     # application -> us: the answer to the call of the same id
+P_ERROR = 2     # application -> us: the call of the same id failed
+P_CHUNK = 3     # either way: the next piece of a streamed call, or of its reply
+P_EOF = 4       # either way: the end of a streamed call, or of its reply
+P_MORE = 5      # either way: ready for the next P_CHUNK of the same id
+P_CLOSE = 6     # us -> application: drop whatever is left of the call, streamed or not
+                # application -> us: dropped it, as asked
+P_NOTIFY = 7    # application -> us: a notification for subscribers, of no id
+P_SHMCALL = 8   # us -> application: P_CALL, with the data in recv.shm at SHM_REF
+P_SHMREPLY = 9  # application -> us: P_REPLY, with the data in send.shm at SHM_REF
+P_FREE = 10     # us -> application: done with the P_SHMREPLY at SHM_REF
+
+# What the application may send us
+REPLY_KINDS = (P_REPLY, P_ERROR, P_CHUNK, P_EOF, P_MORE, P_NOTIFY, P_SHMREPLY, P_CLOSE)
+
+# How many notifications a subscriber may fall behind by
+# before the oldest start to go
+NOTIFY_BACKLOG = 1024
+
+# recv's transport protocol, telling the pipe once the
+# application has let go of its end
+class RecvProtocol(asyncio.streams.FlowControlMixin):
+    def __init__(self, lost: Callable[[], None]) -> None:
+        super().__init__()
+        self._lost = lost
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        super().connection_lost(exc)
+        self._lost()
+
+class Pipe:
+    def __init__(self, qiddir: str) -> None:
+        self._recv = os.path.join(qiddir, "recv")
+        self._send = os.path.join(qiddir, "send")
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._reader_transport: Optional[asyncio.ReadTransport] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # One request at a time: answers are matched
+        # to requests purely by order
+        self._lock = asyncio.Lock()
+        # Answers still to come to calls given up on (see
+        # FLUSH in nine/dat.py), to be skipped when they do
+        self._stale = 0
+
+    async def call(self, data: bytes) -> bytes:
+        if b"\n" in data:
+            raise RPCException(Error.EILLEGAL)
+
+        async with self._lock:
+            writer = await self._open_writer()
+            reader = await self._open_reader()
+
+            try:
+                writer.write(data + b"\n")
+            except OSError as ex:
+                self._close_writer()
+                raise RPCException(Error.EOPENWRF) from ex
+
+            # The line is on its way, so from here on, its
+            # answer is owed whether we wait for it or not
+            self._stale += 1
+            try:
+                await writer.drain()
+            except OSError as ex:
+                self._stale -= 1
+                self._close_writer()
+                raise RPCException(Error.EOPENWRF) from ex
+
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self._stale -= 1
+                    if not self._stale:
+                        return line
+            except (OSError, ValueError) as ex:
+                self._close_reader()
+                raise RPCException(Error.EOPENRDF) from ex
+            self._close_reader()
+            raise RPCException(Error.EOPENRDF)
+
+    # Lines can't be streamed, nor told from notifications;
+    # see FramedPipe
+    def stream(self) -> "Stream":
+        raise RPCException(Error.EUNIMPLM)
+
+    async def subscribe(self) -> "Subscription":
+        raise RPCException(Error.EUNIMPLM)
+
+    def close(self) -> None:
+        self._close_writer()
+        self._close_reader()
+
+    async def _open_writer(self) -> asyncio.StreamWriter:
+        if self._writer is not None and not self._writer.is_closing():
+            return self._writer
+
+        # Opening a FIFO for writing without blocking only works
+        # once somebody has it open for reading, so give the
+        # application a little while to show up
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + OPEN_TIMEOUT
+        backoff = 0.001
+        while True:
+            try:
+                fd = os.open(self._recv, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as ex:
+                if ex.errno != errno.ENXIO or loop.time() >= deadline:
+                    raise RPCException(Error.EOPENWRF) from ex
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, OPEN_BACKOFF_MAX)
+
+        writer: Optional[asyncio.StreamWriter] = None
+
+        def lost() -> None:
+            # Unless we let go first
+            if writer is not None and writer is self._writer:
+                self._recv_lost()
+
+        pipe = self._fifo(fd, 'w')
+        transport, protocol = await loop.connect_write_pipe(lambda: RecvProtocol(lost), pipe)
+        writer = self._writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        return writer
+
+    # The application is gone. Stop reading send, so that
+    # whoever is waiting on it sees EOF once they have had
+    # what was read already.
+    def _recv_lost(self) -> None:
+        self._writer = None
+        if self._reader_transport is not None:
+            self._reader_transport.close()
+            self._reader_transport = None
+        self._reader = None
+
+    async def _open_reader(self) -> asyncio.StreamReader:
+        if self._reader is not None and not self._reader.at_eof():
+            return self._reader
+
+        self._close_reader()
+        try:
+            fd = os.open(self._send, os.O_RDWR | os.O_NONBLOCK)
+        except OSError as ex:
+            raise RPCException(Error.EOPENRDF) from ex
+
+        pipe = self._fifo(fd, 'r')
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=MSIZE, loop=loop)
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader, loop=loop), pipe)
+        self._reader = reader
+        self._reader_transport = transport
+        return self._reader
+
+    @staticmethod
+    def _fifo(fd: int, mode: str) -> io.FileIO:
+        if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+            os.close(fd)
+            raise RPCException(Error.EBADPATH)
+        return io.FileIO(fd, mode)
+
+    def _close_writer(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _close_reader(self) -> None:
+        # Whoever owed us answers is gone
+        self._stale = 0
+        if self._reader_transport is not None:
+            self._reader_transport.close()
+            self._reader_transport = None
+        self._reader = None
 
-async def write_pipe(path: str, data: str) -> None:
-    if not stat.S_ISFIFO(os.stat(path).st_mode):
-        raise RPCException(Error.EBADPATH)
-    done = False
-    try:
-        # This is going to break because the pipe isn't
-        # seekable. After the write succeeds, gtfo accordingly
-        async with aiofiles.open(path, 'a') as f:
-            await f.write(data + "\n")
-            done = True
-    except OSError as ex:
-        if done:
+# A pipe carrying framed messages. Calls go out as they
+# come, and a single task reads replies off send, handing
+# each to whichever call (or stream) has its id.
+class FramedPipe(Pipe):
+    def __init__(self, qiddir: str) -> None:
+        super().__init__(qiddir)
+        self._nextid = 1
+        self._pending: Dict[int, asyncio.Future[bytes]] = {}
+        self._streams: Dict[int, Stream] = {}
+        self._subscriptions: Set[Subscription] = set()
+        self._replies: Optional[asyncio.Task[None]] = None
+        # The application's shared memory, if it offers any:
+        # recv.shm for us to write arguments into, send.shm
+        # for it to write answers into
+        self._shmcalls: Optional[Shm] = None
+        self._shmreplies: Optional[Shm] = None
+        # Arguments in recv.shm, by call, which the application
+        # may be reading until it answers, or drops, the call
+        self._held: Dict[int, Tuple[Shm, bytes]] = {}
+
+    async def call(self, data: bytes) -> bytes:
+        callid = self._newid()
+        reply: asyncio.Future[bytes] = asyncio.get_running_loop().create_future()
+        self._pending[callid] = reply
+        shm = self._shm_for(data)
+        ref = shm.write(data) if shm is not None else None
+        if shm is not None and ref is not None:
+            self._held[callid] = (shm, ref)
+        try:
+            try:
+                if ref is not None:
+                    await self.send(callid, P_SHMCALL, ref)
+                else:
+                    await self.send(callid, P_CALL, data)
+            except RPCException:
+                self._unhold(callid)
+                raise
+            return await reply
+        except asyncio.CancelledError:
+            # Given up on; the application may as well too.
+            # Any argument in recv.shm stays put until it has.
+            if not self.post(callid, P_CLOSE):
+                self._unhold(callid)
+            raise
+        finally:
+            self._pending.pop(callid, None)
+
+    def _unhold(self, callid: int) -> None:
+        held = self._held.pop(callid, None)
+        if held is not None:
+            shm, ref = held
+            shm.free(ref)
+
+    # Where data should go instead of the pipe, if anywhere
+    def _shm_for(self, data: bytes) -> Optional[Shm]:
+        if len(data) < SHM_THRESHOLD:
+            return None
+        if self._shmcalls is not None and self._shmcalls.stale():
+            self._shmcalls.close()
+            self._shmcalls = None
+        if self._shmcalls is None:
+            self._shmcalls = open_shm(self._recv + ".shm", True)
+        return self._shmcalls
+
+    # An answer the application left in send.shm, copied
+    # out. The file may have grown, or been made anew,
+    # since we last mapped it.
+    def _shm_reply(self, ref: bytes) -> bytes:
+        for fresh in (False, True):
+            if fresh or self._shmreplies is None or self._shmreplies.stale():
+                if self._shmreplies is not None:
+                    self._shmreplies.close()
+                self._shmreplies = open_shm(self._send + ".shm", False)
+            if self._shmreplies is None:
+                break
+            try:
+                with self._shmreplies.view(ref) as view:
+                    return bytes(view)
+            except ValueError:
+                continue
+        raise RPCException(Error.EAPPFAIL)
+
+    def stream(self) -> "Stream":
+        callid = self._newid()
+        self._streams[callid] = Stream(self, callid)
+        return self._streams[callid]
+
+    def forget(self, callid: int) -> None:
+        self._streams.pop(callid, None)
+
+    # Hear every notification from here on. Notifications
+    # are read off send with the replies, so nothing needs
+    # to have been called yet; recv is opened all the same,
+    # as that is how we tell that the application has gone
+    # away, and the subscription with it.
+    async def subscribe(self) -> "Subscription":
+        async with self._lock:
+            await self._open_writer()
+            await self._start_replies()
+        subscription = Subscription(self)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: "Subscription") -> None:
+        self._subscriptions.discard(subscription)
+
+    # Calls and streams start in the order their ids are
+    # handed out (the lock being fair), which lib/endpoint.py
+    # relies on to tell stale chunks from new streams
+    def _newid(self) -> int:
+        callid = self._nextid
+        self._nextid += 1
+        return callid
+
+    async def send(self, callid: int, kind: int, data: bytes) -> None:
+        async with self._lock:
+            writer = await self._open_writer()
+            await self._start_replies()
+
+        try:
+            # No await in between, so frames never interleave
+            writer.write(PIPE_HEADER.pack(callid, kind, len(data)))
+            writer.write(data)
+            await writer.drain()
+        except OSError as ex:
+            self._close_writer()
+            raise RPCException(Error.EOPENWRF) from ex
+
+    # send(), for a short frame that can't wait, e.g. from
+    # a clunk. Dropped (returning False) if there's nobody
+    # to send it to.
+    def post(self, callid: int, kind: int, data: bytes = b"") -> bool:
+        if self._writer is None or self._writer.is_closing():
+            return False
+        self._writer.write(PIPE_HEADER.pack(callid, kind, len(data)) + data)
+        return True
+
+    async def _start_replies(self) -> None:
+        if self._replies is not None and not self._replies.done():
             return
-        print("i am ded not big surprise")
-        raise RPCException(Error.EOPENWRF) from ex
-
-async def read_pipe(path: str) -> str:
-    if not stat.S_ISFIFO(os.stat(path).st_mode):
-        raise RPCException(Error.EBADPATH)
-    try:
-        async with aiofiles.open(path, 'r') as f:
-            data = await f.readline()
-        return data
-    except OSError as ex:
-        raise RPCException(Error.EOPENRDF) from ex
+        reader = await self._open_reader()
+        self._replies = asyncio.get_running_loop().create_task(self._read_replies(reader))
+
+    async def _read_replies(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                header = await reader.readexactly(PIPE_HEADER.size)
+                callid, kind, length = PIPE_HEADER.unpack(header)
+                if kind not in REPLY_KINDS or length > MSIZE:
+                    print("9: garbled reply on pipe", self._send)
+                    break
+                payload = await reader.readexactly(length)
+                if kind == P_NOTIFY:
+                    for subscription in self._subscriptions:
+                        subscription.deliver(payload)
+                    continue
+                stream = self._streams.get(callid)
+                if stream is not None:
+                    stream.deliver(kind, payload)
+                    continue
+                if kind in (P_REPLY, P_ERROR, P_SHMREPLY, P_CLOSE):
+                    # The application is done with the argument
+                    self._unhold(callid)
+                if kind == P_CLOSE:
+                    continue
+                reply = self._pending.get(callid)
+                if kind == P_SHMREPLY:
+                    if len(payload) != SHM_REF.size:
+                        print("9: garbled reply on pipe", self._send)
+                        break
+                    if reply is not None and not reply.done():
+                        try:
+                            reply.set_result(self._shm_reply(payload))
+                        except RPCException as ex:
+                            reply.set_exception(ex)
+                    # Copied out (or unwanted) either way
+                    self.post(callid, P_FREE, payload)
+                    continue
+                if reply is None or reply.done():
+                    continue
+                if kind == P_ERROR:
+                    reply.set_exception(RPCException(Error.EAPPFAIL))
+                elif kind == P_REPLY:
+                    reply.set_result(payload)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        self._close_reader()
+        self._fail_pending()
+
+    def _fail_pending(self) -> None:
+        for reply in self._pending.values():
+            if not reply.done():
+                reply.set_exception(RPCException(Error.EOPENRDF))
+        for stream in self._streams.values():
+            stream.fail(Error.EOPENRDF)
+        for subscription in self._subscriptions:
+            subscription.fail(Error.EOPENRDF)
+        # Nobody left reading any of it
+        for callid in list(self._held):
+            self._unhold(callid)
+
+    def close(self) -> None:
+        if self._replies is not None:
+            self._replies.cancel()
+            self._replies = None
+        self._fail_pending()
+        for shm in (self._shmcalls, self._shmreplies):
+            if shm is not None:
+                shm.close()
+        self._shmcalls = self._shmreplies = None
+        super().close()
+
+# A streamed call on a FramedPipe (see SAPPEND in nine/dat.py).
+# Its argument goes out as P_CHUNKs then a P_EOF, and its
+# reply comes back the same way. Neither side sends a P_CHUNK
+# until the other has asked for one with P_MORE, bar the
+# first of the argument, so however long the call runs, at
+# most a chunk each way is ever held on its behalf.
+class Stream:
+    def __init__(self, pipe: FramedPipe, callid: int) -> None:
+        self._pipe = pipe
+        self._callid = callid
+        # The application has room for a chunk up front
+        self._credit = asyncio.Semaphore(1)
+        self._replies: asyncio.Queue[Tuple[int, bytes]] = asyncio.Queue()
+        self._error: Optional[Error] = None
+        # Whether the argument, and the reply, are over
+        self.sent = False
+        self.done = False
+
+    async def write(self, data: bytes) -> None:
+        if self.sent:
+            raise RPCException(Error.EILLEGAL)
+        await self._credit.acquire()
+        if self._error is not None:
+            raise RPCException(self._error)
+        await self._pipe.send(self._callid, P_CHUNK, data)
+
+    async def end(self) -> None:
+        if self.sent:
+            raise RPCException(Error.EILLEGAL)
+        self.sent = True
+        await self._pipe.send(self._callid, P_EOF, b"")
+
+    # The next chunk of the reply, and whether it was the last
+    async def read(self) -> Tuple[bytes, bool]:
+        if self.done:
+            return b"", True
+        if self._error is None:
+            await self._pipe.send(self._callid, P_MORE, b"")
+        kind, data = await self._replies.get()
+        if kind == P_CHUNK:
+            return data, False
+        self.done = True
+        if kind == P_EOF:
+            return b"", True
+        assert self._error is not None
+        raise RPCException(self._error)
+
+    # Let go of the call, telling the application to stop
+    # working on it if it hasn't finished yet, and failing
+    # whatever is still waiting on it
+    def close(self) -> None:
+        self._pipe.forget(self._callid)
+        if not self.done and self._error is None:
+            self._pipe.post(self._callid, P_CLOSE)
+        self.done = True
+        self.fail(Error.EILLEGAL)
+
+    def deliver(self, kind: int, data: bytes) -> None:
+        if kind == P_MORE:
+            self._credit.release()
+        elif kind == P_ERROR:
+            self.fail(Error.EAPPFAIL)
+        elif kind in (P_CHUNK, P_EOF):
+            self._replies.put_nowait((kind, data))
+
+    def fail(self, err: Error) -> None:
+        if self._error is not None:
+            return
+        self._error = err
+        # Wake up whoever is waiting on the application
+        self._credit.release()
+        self._replies.put_nowait((P_ERROR, b""))
+
+# Notifications from the application, as one subscriber
+# hears them. Each has a backlog of its own, so that one
+# falling behind holds up nobody else, least of all the
+# task reading the pipe; past NOTIFY_BACKLOG the oldest
+# are dropped, and counted against the next handed out.
+class Subscription:
+    def __init__(self, pipe: FramedPipe) -> None:
+        self._pipe = pipe
+        # Each notification, with how many were dropped before it
+        self._backlog: Deque[Tuple[bytes, int]] = deque()
+        self._ready = asyncio.Event()
+        self._error: Optional[Error] = None
+        self._closed = False
+
+    def deliver(self, data: bytes) -> None:
+        self._backlog.append((data, 0))
+        if len(self._backlog) > NOTIFY_BACKLOG:
+            _, missed = self._backlog.popleft()
+            nextdata, nextmissed = self._backlog[0]
+            self._backlog[0] = (nextdata, nextmissed + missed + 1)
+        self._ready.set()
+
+    # The next notification and how many went missing just
+    # before it, or None once the subscription is closed
+    async def next(self) -> Optional[Tuple[bytes, int]]:
+        while not self._backlog or self._closed:
+            if self._closed:
+                return None
+            if self._error is not None:
+                raise RPCException(self._error)
+            self._ready.clear()
+            await self._ready.wait()
+        return self._backlog.popleft()
+
+    def fail(self, err: Error) -> None:
+        self._error = err
+        self._ready.set()
+
+    def close(self) -> None:
+        self._pipe.unsubscribe(self)
+        self._closed = True
+        self._backlog.clear()
+        self._ready.set()
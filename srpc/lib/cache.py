@@ -0,0 +1,95 @@
+# Client side cache of walks and stats.
+
+# Resolving the same deep paths and listing the same
+# directories over and over costs a round trip each
+# time. Every qid the server hands out comes with a
+# version though (see nine/dat.py), so we can hang on
+# to what we've learned about a qid until we hear of
+# a version other than the one we learned it at:
+#
+# - which qid each name in a directory walks to, and
+# - what a STAT of each qid returned.
+#
+# Versions arrive with every WALK and STAT response
+# that passes through Client, so whatever is cached
+# goes stale no later than the next time the qid is
+# walked through. A cached STAT is taken as is for ttl
+# seconds; after that Client checks back with a STAT
+# naming its version, which costs a round trip but
+# brings the children back only if they did change.
+# invalidate() drops everything outright.
+
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from srpc.nine.dat import StatResponse
+
+# How long a cached STAT goes unquestioned, by default
+STAT_TTL = 1.0
+
+class WalkCache:
+    def __init__(self, ttl: float = STAT_TTL) -> None:
+        self.ttl = ttl
+        # The latest version seen of each qid
+        self._versions: Dict[int, int] = {}
+        # (directory qid, name) -> qid, and the names
+        # cached per directory, to drop them in one go
+        self._walks: Dict[Tuple[int, str], int] = {}
+        self._names: Dict[int, Set[str]] = {}
+        self._stats: Dict[int, StatResponse] = {}
+        # When each STAT was last known to hold
+        self._checked: Dict[int, float] = {}
+
+    # Note the version of a qid, dropping whatever was
+    # cached about it under some other version
+    def observe(self, qid: int, version: int) -> None:
+        if self._versions.get(qid) == version:
+            return
+        self._versions[qid] = version
+        self._stats.pop(qid, None)
+        self._checked.pop(qid, None)
+        for wname in self._names.pop(qid, set()):
+            self._walks.pop((qid, wname), None)
+
+    # Record a walk from fromqid. ".." is left out, being
+    # answerable only by whoever knows where the root is.
+    def walked(self, fromqid: int, wnames: List[str], qids: List[int],
+            versions: List[int]) -> None:
+        for wname, qid, version in zip(wnames, qids, versions):
+            self.observe(qid, version)
+            if wname != "..":
+                self._walks[(fromqid, wname)] = qid
+                self._names.setdefault(fromqid, set()).add(wname)
+            fromqid = qid
+
+    # The qids a walk from fromqid would return, if every
+    # step of it is known
+    def lookup(self, fromqid: int, wnames: List[str]) -> Optional[List[int]]:
+        qids: List[int] = []
+        for wname in wnames:
+            try:
+                fromqid = self._walks[(fromqid, wname)]
+            except KeyError:
+                return None
+            qids.append(fromqid)
+        return qids
+
+    def statted(self, stat: StatResponse) -> None:
+        self.observe(stat.qid, stat.version)
+        self._stats[stat.qid] = stat
+        self._checked[stat.qid] = time.monotonic()
+
+    def stat(self, qid: int) -> Optional[StatResponse]:
+        return self._stats.get(qid)
+
+    # Is the cached STAT of qid recent enough to go by?
+    def fresh(self, qid: int) -> bool:
+        checked = self._checked.get(qid)
+        return checked is not None and time.monotonic() - checked < self.ttl
+
+    def invalidate(self) -> None:
+        self._versions.clear()
+        self._walks.clear()
+        self._names.clear()
+        self._stats.clear()
+        self._checked.clear()
@@ -1,42 +1,121 @@
 import asyncio
 import logging
-import json
-from typing import Optional, Dict, Type, TypeVar
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional, Dict, List, Set, Type, \
+    NamedTuple, Union
 from types import TracebackType
 
-from srpc.srv.dat import Message, SSLContextBuilder, encode_message, decode_message
+from srpc.lib.cache import STAT_TTL, WalkCache
+from srpc.srv.dat import FrameReader, FrameWriter, Message, SSLContextBuilder
+from srpc.nine.codec import Body, Codec, CODECS, JSON, MSIZE, VERSION_BINARY
 from srpc.nine.dat import MessageType, AuthRequest, AuthResponse, AttachRequest, AttachResponse, \
     WalkRequest, WalkResponse, StatRequest, StatResponse, AppendRequest, AppendResponse, \
-    ClunkRequest, ClunkResponse, RPCException, Error
+    ClunkRequest, ClunkResponse, VersionRequest, VersionResponse, ErrorResponse, \
+    CompoundRequest, CompoundResponse, CompoundException, ReaddirRequest, ReaddirResponse, \
+    SappendRequest, SappendResponse, SreadRequest, SreadResponse, STREAM_CHUNK, \
+    SubscribeRequest, NotifyResponse, FlushRequest, CURFID, \
+    RPCException, Error
 
 LOGGER = logging.getLogger(__name__)
 
-ResponseMessage = TypeVar("ResponseMessage")
+# How many names listdir asks for at a time, by default
+READDIR_COUNT = 256
 
 class Client:
-    def __init__(self, certfile: str, hostname: str, port: int):
+    # version names the body codec we would like to speak; see
+    # nine/codec.py. If the server doesn't know it we fall back
+    # to json, which every server understands.
+    # With cache set, STATs are answered from what earlier
+    # ones returned for as long as the qid's version holds,
+    # checking back after cachettl seconds (see lib/cache.py).
+    # Batches go around the cache, though what their walks
+    # and clunks do to fids is kept track of all the same.
+    def __init__(
+        self,
+        certfile: str,
+        hostname: str,
+        port: int,
+        version: str = VERSION_BINARY,
+        cache: bool = False,
+        cachettl: float = STAT_TTL
+    ):
         ssl_context_builder = SSLContextBuilder(certfile)
         self._ssl_context = ssl_context_builder.build_client()
-        self._reader: Optional[asyncio.StreamReader] = None
+        self._reader: Optional[FrameReader] = None
         self._writer: Optional[asyncio.StreamWriter] = None
+        self._frames: Optional[FrameWriter] = None
         self._hostname = hostname
         self._port = port
         self._tag = 0
-        self._tag_to_response: Dict[int, Optional[Message]] = {}
+        # Each in-flight tag owns a future which _loop resolves
+        # directly once the matching response comes off the wire.
+        self._tag_to_response: Dict[int, asyncio.Future[Message]] = {}
+        # Subscriptions get every message for their tag
+        # instead, and None should the connection go
+        self._tag_to_notes: Dict[int, asyncio.Queue[Optional[Message]]] = {}
+        # Tags given up on and FLUSHed, whose responses may
+        # yet turn up ahead of the FLUSHR, and the FLUSHes
+        self._flushed: Set[int] = set()
+        self._flushes: Set[asyncio.Task[None]] = set()
         self._loop_task: Optional[asyncio.Task[None]] = None
+        self._version = version
+        self._codec: Codec = JSON
+        self._msize = MSIZE
+        self._cache = WalkCache(cachettl) if cache else None
+        # What each fid points at, as far as the cache goes
+        self._fidqids: Dict[int, int] = {}
 
     async def setup(self) -> None:
         assert self._reader is None
         assert self._writer is None
         assert self._loop_task is None
-        self._reader, self._writer = await asyncio.open_connection(
+        reader, self._writer = await asyncio.open_connection(
             self._hostname,
             self._port,
             ssl=self._ssl_context
         )
+        self._reader = FrameReader(reader, self._msize)
+        self._frames = FrameWriter(self._writer)
         self._loop_task = asyncio.create_task(self._loop())
+        await self._negotiate()
         print(f"Connected to {self._hostname}:{self._port}")
 
+    @property
+    def version(self) -> str:
+        return self._codec.version
+
+    @property
+    def msize(self) -> int:
+        return self._msize
+
+    @property
+    def codec(self) -> Codec:
+        return self._codec
+
+    @property
+    def cache(self) -> Optional[WalkCache]:
+        return self._cache
+
+    # Settle on a codec and msize with the server. VERSION goes
+    # out as json, since nothing else has been agreed upon yet.
+    async def _negotiate(self) -> None:
+        request = VersionRequest(MSIZE, self._version)
+        response_message = await self._rpc(
+            Message(MessageType.VERSION, self._next_tag(), JSON.encode(request))
+        )
+        if response_message.message_type != MessageType.VERSIONR:
+            LOGGER.info("Server refused VERSION, staying with json")
+            return
+        response = JSON.decode(VersionResponse, response_message.data)
+        self._codec = CODECS.get(response.version, JSON)
+        self._msize = response.msize
+        assert self._reader is not None
+        self._reader.maxsize = self._msize
+
+    def _next_tag(self) -> int:
+        tag = self._tag
+        self._tag += 1
+        return tag
+
     async def __aenter__(self) -> 'Client':
         await self.setup()
         return self
@@ -46,11 +125,15 @@ class Client:
             self._writer.close()
             await self._writer.wait_closed()
             self._writer = None
+            self._frames = None
         if self._loop_task is not None:
             self._loop_task.cancel()
-            while not self._loop_task.done():
-                await asyncio.sleep(0)
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
             self._loop_task = None
+        self._fail_pending(ConnectionError("Connection closed"))
         self._reader = None
 
     async def __aexit__(
@@ -63,46 +146,199 @@ class Client:
 
     async def _rpc_wrapper(
         self,
-        request: object,
+        request: NamedTuple,
         request_message_type: MessageType,
-        response_message_cls: Type[ResponseMessage]
-    ) -> ResponseMessage:
-        tag = self._tag
-        self._tag += 1
-        request_bytes = json.dumps(request._asdict()).encode('utf-8') # type: ignore[attr-defined]
-        request_message = Message(request_message_type, tag, request_bytes)
+        response_message_cls: Type[Body]
+    ) -> Body:
+        request_bytes = self._codec.encode(request)
+        request_message = Message(request_message_type, self._next_tag(), request_bytes)
         response_message = await self._rpc(request_message)
-        data_json = json.loads(response_message.data)
         # response message types are 1 more than the request type, by convention
         if response_message.message_type == MessageType(request_message_type.value + 1):
-            return response_message_cls(**data_json)  # type: ignore
+            return self._codec.decode(response_message_cls, response_message.data)
         if response_message.message_type == MessageType.ERROR:
-            raise RPCException(Error(data_json['errno']))
+            err = self._codec.decode(ErrorResponse, response_message.data)
+            raise RPCException(Error(err.errno))
         raise ValueError("Invalid response_message from the server", response_message)
 
     async def auth(self, request: AuthRequest) -> AuthResponse:
         return await self._rpc_wrapper(request, MessageType.AUTH, AuthResponse)
 
     async def attach(self, request: AttachRequest) -> AttachResponse:
-        return await self._rpc_wrapper(request, MessageType.ATTACH, AttachResponse)
+        response = await self._rpc_wrapper(request, MessageType.ATTACH, AttachResponse)
+        if self._cache is not None:
+            self._fidqids[request.fid] = response.qid
+        return response
 
     async def walk(self, request: WalkRequest) -> WalkResponse:
-        return await self._rpc_wrapper(request, MessageType.WALK, WalkResponse)
+        response = await self._rpc_wrapper(request, MessageType.WALK, WalkResponse)
+        self.walked(request, response)
+        return response
+
+    # Note down where a walk left newfid, for lookup and stat;
+    # Batch does this for the walks that went out in a COMPOUND
+    def walked(self, request: WalkRequest, response: WalkResponse) -> None:
+        if self._cache is None or len(response.qids) != len(request.wnames):
+            return
+        fromqid = self._fidqids.get(request.fid)
+        if fromqid is not None:
+            self._cache.walked(fromqid, request.wnames, response.qids, response.versions)
+            self._fidqids[request.newfid] = response.qids[-1] if response.qids else fromqid
+
+    # The qids walking wnames from fid would return, if the
+    # cache knows them all, without asking the server
+    def lookup(self, fid: int, wnames: List[str]) -> Optional[List[int]]:
+        fromqid = self._fidqids.get(fid)
+        if self._cache is None or fromqid is None:
+            return None
+        return self._cache.lookup(fromqid, wnames)
 
     async def stat(self, request: StatRequest) -> StatResponse:
-        return await self._rpc_wrapper(request, MessageType.STAT, StatResponse)
+        qid = self._fidqids.get(request.fid)
+        if self._cache is None or qid is None:
+            return await self._rpc_wrapper(request, MessageType.STAT, StatResponse)
+
+        cached = self._cache.stat(qid)
+        if cached is not None:
+            if self._cache.fresh(qid):
+                return cached
+            if request.version == 0:
+                request = request._replace(version=cached.version)
+        response = await self._rpc_wrapper(request, MessageType.STAT, StatResponse)
+        if response.unchanged:
+            # Unless the fid has since been pointed elsewhere
+            if cached is not None and response.qid == cached.qid \
+                    and response.version == cached.version:
+                self._cache.statted(cached)
+                return cached
+            return response
+        self._cache.statted(response)
+        return response
+
+    async def readdir(self, request: ReaddirRequest) -> ReaddirResponse:
+        return await self._rpc_wrapper(request, MessageType.READDIR, ReaddirResponse)
+
+    # Every name in the directory fid points at, a page of
+    # count at a time, so that only one page is ever held
+    async def listdir(self, fid: int, count: int = READDIR_COUNT) -> AsyncIterator[str]:
+        offset = 0
+        while True:
+            response = await self.readdir(ReaddirRequest(fid, offset, count))
+            for name in response.names:
+                yield name
+            if response.eof:
+                return
+            offset = response.offset
 
     async def append(self, request: AppendRequest) -> AppendResponse:
         return await self._rpc_wrapper(request, MessageType.APPEND, AppendResponse)
 
+    async def sappend(self, request: SappendRequest) -> SappendResponse:
+        return await self._rpc_wrapper(request, MessageType.SAPPEND, SappendResponse)
+
+    async def sread(self, request: SreadRequest) -> SreadResponse:
+        return await self._rpc_wrapper(request, MessageType.SREAD, SreadResponse)
+
+    # APPEND to fid, streamed: send the argument a chunk at
+    # a time as it comes out of argument, and yield the reply
+    # a chunk at a time as the endpoint makes it, which may
+    # be before the argument is done. Only one chunk is in
+    # flight at once, either way. Leaving off before the end
+    # leaves the rest of the reply to be dropped by the next
+    # stream on fid, or its clunk.
+    async def stream(
+        self,
+        fid: int,
+        argument: Union[Iterable[bytes], AsyncIterable[bytes]]
+    ) -> AsyncIterator[bytes]:
+        chunks = stream_chunks(argument)
+        # The first SAPPEND starts the call, so the
+        # SREADs have something to go by
+        first = await anext(chunks, None)
+        await self.sappend(SappendRequest(fid, first or b"", first is None))
+        sender: Optional[asyncio.Task[None]] = None
+        if first is not None:
+            sender = asyncio.create_task(self._sappend_rest(fid, chunks))
+
+        try:
+            while True:
+                response = await self.sread(SreadRequest(fid))
+                if response.data:
+                    yield response.data
+                if response.eof:
+                    break
+        finally:
+            # The endpoint may well be done before hearing
+            # the argument out
+            if sender is not None and not sender.done():
+                sender.cancel()
+                sender = None
+        if sender is not None:
+            # Whatever went wrong sending the argument
+            await sender
+
+    async def _sappend_rest(self, fid: int, chunks: AsyncIterator[bytes]) -> None:
+        async for chunk in chunks:
+            await self.sappend(SappendRequest(fid, chunk, False))
+        await self.sappend(SappendRequest(fid, b"", True))
+
+    # Every notification from the endpoint fid points at,
+    # from now until fid is clunked or we stop listening
+    async def subscribe(self, request: SubscribeRequest) -> AsyncIterator[NotifyResponse]:
+        assert self._frames is not None
+        if self._loop_task is None or self._loop_task.done():
+            raise ConnectionError("Connection Dropped")
+        tag = self._next_tag()
+        notes: asyncio.Queue[Optional[Message]] = asyncio.Queue()
+        self._tag_to_notes[tag] = notes
+        try:
+            request_bytes = self._codec.encode(request)
+            await self._frames.send(Message(MessageType.SUBSCRIBE, tag, request_bytes))
+            while True:
+                message = await notes.get()
+                if message is None:
+                    raise ConnectionError("Connection Dropped")
+                if message.message_type == MessageType.NOTIFY:
+                    yield self._codec.decode(NotifyResponse, message.data)
+                elif message.message_type == MessageType.SUBSCRIBER:
+                    return
+                elif message.message_type == MessageType.ERROR:
+                    err = self._codec.decode(ErrorResponse, message.data)
+                    raise RPCException(Error(err.errno))
+                else:
+                    raise ValueError("Invalid response_message from the server", message)
+        except (asyncio.CancelledError, GeneratorExit):
+            self._flush(tag)
+            raise
+        finally:
+            self._tag_to_notes.pop(tag, None)
+
     async def clunk(self, request: ClunkRequest) -> ClunkResponse:
+        self.clunked(request.fid)
         return await self._rpc_wrapper(request, MessageType.CLUNK, ClunkResponse)
 
+    # Forget what fid was walked to, once it is gone
+    def clunked(self, fid: int) -> None:
+        self._fidqids.pop(fid, None)
+
+    # Queue up requests to go out together as one COMPOUND; see Batch
+    def batch(self) -> 'Batch':
+        return Batch(self)
+
+    async def compound(self, request: CompoundRequest) -> CompoundResponse:
+        return await self._rpc_wrapper(request, MessageType.COMPOUND, CompoundResponse)
+
     async def _rpc(self, message: Message) -> Message:
-        assert self._writer is not None
+        assert self._frames is not None
+        if self._loop_task is None or self._loop_task.done():
+            raise ConnectionError("Connection Dropped")
+        if len(message.data) > self._msize:
+            # The server would hang up on us over it
+            raise ValueError(f"request of {len(message.data)} bytes exceeds msize {self._msize}")
         tag = message.tag
         assert tag not in self._tag_to_response, "duplicate request id"
-        self._tag_to_response[tag] = None
+        response_future: asyncio.Future[Message] = asyncio.get_running_loop().create_future()
+        self._tag_to_response[tag] = response_future
         request_message = Message(
             message_type=message.message_type,
             tag=tag,
@@ -114,39 +350,180 @@ class Client:
             message.tag,
             message.data
         )
-        self._writer.write(encode_message(request_message))
-        await self._writer.drain()
-        while True:
-            if self._tag_to_response[tag] is not None:
-                response_message = self._tag_to_response[tag]
-                assert response_message is not None
-                del self._tag_to_response[tag]
-                assert response_message.tag == message.tag
-                LOGGER.info(
-                    "responding rpc_id(%d) tag(%d) data(%s)",
-                    message.message_type,
-                    tag,
-                    response_message.data
-                )
-                return response_message
-            await asyncio.sleep(0)
+        try:
+            await self._frames.send(request_message)
+            response_message = await response_future
+        except asyncio.CancelledError:
+            # Cancelled, or timed out by asyncio.wait_for
+            self._flush(tag)
+            raise
+        finally:
+            self._tag_to_response.pop(tag, None)
+        assert response_message.tag == message.tag
+        LOGGER.info(
+            "responding rpc_id(%d) tag(%d) data(%s)",
+            message.message_type,
+            tag,
+            response_message.data
+        )
+        return response_message
+
+    # Tell the server we're no longer waiting on tag, so that
+    # it may stop work on it. Goes out in the background, as
+    # whoever gave up on tag is on their way out.
+    def _flush(self, tag: int) -> None:
+        if self._loop_task is None or self._loop_task.done():
+            return
+        self._flushed.add(tag)
+
+        async def flush() -> None:
+            request = Message(MessageType.FLUSH, self._next_tag(),
+                self._codec.encode(FlushRequest(tag)))
+            try:
+                await self._rpc(request)
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            finally:
+                self._flushed.discard(tag)
+
+        task = asyncio.get_running_loop().create_task(flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    # Fail every outstanding call, e.g. once the connection goes away,
+    # so that nobody is left waiting on a response which won't come.
+    def _fail_pending(self, ex: Exception) -> None:
+        for response_future in self._tag_to_response.values():
+            if not response_future.done():
+                response_future.set_exception(ex)
+        self._tag_to_response.clear()
+        for notes in self._tag_to_notes.values():
+            notes.put_nowait(None)
 
     async def _loop(self) -> None:
         # Gets messages from the server and passes them to appropriate consumer
         assert self._reader is not None
         assert self._writer is not None
-        while True:
-            try:
-                message = await decode_message(self._reader)
-            except asyncio.IncompleteReadError:
-                return
-            LOGGER.debug("Received message: %s", message)
-            self._tag_to_response[message.tag] = message
-            await asyncio.sleep(0)
+        try:
+            while True:
+                message = await self._reader.read()
+                LOGGER.debug("Received message: %s", message)
+                notes = self._tag_to_notes.get(message.tag)
+                if notes is not None:
+                    notes.put_nowait(message)
+                    continue
+                if message.tag in self._flushed:
+                    continue
+                response_future = self._tag_to_response.get(message.tag)
+                if response_future is None or response_future.done():
+                    LOGGER.warning("Dropping response for unknown tag(%d)", message.tag)
+                    continue
+                response_future.set_result(message)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as ex:
+            LOGGER.debug("Connection lost: %s", ex)
+            self._fail_pending(ConnectionError("Connection Dropped"))
+        except asyncio.CancelledError:
+            self._fail_pending(ConnectionError("Connection closed"))
+            raise
 
     async def spin(self) -> None:
-        assert self._writer is not None
-        while True:
-            if self._writer.get_extra_info('socket') is None:
-                raise RuntimeError("Connection Dropped")
-            await asyncio.sleep(0)
+        assert self._loop_task is not None
+        await asyncio.shield(self._loop_task)
+        raise RuntimeError("Connection Dropped")
+
+# The chunks of a streamed argument, cut down to
+# STREAM_CHUNK where need be
+async def stream_chunks(
+    argument: Union[Iterable[bytes], AsyncIterable[bytes]]
+) -> AsyncIterator[bytes]:
+    if isinstance(argument, AsyncIterable):
+        async for chunk in argument:
+            for offset in range(0, len(chunk), STREAM_CHUNK):
+                yield chunk[offset:offset + STREAM_CHUNK]
+    else:
+        for chunk in argument:
+            for offset in range(0, len(chunk), STREAM_CHUNK):
+                yield chunk[offset:offset + STREAM_CHUNK]
+
+# Response bodies of what a Batch may hold
+BATCH_RESPONSES: Dict[MessageType, Type[NamedTuple]] = {
+    MessageType.WALKR: WalkResponse,
+    MessageType.STATR: StatResponse,
+    MessageType.READDIRR: ReaddirResponse,
+    MessageType.APPENDR: AppendResponse,
+    MessageType.CLUNKR: ClunkResponse,
+}
+
+# A run of requests sent off in a single round trip, e.g.
+#
+#   results = await client.batch() \
+#       .walk(WalkRequest(rootfid, newfid, ["sub", "rpc"])) \
+#       .append(AppendRequest(CURFID, b"args")) \
+#       .clunk(ClunkRequest(CURFID)) \
+#       .run()
+#
+# where CURFID stands for the fid the request before left
+# off with. run() returns the responses in order, or raises
+# a CompoundException holding those which came back before
+# the one that failed (or the walk that was cut short).
+class Batch:
+    def __init__(self, client: Client):
+        self._client = client
+        self._types: List[int] = []
+        self._requests: List[NamedTuple] = []
+
+    def _add(self, request_message_type: MessageType, request: NamedTuple) -> 'Batch':
+        self._types.append(request_message_type.value)
+        self._requests.append(request)
+        return self
+
+    def walk(self, request: WalkRequest) -> 'Batch':
+        return self._add(MessageType.WALK, request)
+
+    def stat(self, request: StatRequest) -> 'Batch':
+        return self._add(MessageType.STAT, request)
+
+    def readdir(self, request: ReaddirRequest) -> 'Batch':
+        return self._add(MessageType.READDIR, request)
+
+    def append(self, request: AppendRequest) -> 'Batch':
+        return self._add(MessageType.APPEND, request)
+
+    def clunk(self, request: ClunkRequest) -> 'Batch':
+        return self._add(MessageType.CLUNK, request)
+
+    async def run(self) -> List[NamedTuple]:
+        codec = self._client.codec
+        request = CompoundRequest(self._types, [codec.encode(r) for r in self._requests])
+        response = await self._client.compound(request)
+
+        results: List[NamedTuple] = []
+        for typeno, body in zip(response.types, response.bodies):
+            response_message_type = MessageType(typeno)
+            if response_message_type == MessageType.ERROR:
+                err = codec.decode(ErrorResponse, body)
+                self._settle(results)
+                raise CompoundException(Error(err.errno), results)
+            results.append(codec.decode(BATCH_RESPONSES[response_message_type], body))
+        # Short of an error, only a walk cut short stops a batch
+        if len(results) < len(self._requests):
+            self._settle(results)
+            raise CompoundException(Error.EBADPATH, results)
+        self._settle(results)
+        return results
+
+    # Tell the client what the walks and clunks that went
+    # through did to fids, as if they had gone on their own
+    def _settle(self, results: List[NamedTuple]) -> None:
+        curfid: Optional[int] = None
+        for request, result in zip(self._requests, results):
+            fid: int = request[0]
+            if fid == CURFID and curfid is not None:
+                fid = curfid
+            if isinstance(request, WalkRequest) and isinstance(result, WalkResponse):
+                self._client.walked(request._replace(fid=fid), result)
+                curfid = request.newfid
+            else:
+                if isinstance(request, ClunkRequest):
+                    self._client.clunked(fid)
+                curfid = fid
@@ -0,0 +1,313 @@
+# Serving endpoints over framed pipes.
+
+# Each APPEND to an endpoint reaches the application as
+# a message on the endpoint's recv pipe, tagged with an
+# id, and its answer has to go back on send under the
+# same id (see fs/unix.py).
+# Endpoint takes care of that: hand it a handler, and it
+# calls it for every APPEND as it comes in, with as many
+# running at once as there are APPENDs in flight.
+#
+#   async def echo(data: bytes) -> bytes:
+#       return data
+#
+#   async for linedir in srv.listen(rpcroot):
+#       if linedir is not None:
+#           serving.add(asyncio.create_task(Endpoint(linedir, "echo").serve(echo)))
+#
+# (hanging on to the task, lest it be garbage collected).
+# Should the handler raise, the APPEND fails with EAPPFAIL.
+# Should the client give up on the APPEND (see FLUSH in
+# nine/dat.py), the handler is cancelled.
+#
+# Streamed APPENDs (SAPPEND) go to streamer, which takes the
+# argument as an async iterator of chunks and yields the
+# reply a chunk at a time:
+#
+#   async def tail(argument: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+#       async for _ in argument:
+#           pass
+#       for line in open("/var/log/app.log", "rb"):
+#           yield line
+#
+# Each chunk is only asked for once the client is ready
+# for it, and the streamer waits at each yield until the
+# client reads, so a call holds on to about a chunk at a
+# time. Without a streamer, handler gets streamed calls
+# too, with the argument gathered up beforehand.
+#
+# notify() sends a notification to every client subscribed
+# to the endpoint (see SUBSCRIBE in nine/dat.py), or to
+# nobody, should there be nobody listening.
+#
+# With shmsize, large arguments and answers go through
+# shared memory of that size rather than the pipes (see
+# fs/shm.py). serve_views() then hands the handler each
+# argument as a memoryview, of the shared memory itself
+# where it came that way, to be read in place:
+#
+#   async def checksum(view: memoryview) -> bytes:
+#       return hashlib.sha256(view).digest()
+#
+#   Endpoint(linedir, "checksum", shm.SHM_SIZE).serve_views(checksum)
+#
+# Such a view is only good until the handler returns (or
+# is cancelled); copy out whatever is needed after that.
+# serve() handlers get their own bytes, as ever.
+
+import asyncio
+import io
+import os
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from srpc.fs.shm import SHM_REF, SHM_THRESHOLD, Shm, make_shm
+from srpc.fs.unix import PIPE_HEADER, P_CALL, P_CHUNK, P_CLOSE, P_EOF, P_ERROR, P_FREE, \
+    P_MORE, P_NOTIFY, P_REPLY, P_SHMCALL, P_SHMREPLY
+from srpc.nine.dat import STREAM_CHUNK
+
+Handler = Callable[[bytes], Awaitable[bytes]]
+Viewer = Callable[[memoryview], Awaitable[bytes]]
+Streamer = Callable[[AsyncIterator[bytes]], AsyncIterator[bytes]]
+
+# How often to look for the pipes of a lazily cloned
+# endpoint, which only appear once a client walks to it
+APPEAR_INTERVAL = 0.05
+
+class Endpoint:
+    # name is the endpoint's path under linedir, e.g. "sub/ping"
+    def __init__(self, linedir: str, name: str, shmsize: int = 0) -> None:
+        self._recv = os.path.join(linedir, name, "recv")
+        self._send = os.path.join(linedir, name, "send")
+        self._shmsize = shmsize
+        # recv.shm and send.shm, once offered
+        self._shmcalls: Optional[Shm] = None
+        self._shmreplies: Optional[Shm] = None
+        self._tasks: Set[asyncio.Task[None]] = set()
+        self._calls: Dict[int, asyncio.Task[None]] = {}
+        self._streams: Dict[int, StreamedCall] = {}
+        # Calls are numbered in the order they start, so
+        # a chunk of a call that has already ended (which
+        # the server sent before hearing it had) can be
+        # told from the start of a new one
+        self._lastid = 0
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._writelock = asyncio.Lock()
+
+    # Answer APPENDs until cancelled
+    async def serve(self, handler: Handler, streamer: Optional[Streamer] = None) -> None:
+        async def view(argument: memoryview) -> bytes:
+            return await handler(bytes(argument))
+        await self._serve(handler, view, streamer or gathered(handler))
+
+    # serve(), for a handler taking its argument as a memoryview
+    async def serve_views(self, viewer: Viewer, streamer: Optional[Streamer] = None) -> None:
+        async def handler(argument: bytes) -> bytes:
+            return await viewer(memoryview(argument))
+        await self._serve(handler, viewer, streamer or gathered(handler))
+
+    async def _serve(self, handler: Handler, viewer: Viewer, streamer: Streamer) -> None:
+        while not (os.path.exists(self._recv) and os.path.exists(self._send)):
+            await asyncio.sleep(APPEAR_INTERVAL)
+
+        self._offer_shm()
+        reader, reader_transport = await self._open_reader()
+        try:
+            while True:
+                header = await reader.readexactly(PIPE_HEADER.size)
+                callid, kind, length = PIPE_HEADER.unpack(header)
+                data = await reader.readexactly(length)
+                if kind == P_CALL:
+                    self._lastid = max(self._lastid, callid)
+                    self._calls[callid] = self._spawn(self._answer(handler(data), callid))
+                elif kind == P_SHMCALL:
+                    self._lastid = max(self._lastid, callid)
+                    try:
+                        if self._shmcalls is None:
+                            raise ValueError("no shared memory offered")
+                        argument = self._shmcalls.view(data)
+                    except ValueError as ex:
+                        print(f"endpoint: call {callid} not in shared memory: {ex!r}")
+                        await self._send_frame(callid, P_ERROR, b"")
+                        continue
+                    self._calls[callid] = self._spawn(
+                        self._answer(viewer(argument), callid, argument))
+                elif kind == P_FREE:
+                    if self._shmreplies is not None and len(data) == SHM_REF.size:
+                        self._shmreplies.free(data)
+                elif kind in (P_CHUNK, P_EOF):
+                    call = self._streams.get(callid)
+                    if call is None:
+                        if callid <= self._lastid:
+                            continue
+                        self._lastid = callid
+                        call = self._streams[callid] = StreamedCall()
+                        call.task = self._spawn(self._stream(streamer, callid, call))
+                    call.argument.put_nowait(data if kind == P_CHUNK else None)
+                elif kind == P_MORE:
+                    call = self._streams.get(callid)
+                    if call is not None:
+                        call.wanted.release()
+                elif kind == P_CLOSE:
+                    answer = self._calls.pop(callid, None)
+                    if answer is not None:
+                        answer.cancel()
+                        # Let the server know once the handler is
+                        # done with any argument in recv.shm
+                        answer.add_done_callback(self._closed(callid))
+                    call = self._streams.pop(callid, None)
+                    if call is not None and call.task is not None:
+                        call.task.cancel()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            reader_transport.close()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for shm in (self._shmcalls, self._shmreplies):
+                if shm is not None:
+                    shm.close()
+            self._shmcalls = self._shmreplies = None
+
+    # Lay down (or take back) our offer of shared memory.
+    # Going without is no great loss, so failing to make
+    # it is no reason not to serve.
+    def _offer_shm(self) -> None:
+        if not self._shmsize:
+            # Lest the server take a previous offer as standing
+            try:
+                os.unlink(self._recv + ".shm")
+            except OSError:
+                pass
+            return
+        try:
+            self._shmreplies = make_shm(self._send + ".shm", self._send, self._shmsize)
+            # Last, as the server takes it as the offer
+            self._shmcalls = make_shm(self._recv + ".shm", self._recv, self._shmsize)
+        except OSError as ex:
+            print(f"endpoint: going without shared memory: {ex!r}")
+
+    async def notify(self, data: bytes) -> None:
+        try:
+            await self._open_writer()
+        except OSError:
+            # The server hasn't opened send yet, so
+            # nobody can have subscribed
+            return
+        await self._send_frame(0, P_NOTIFY, data)
+
+    def _closed(self, callid: int) -> Callable[["asyncio.Task[None]"], None]:
+        def ack(_: "asyncio.Task[None]") -> None:
+            self._spawn(self._send_frame(callid, P_CLOSE, b""))
+        return ack
+
+    def _spawn(self, coro: Awaitable[None]) -> "asyncio.Task[None]":
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # Send back what call comes to, letting go of the
+    # shared memory argument was in, if any, once done
+    async def _answer(self, call: Awaitable[bytes], callid: int,
+            argument: Optional[memoryview] = None) -> None:
+        try:
+            kind, result = P_REPLY, await call
+        except Exception as ex:
+            print(f"endpoint: call {callid} failed: {ex!r}")
+            kind, result = P_ERROR, b""
+        finally:
+            self._calls.pop(callid, None)
+            if argument is not None:
+                argument.release()
+
+        ref = None
+        if kind == P_REPLY and len(result) >= SHM_THRESHOLD and self._shmreplies is not None:
+            ref = self._shmreplies.write(result)
+        if ref is not None:
+            await self._send_frame(callid, P_SHMREPLY, ref)
+        else:
+            await self._send_frame(callid, kind, result)
+
+    # Run a streamed call, sending each chunk of the
+    # reply as it is asked for
+    async def _stream(self, streamer: Streamer, callid: int, call: "StreamedCall") -> None:
+        async def argument() -> AsyncIterator[bytes]:
+            while True:
+                chunk = await call.argument.get()
+                if chunk is None:
+                    return
+                # Room for the next one
+                await self._send_frame(callid, P_MORE, b"")
+                yield chunk
+
+        try:
+            async for piece in streamer(argument()):
+                for offset in range(0, len(piece), STREAM_CHUNK):
+                    await call.wanted.acquire()
+                    await self._send_frame(callid, P_CHUNK, piece[offset:offset + STREAM_CHUNK])
+            # The end of the reply is asked for like any chunk
+            await call.wanted.acquire()
+            kind = P_EOF
+        except Exception as ex:
+            # Right away, lest the server be waiting to send more
+            print(f"endpoint: streamed call {callid} failed: {ex!r}")
+            kind = P_ERROR
+        finally:
+            self._streams.pop(callid, None)
+        await self._send_frame(callid, kind, b"")
+
+    async def _send_frame(self, callid: int, kind: int, data: bytes) -> None:
+        try:
+            writer = await self._open_writer()
+            # No await in between, so replies never interleave
+            writer.write(PIPE_HEADER.pack(callid, kind, len(data)))
+            writer.write(data)
+            await writer.drain()
+        except OSError as ex:
+            # The server has gone away, and the call with it
+            print(f"endpoint: couldn't answer call {callid}: {ex!r}")
+
+    # recv is held read/write, so that opening it doesn't
+    # block waiting for the server, nor does it ever see
+    # EOF while the server isn't holding it open
+    async def _open_reader(self) -> Tuple[asyncio.StreamReader, asyncio.BaseTransport]:
+        loop = asyncio.get_running_loop()
+        fd = os.open(self._recv, os.O_RDWR | os.O_NONBLOCK)
+        reader = asyncio.StreamReader(loop=loop)
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader, loop=loop), io.FileIO(fd, 'r'))
+        return reader, transport
+
+    # send is held write-only, for the transport to tell when
+    # the server lets go of it. The server opens its end
+    # before sending a call, so it's there by the time we
+    # have an answer.
+    async def _open_writer(self) -> asyncio.StreamWriter:
+        async with self._writelock:
+            if self._writer is not None and not self._writer.is_closing():
+                return self._writer
+            loop = asyncio.get_running_loop()
+            fd = os.open(self._send, os.O_WRONLY | os.O_NONBLOCK)
+            transport, protocol = await loop.connect_write_pipe(
+                asyncio.streams.FlowControlMixin, io.FileIO(fd, 'w'))
+            self._writer = asyncio.StreamWriter(transport, protocol, None, loop)
+            if self._shmreplies is not None:
+                # Any server that owed us a P_FREE let go of send
+                self._shmreplies.ring.reset()
+            return self._writer
+
+# A streamed call underway: its argument as it comes in
+# (None marking the end), and how many chunks of the
+# reply the server has asked for and not yet had
+class StreamedCall:
+    def __init__(self) -> None:
+        self.argument: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+        self.wanted = asyncio.Semaphore(0)
+        self.task: Optional[asyncio.Task[None]] = None
+
+# A streamer calling handler with the whole argument at once
+def gathered(handler: Handler) -> Streamer:
+    async def streamer(argument: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        yield await handler(b"".join([chunk async for chunk in argument]))
+    return streamer
@@ -5,20 +5,57 @@ import os
 import ssl
 import shutil
 
-from srpc.srv.srv import RPCServer
-from srpc.srv.dat import Con
+from srpc.fs.trees import TREEPOOLSIZE
+from srpc.nine.pool import POOLSIZE
+from srpc.srv.srv import RPCServer, MAXINFLIGHT
+from srpc.srv.dat import Con, ReapTTLs
 
 class Srv:
     def __init__(self) -> None:
         self._context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
         self._ctls: Dict[str, Con] = {}
+        self._servers: Dict[str, RPCServer] = {}
 
     # Configure the ssl context automatically, for ease of use
     async def ssl_context_helper(self, certfile: str, keyfile: str) -> None:
         self._context.load_cert_chain(certfile = certfile, keyfile = keyfile)
 
-    async def announce(self, hostname: str, port: int, rpcroot: str) -> None:
-        newcon = Con(hostname, port, self._context)
+    # maxinflight bounds how many requests each client
+    # connection may have outstanding at the server at once,
+    # and workers is how many per-user worker processes to
+    # keep started ahead of the ATTACHes that will claim them.
+    # authttl, if set, is how many seconds a successful PAM
+    # authentication is remembered for.
+    # With lazy set, each endpoint's named pipes are only
+    # made once a client first walks to it, so applications
+    # must cope with an endpoint's recv/send appearing some
+    # time after its linedir is handed out. trees is how many
+    # ready-made clone trees to keep per template attached to.
+    # reap sets how long clone trees, afids and idle workers
+    # are kept around for (see srv/reaper.py). maxpending, if
+    # set, caps how many new linedirs may wait for listen() to
+    # pick them up; past that, ATTACHes wait their turn.
+    # Endpoints speak framed pipes, carrying any bytes and
+    # taking many APPENDs at once; applications should use
+    # lib/endpoint.py to serve them. Older applications that
+    # read and write lines may clear framed, at the price of
+    # newlines in arguments and results.
+    async def announce(
+        self,
+        hostname: str,
+        port: int,
+        rpcroot: str,
+        maxinflight: int = MAXINFLIGHT,
+        workers: int = POOLSIZE,
+        authttl: float = 0.0,
+        lazy: bool = False,
+        trees: int = TREEPOOLSIZE,
+        reap: ReapTTLs = ReapTTLs(),
+        maxpending: int = 0,
+        framed: bool = True
+    ) -> None:
+        newcon = Con(hostname, port, self._context, maxinflight, workers, authttl, lazy,
+            trees, reap, maxpending, framed)
         if rpcroot in self._ctls.keys():
             raise RuntimeError("ERROR: dir already announced")
         self._ctls[rpcroot] = newcon
@@ -37,12 +74,33 @@ class Srv:
         # approach where ctls dictate the flow
         # of the connection etc.
 
+    # What the reaper has cleaned up after rpcroot's clients
+    def reaped(self, rpcroot: str) -> Dict[str, int]:
+        try:
+            return dict(self._servers[rpcroot].reaper.counters)
+        except KeyError as ex:
+            raise RuntimeError("ERROR: dir not listening") from ex
+
     async def listen(self, rpcroot: str) -> AsyncIterator[Optional[str]]:
         try:
             thiscon = self._ctls[rpcroot]
         except KeyError as ex:
             raise RuntimeError("ERROR: dir not announced") from ex
 
-        rpcserver = RPCServer(rpcroot, thiscon.hostname, thiscon.port, thiscon.ssl)
+        rpcserver = RPCServer(
+            rpcroot,
+            thiscon.hostname,
+            thiscon.port,
+            thiscon.ssl,
+            thiscon.maxinflight,
+            thiscon.workers,
+            thiscon.authttl,
+            thiscon.lazy,
+            thiscon.trees,
+            thiscon.reap,
+            thiscon.maxpending,
+            thiscon.framed
+        )
+        self._servers[rpcroot] = rpcserver
         async for linedir in rpcserver.dolisten():
             yield linedir
@@ -0,0 +1,321 @@
+# Body codecs for the message types in nine/dat.py
+
+# Every request and response is a NamedTuple, stapled
+# into a Message with its type and tag. Originally the
+# body was always a json dict, which is easy to read on
+# the wire but spends most of its bytes (and most of its
+# CPU) on field names for the small RPCs we care about.
+#
+# The binary codec lays each NamedTuple out in field
+# order with no names at all:
+#
+#   int       - 8 byte signed, network order
+#   bool      - 1 byte
+#   str       - 32 bit length, then utf-8
+#   List[int] - 32 bit count, then that many int
+#   List[str] - 32 bit count, that many 32 bit lengths,
+#               then the utf-8 of every item back to back
+#   bytes       - as str, but raw
+#   List[bytes] - as List[str], but raw
+#
+# and prefixes the whole body with a single marker byte.
+# (In json, bytes go as base64 strings.)
+# A json body always starts with '{', so whoever receives
+# a body can tell the two apart without any other context.
+# That keeps the parent and the per-user workers codec
+# agnostic: they answer in whatever codec they were asked.
+#
+# Requests on a fid lead with it, so in the binary codec
+# it sits at a fixed offset right after the marker. peek
+# reads leading int fields like that straight off the
+# front without decoding the rest, which is all the parent
+# needs in order to route a request to the right worker.
+#
+# Which codec a client uses is settled once at connect
+# time through a VERSION exchange, in the spirit of the
+# 9P Tversion/Rversion pair. VERSION itself is always json.
+
+import abc
+import base64
+import binascii
+import itertools
+import json
+import struct
+import typing
+from typing import Dict, List, Tuple, Type, TypeVar, NamedTuple
+
+VERSION_JSON = "sRPC2000.json"
+VERSION_BINARY = "sRPC2000.bin"
+
+# Largest frame either side is willing to handle,
+# unless the VERSION exchange says otherwise
+MSIZE = 1 << 24
+
+# Smallest msize a client may ask for: below this, not
+# even an error or a page of names would fit in a frame
+MIN_MSIZE = 1 << 13
+
+BINARY_MARKER = 0x01
+BINARY_PREFIX = bytes([BINARY_MARKER])
+
+Body = TypeVar("Body", bound=NamedTuple)
+
+INT = struct.Struct("!q")
+BOOL = struct.Struct("!?")
+LEN = struct.Struct("!I")
+MARKER = struct.Struct("!B")
+
+# Field kinds understood by the binary layout
+K_INT = 0
+K_BOOL = 1
+K_STR = 2
+K_STRLIST = 3
+K_INTLIST = 4
+K_BYTES = 5
+K_BYTESLIST = 6
+
+# Work out the field kinds of a NamedTuple from its annotations
+def field_kinds(cls: type) -> Tuple[int, ...]:
+    kinds: List[int] = []
+    for fieldtype in typing.get_type_hints(cls).values():
+        if fieldtype is bool:
+            kinds.append(K_BOOL)
+        elif fieldtype is int:
+            kinds.append(K_INT)
+        elif fieldtype is str:
+            kinds.append(K_STR)
+        elif fieldtype is bytes:
+            kinds.append(K_BYTES)
+        elif fieldtype == List[str]:
+            kinds.append(K_STRLIST)
+        elif fieldtype == List[int]:
+            kinds.append(K_INTLIST)
+        elif fieldtype == List[bytes]:
+            kinds.append(K_BYTESLIST)
+        else:
+            raise TypeError(f"no layout for {cls.__name__}: {fieldtype}")
+    return tuple(kinds)
+
+class Codec(abc.ABC):
+    version = ""
+
+    @abc.abstractmethod
+    def encode(self, body: NamedTuple) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    def decode(self, cls: Type[Body], data: bytes) -> Body:
+        ...
+
+    # The first count fields of a cls body, which must be ints
+    @abc.abstractmethod
+    def peek(self, cls: Type[Body], data: bytes, count: int) -> Tuple[int, ...]:
+        ...
+
+class JSONCodec(Codec):
+    version = VERSION_JSON
+
+    def __init__(self) -> None:
+        # Names of the bytes and List[bytes] fields per NamedTuple
+        self._binary: Dict[type, Tuple[Tuple[str, int], ...]] = {}
+
+    def binary_fields(self, cls: type) -> Tuple[Tuple[str, int], ...]:
+        try:
+            return self._binary[cls]
+        except KeyError:
+            pass
+        fields = getattr(cls, "_fields", ())
+        self._binary[cls] = tuple(
+            (name, kind) for name, kind in zip(fields, field_kinds(cls))
+            if kind in (K_BYTES, K_BYTESLIST)
+        )
+        return self._binary[cls]
+
+    def encode(self, body: NamedTuple) -> bytes:
+        body_dict = body._asdict()
+        for name, kind in self.binary_fields(type(body)):
+            if kind == K_BYTES:
+                body_dict[name] = base64.b64encode(body_dict[name]).decode('ascii')
+            else:
+                body_dict[name] = [base64.b64encode(item).decode('ascii')
+                    for item in body_dict[name]]
+        return json.dumps(body_dict).encode('utf-8')
+
+    def decode(self, cls: Type[Body], data: bytes) -> Body:
+        data_json = json.loads(data)
+        if not isinstance(data_json, dict):
+            raise ValueError("message body is not a json object")
+        try:
+            for name, kind in self.binary_fields(cls):
+                if kind == K_BYTES:
+                    data_json[name] = base64.b64decode(data_json[name], validate=True)
+                else:
+                    data_json[name] = [base64.b64decode(item, validate=True)
+                        for item in data_json[name]]
+        except (KeyError, TypeError, binascii.Error) as ex:
+            raise ValueError("malformed bytes in message body") from ex
+        return cls(**data_json)  # type: ignore
+
+    # No shortcuts here: json has to be parsed to find anything
+    def peek(self, cls: Type[Body], data: bytes, count: int) -> Tuple[int, ...]:
+        data_json = json.loads(data)
+        if not isinstance(data_json, dict):
+            raise ValueError("message body is not a json object")
+        try:
+            values = tuple(data_json[name] for name in cls._fields[:count])
+        except KeyError as ex:
+            raise ValueError(f"message body is missing {ex}") from ex
+        if not all(isinstance(value, int) for value in values):
+            raise ValueError("message body has a non-integer where one was expected")
+        return values
+
+class BinaryCodec(Codec):
+    version = VERSION_BINARY
+
+    def __init__(self) -> None:
+        # Field kinds per NamedTuple, worked out once from the
+        # annotations and then reused for every message
+        self._layouts: Dict[type, Tuple[int, ...]] = {}
+        # Formats for peeking at so many leading ints
+        self._peeks: Dict[int, struct.Struct] = {}
+
+    def layout(self, cls: type) -> Tuple[int, ...]:
+        try:
+            return self._layouts[cls]
+        except KeyError:
+            pass
+
+        kinds = field_kinds(cls)
+        self._layouts[cls] = tuple(kinds)
+        return self._layouts[cls]
+
+    def encode(self, body: NamedTuple) -> bytes:
+        fmt = ["!B"]
+        values: List[object] = [BINARY_MARKER]
+        for kind, value in zip(self.layout(type(body)), body):
+            if kind == K_INT:
+                fmt.append("q")
+                values.append(value)
+            elif kind == K_BOOL:
+                fmt.append("?")
+                values.append(value)
+            elif kind == K_STR:
+                assert isinstance(value, str)
+                encoded = value.encode('utf-8')
+                fmt.append(f"I{len(encoded)}s")
+                values += [len(encoded), encoded]
+            elif kind == K_BYTES:
+                assert isinstance(value, bytes)
+                fmt.append(f"I{len(value)}s")
+                values += [len(value), value]
+            elif kind == K_INTLIST:
+                assert isinstance(value, list)
+                fmt.append(f"I{len(value)}q")
+                values += [len(value), *value]
+            else:
+                assert isinstance(value, list)
+                items = value if kind == K_BYTESLIST else [item.encode('utf-8') for item in value]
+                blob = b"".join(items)
+                fmt.append(f"I{len(items)}I{len(blob)}s")
+                values += [len(items), *map(len, items), blob]
+        return struct.pack("".join(fmt), *values)
+
+    def decode(self, cls: Type[Body], data: bytes) -> Body:
+        if not data or data[0] != BINARY_MARKER:
+            raise ValueError("message body is not binary encoded")
+
+        fields: List[object] = []
+        offset = MARKER.size
+        try:
+            for kind in self.layout(cls):
+                if kind == K_INT:
+                    fields.append(INT.unpack_from(data, offset)[0])
+                    offset += INT.size
+                elif kind == K_BOOL:
+                    fields.append(BOOL.unpack_from(data, offset)[0])
+                    offset += BOOL.size
+                elif kind == K_STR:
+                    value, offset = self._decode_str(data, offset)
+                    fields.append(value)
+                elif kind == K_BYTES:
+                    length, = LEN.unpack_from(data, offset)
+                    offset += LEN.size
+                    if offset + length > len(data):
+                        raise ValueError("truncated message body")
+                    fields.append(data[offset:offset + length])
+                    offset += length
+                elif kind == K_INTLIST:
+                    count, = LEN.unpack_from(data, offset)
+                    offset += LEN.size
+                    fields.append(list(struct.unpack_from(f"!{count}q", data, offset)))
+                    offset += INT.size * count
+                else:
+                    count, = LEN.unpack_from(data, offset)
+                    offset += LEN.size
+                    lengths = struct.unpack_from(f"!{count}I", data, offset)
+                    offset += LEN.size * count
+                    ends = list(itertools.accumulate(lengths, initial=offset))
+                    offset = ends[-1]
+                    if offset > len(data):
+                        raise ValueError("truncated message body")
+                    if kind == K_BYTESLIST:
+                        fields.append([
+                            data[start:end] for start, end in zip(ends, ends[1:])
+                        ])
+                        continue
+                    # Decode the items in one go; for the (usual) ascii
+                    # case the byte offsets double as string offsets
+                    text = str(data[ends[0]:offset], 'utf-8')
+                    if len(text) == offset - ends[0]:
+                        base = ends[0]
+                        fields.append([
+                            text[start - base:end - base]
+                            for start, end in zip(ends, ends[1:])
+                        ])
+                    else:
+                        fields.append([
+                            str(data[start:end], 'utf-8')
+                            for start, end in zip(ends, ends[1:])
+                        ])
+        except struct.error as ex:
+            raise ValueError("truncated message body") from ex
+
+        if offset != len(data):
+            raise ValueError("trailing bytes in message body")
+        return cls._make(fields)
+
+    def peek(self, cls: Type[Body], data: bytes, count: int) -> Tuple[int, ...]:
+        if any(kind != K_INT for kind in self.layout(cls)[:count]):
+            raise TypeError(f"{cls.__name__} doesn't lead with {count} ints")
+        if not data or data[0] != BINARY_MARKER:
+            raise ValueError("message body is not binary encoded")
+        try:
+            fmt = self._peeks[count]
+        except KeyError:
+            fmt = self._peeks[count] = struct.Struct(f"!{count}q")
+        try:
+            return fmt.unpack_from(data, MARKER.size)
+        except struct.error as ex:
+            raise ValueError("truncated message body") from ex
+
+    @staticmethod
+    def _decode_str(data: bytes, offset: int) -> Tuple[str, int]:
+        length, = LEN.unpack_from(data, offset)
+        offset += LEN.size
+        if offset + length > len(data):
+            raise ValueError("truncated message body")
+        return data[offset:offset + length].decode('utf-8'), offset + length
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+
+CODECS: Dict[str, Codec] = {
+    VERSION_JSON: JSON,
+    VERSION_BINARY: BINARY,
+}
+
+# Work out which codec a body was encoded with
+def codec_for(data: bytes) -> Codec:
+    if data[:1] == BINARY_PREFIX:
+        return BINARY
+    return JSON
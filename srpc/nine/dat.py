@@ -12,7 +12,13 @@
 #        only desire a subset of the RPC tree
 #
 # WALK:  register a new fid which corresponds to the
-#        passed path, i.e. descend the directory tree
+#        passed path, i.e. descend the directory tree.
+#        The path goes as a list of names, one per step
+#        (".." steps back up), and the qid of every step
+#        comes back, as in 9P. Should a step other than
+#        the first fail, the walk stops there and only the
+#        qids walked so far come back, with newfid left
+#        unmade. No names at all makes newfid a copy of fid.
 #
 # STAT:  get a Stat struct which contains information
 #        about a fid, chiefly names and possibly
@@ -23,10 +29,70 @@
 #        or a list of stat structures in json form. This
 #        is used to get return values from RPCs.
 #
-# APPEND:write to a file, i.e. call an RPC.
+# Every qid has a version, which changes whenever what
+# a STAT of it would return does. WALK and STAT hand it
+# out alongside the qid, so that clients may cache what
+# they learn (see lib/cache.py) and tell when to stop.
+# A STAT naming the version the client already has is
+# answered with just that: unchanged, and no children.
+#
+# APPEND:write to a file, i.e. call an RPC. Arguments
+#        and results are bytes, taken as they are. With a
+#        timeout (in milliseconds), an application that takes
+#        longer to answer is given up on, and the APPEND
+#        fails with ETIMEOUT.
 #
 # CLUNK: Unmap a fid/qid mapping, allowing the client to
 #        reuse it for a different server file / qid.
+#
+# VERSION: agree on a maximum message size and on how
+#        message bodies are encoded (see nine/codec.py).
+#        Sent once, before anything else, and always
+#        json encoded. A response that would come to more
+#        than the agreed size fails with ETOOBIG instead.
+#
+# READDIR: list a directory a page at a time: up to nnames
+#        names, starting offset names in. The response says
+#        where the next page starts, and whether there is
+#        one. Reading on from where the last page left off
+#        carries on with the same listing; any other offset
+#        starts a fresh one.
+#
+# COMPOUND: run a list of WALK/STAT/READDIR/APPEND/CLUNK
+#        requests in order, in a single round trip, stopping
+#        at the first that fails. A leading fid of CURFID stands
+#        for the fid the previous request left off with:
+#        the newfid of a WALK, the fid of anything else.
+#        The response holds a response per request run,
+#        the last of which may be an ERROR.
+#
+# SAPPEND: APPEND, streamed, for arguments or results too
+#        big to hold at once. The argument goes out as a
+#        run of SAPPENDs on the fid, the last with eof set;
+#        each is answered once the endpoint is ready for
+#        the next. The result then comes back a chunk per
+#        SREAD, until one says eof. A SAPPEND after the
+#        argument is done starts the next call on the fid,
+#        dropping whatever is left of the last one's result.
+#
+# SUBSCRIBE: hear whatever the endpoint fid points at has
+#        to say of its own accord. Every notification the
+#        application sends comes back as a NOTIFY under the
+#        SUBSCRIBE's tag, for as long as the fid stays open;
+#        clunking it ends the subscription with a SUBSCRIBER.
+#        A subscriber that falls too far behind misses the
+#        oldest notifications, and the next NOTIFY says how
+#        many it missed.
+#
+# FLUSH: give up on the request of tag oldtag. By the time
+#        FLUSHR comes back, the old request is done with: its
+#        response either came first, or won't come at all.
+#        Requests that can be dropped part way (APPEND,
+#        SAPPEND, SREAD, SUBSCRIBE, STAT, READDIR) are cut
+#        short, along with any call to the application they
+#        were waiting on; anything else is let finish. A
+#        COMPOUND stops at the first of its requests that
+#        can be dropped, or after the one underway.
 
 # I'm using some 9P parlance here...fid refers
 # to a unique identifier chosen by the client
@@ -50,14 +116,35 @@ class MessageType(Enum):
     AUTHR = 2       # AUTHR tag (aqid)
     ATTACH = 3      # ATTACH tag (afid fid uname aname)
     ATTACHR = 4     # ATTACHR tag (qid)
-    WALK = 5        # WALK tag (fid newfid path)
-    WALKR = 6       # WALKR tag (qid)
-    STAT = 7        # STAT tag (fid)
-    STATR = 8       # STATR tag (Stat)
+    WALK = 5        # WALK tag (fid newfid wnames)
+    WALKR = 6       # WALKR tag (qids versions)
+    STAT = 7        # STAT tag (fid version)
+    STATR = 8       # STATR tag (Stat version unchanged)
     APPEND = 9      # APPEND tag (fid data...)
     APPENDR = 10    # APPENDR tag (data...)
     CLUNK = 11      # CLUNK tag (fid)
     CLUNKR = 12     # CLUNKR tag
+    VERSION = 13    # VERSION tag (msize version)
+    VERSIONR = 14   # VERSIONR tag (msize version)
+    COMPOUND = 15   # COMPOUND tag (types bodies)
+    COMPOUNDR = 16  # COMPOUNDR tag (types bodies)
+    READDIR = 17    # READDIR tag (fid offset nnames)
+    READDIRR = 18   # READDIRR tag (names offset eof version)
+    SAPPEND = 19    # SAPPEND tag (fid data eof)
+    SAPPENDR = 20   # SAPPENDR tag
+    SREAD = 21      # SREAD tag (fid)
+    SREADR = 22     # SREADR tag (data eof)
+    SUBSCRIBE = 23  # SUBSCRIBE tag (fid)
+    SUBSCRIBER = 24 # SUBSCRIBER tag
+    NOTIFY = 25     # NOTIFY tag (data missed), any number of them ahead of SUBSCRIBER
+    FLUSH = 26      # FLUSH tag (oldtag)
+    FLUSHR = 27     # FLUSHR tag
+
+    # Between the parent and the per-user workers only
+    CTLATTACH = 101  # CTLATTACH tag (fid uname aname qids fnames dirs framed)
+    CTLATTACHR = 102 # CTLATTACHR tag
+    CTLDETACH = 103  # CTLDETACH tag
+    CTLDETACHR = 104 # CTLDETACHR tag
 
 # Error messages -- work in progress
 class Error(Enum):
@@ -71,6 +158,10 @@ class Error(Enum):
     EILLEGAL = -8
     EUNIMPLM = -9
     EFESCAPE = -10
+    ECTLLOST = -11
+    EAPPFAIL = -12
+    ETIMEOUT = -13
+    ETOOBIG = -14
 
 # More classes for these types. These can
 # be json'ified and encoded generically, and
@@ -97,26 +188,83 @@ class AttachResponse(NamedTuple):
 class WalkRequest(NamedTuple):
     fid: int
     newfid: int
-    path: str
+    wnames: List[str]
 
+# versions[i] is the version of qids[i]
 class WalkResponse(NamedTuple):
-    qid: int
+    qids: List[int]
+    versions: List[int]
 
+# version, if not 0, is that of the Stat the client has
 class StatRequest(NamedTuple):
     fid: int
+    version: int = 0
 
 class StatResponse(NamedTuple):
     qid: int
     fname: str
     isdir: bool
     children: List[str]
+    version: int
+    unchanged: bool
+
+class ReaddirRequest(NamedTuple):
+    fid: int
+    offset: int
+    nnames: int
 
+# offset is where the next page starts
+class ReaddirResponse(NamedTuple):
+    names: List[str]
+    offset: int
+    eof: bool
+    version: int
+
+# timeout is in milliseconds, 0 for none
 class AppendRequest(NamedTuple):
     fid: int
-    data: str
+    data: bytes
+    timeout: int = 0
 
 class AppendResponse(NamedTuple):
-    data: str
+    data: bytes
+
+class SappendRequest(NamedTuple):
+    fid: int
+    data: bytes
+    eof: bool
+
+class SappendResponse(NamedTuple):
+    pass
+
+class SreadRequest(NamedTuple):
+    fid: int
+
+class SreadResponse(NamedTuple):
+    data: bytes
+    eof: bool
+
+# How much of a stream goes in one SAPPEND or SREAD, at
+# most, keeping well within any reasonable msize
+STREAM_CHUNK = 64 * 1024
+
+class SubscribeRequest(NamedTuple):
+    fid: int
+
+class SubscribeResponse(NamedTuple):
+    pass
+
+# missed is how many notifications were dropped just before
+# this one, the subscriber having fallen behind
+class NotifyResponse(NamedTuple):
+    data: bytes
+    missed: int
+
+class FlushRequest(NamedTuple):
+    oldtag: int
+
+class FlushResponse(NamedTuple):
+    pass
 
 class ClunkRequest(NamedTuple):
     fid: int
@@ -124,6 +272,50 @@ class ClunkRequest(NamedTuple):
 class ClunkResponse(NamedTuple):
     pass
 
+class VersionRequest(NamedTuple):
+    msize: int
+    version: str
+
+class VersionResponse(NamedTuple):
+    msize: int
+    version: str
+
+# Hand a worker the attach fid of a connection, along with
+# the qids of the tree it was cloned into: qids[i] names
+# fnames[i], and every qid in dirs is a directory. framed
+# says whether the tree's endpoints speak framed pipes.
+class CtlAttachRequest(NamedTuple):
+    fid: int
+    uname: str
+    aname: str
+    qids: List[int]
+    fnames: List[str]
+    dirs: List[int]
+    framed: bool
+
+class CtlAttachResponse(NamedTuple):
+    pass
+
+# The connection is gone, drop everything it had
+class CtlDetachRequest(NamedTuple):
+    pass
+
+class CtlDetachResponse(NamedTuple):
+    pass
+
+# types[i] is the MessageType of bodies[i], each of which is
+# encoded as it would be on its own
+class CompoundRequest(NamedTuple):
+    types: List[int]
+    bodies: List[bytes]
+
+class CompoundResponse(NamedTuple):
+    types: List[int]
+    bodies: List[bytes]
+
+# Within a COMPOUND, the fid the previous request left off with
+CURFID = -1
+
 class ErrorResponse(NamedTuple):
     errno: int
 
@@ -131,3 +323,10 @@ class RPCException(Exception):
     def __init__(self, err: Error):
         self.err = Error(err.value)
         super().__init__(f"RPC Error: {self.err}")
+
+# A COMPOUND stopped short: results holds the responses
+# of the requests which did go through, in order
+class CompoundException(RPCException):
+    def __init__(self, err: Error, results: List[NamedTuple]):
+        super().__init__(err)
+        self.results = results
@@ -4,46 +4,48 @@
 # the master server process when
 # it should fork etc.
 
-import json
-import shutil
 import asyncio
 import pwd
 import grp
 import os
-import multiprocessing
-from typing import Dict, Optional, Tuple
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Type
 
 from srpc.fs.qid import Qid
-from srpc.fs.fid import clunk_fid, FidData, mk_attach_fid, mk_walk_fid, stat_fid, write_fid
-from srpc.auth.afid import mk_auth_afid
+from srpc.fs.trees import TreePool
+from srpc.fs.fid import clunk_fid, close_cursors, close_streams, close_subscriptions, \
+    mk_attach_fid, mk_walk_fid, readdir_fid, sappend_fid, sread_fid, stat_fid, subscribe_fid, \
+    write_fid, sanitize_path
+from srpc.auth.afid import mk_auth_afid, write_afid, clunk_afid
 from srpc.auth.dat import Relays
 from srpc.auth.privs import validate_token
+from srpc.nine.codec import BINARY, CODECS, JSON, MIN_MSIZE, MSIZE, VERSION_JSON, codec_for
+from srpc.nine.pool import WorkerConn, WorkerPool
+from srpc.nine.relay import CTLDIR, RELAY_MSIZE, channel_for, decode_relayed
 from srpc.nine.dat import MessageType, AuthRequest, AuthResponse, AttachRequest, \
     AttachResponse, WalkRequest, WalkResponse, AppendRequest, AppendResponse, \
     ErrorResponse, ClunkRequest, ClunkResponse, StatRequest, StatResponse, \
-    RPCException
-from srpc.srv.dat import Message, encode_message, decode_message
+    VersionRequest, VersionResponse, CtlAttachRequest, CtlAttachResponse, \
+    CtlDetachRequest, CtlDetachResponse, CompoundRequest, CompoundResponse, CURFID, \
+    ReaddirRequest, ReaddirResponse, SappendRequest, SappendResponse, SreadRequest, \
+    SreadResponse, SubscribeRequest, SubscribeResponse, NotifyResponse, FlushRequest, \
+    FlushResponse, Error, RPCException
+from srpc.srv.dat import FrameReader, FrameWriter, Message, Routing, Running, Session
 
 async def dispatch9(
     msg: Message,
     rpcroot: str,
-    fidtable: Dict[int, FidData],
-    qid: Qid,
-    contained: bool
+    routing: Routing
 ) -> Tuple[Message, Optional[str]]:
-    data_json = json.loads(msg.data)
-    assert isinstance(data_json, dict)
+    # Answer in whichever codec the request was encoded with
+    codec = codec_for(msg.data)
 
     # Switch off between message types
     if msg.message_type == MessageType.AUTH:
-        if contained:
-            raise ValueError()
-
         print("9: auth")
         # You are allowed to derive multiple authentication
         # tokens, but if this process has already dropped privs
         # to a given user this request presently fails.
-        authreq9 = AuthRequest(**data_json)
+        authreq9 = codec.decode(AuthRequest, msg.data)
         try:
             mk_auth_afid(authreq9.afid, authreq9.uname, authreq9.aname)
         except RPCException as ex:
@@ -51,174 +53,378 @@ async def dispatch9(
 
         # So we haven't dropped privs and have a new afid. Good,
         # return this to the user for reading and writing.
-        authresp = json.dumps(AuthResponse()._asdict())
-        authresp_bytes = authresp.encode('utf-8')
+        authresp_bytes = codec.encode(AuthResponse())
         return Message(MessageType.AUTHR, msg.tag, authresp_bytes), None
 
     if msg.message_type == MessageType.ATTACH:
-        if contained:
-            raise ValueError()
-
         print("9: attach")
-        attreq9 = AttachRequest(**data_json)
+        attreq9 = codec.decode(AttachRequest, msg.data)
+        if attreq9.fid in routing.fids.keys():
+            return encode_error(msg, RPCException(Error.EREUSEFD)), None
 
         # Before anything, check to make sure that the user is allowed
-        # to make the insertion they are making.
-        cloneroot = qid.clone(rpcroot + "/" + attreq9.aname)
-        print(f"Made clone dir {cloneroot}")
+        # to make the insertion they are making, then take one of
+        # the trees kept ready for this template (see fs/trees.py).
         try:
-            attqid = mk_attach_fid(
-                attreq9.fid,
-                attreq9.uname,
-                cloneroot + "/" + attreq9.aname,
-                fidtable,
-                qid
-            )
+            validate_token(attreq9.afid, attreq9.uname, attreq9.aname)
+            cloneroot, entries, dirs = await trees.claim(rpcroot + "/" + attreq9.aname)
         except RPCException as ex:
-            shutil.rmtree(cloneroot)
             return encode_error(msg, ex), None
-
-        print("Made attach fid")
-
-        # The qid is blindly set up. We will now need to clunk
-        # it if authentication fails.
-        # Actually do authentication
+        routing.qid.adopt(cloneroot, entries, dirs)
+        print(f"Made clone dir {cloneroot}")
         try:
-            validate_token(attreq9.afid, attreq9.uname, attreq9.aname)
-        except RPCException as ex:
-            shutil.rmtree(cloneroot)
-            clunk_fid(attreq9.fid, fidtable)
+            attqid = routing.qid.qid_for_aname(sanitize_path(cloneroot + "/" + attreq9.aname))
+            routing.qid.materialize(attqid)
+        except (RPCException, OSError) as ex:
+            routing.qid.disown(cloneroot)
+            trees.discard(cloneroot)
+            if isinstance(ex, OSError):
+                ex = RPCException(Error.EBADPATH)
             return encode_error(msg, ex), None
         print("Tok validated")
 
         # If we've gotten this far the user is who they say they are.
-        drop_privileges(attreq9.uname, fidtable, rpcroot, qid)
+        # Hand the worker the new tree and the attach fid; from here
+        # on it alone keeps track of what the fid points at.
+        try:
+            await drop_privileges(attreq9.uname, rpcroot)
+        except RPCException as ex:
+            routing.qid.disown(cloneroot)
+            trees.discard(cloneroot)
+            return encode_error(msg, ex), None
+        qids = sorted(routing.qid.qid_table.items())
+        ctlattreq = CtlAttachRequest(
+            attreq9.fid,
+            attreq9.uname,
+            sanitize_path(cloneroot + "/" + attreq9.aname),
+            [qidno for qidno, _ in qids],
+            [data.fname for _, data in qids],
+            [qidno for qidno, data in qids if data.isdir],
+            routing.qid.framed
+        )
+        ctlmsg = Message(MessageType.CTLATTACH, msg.tag, BINARY.encode(ctlattreq))
+        ctlresp = await proxy9(attreq9.uname, routing.conid, ctlmsg)
+        if ctlresp.message_type != MessageType.CTLATTACHR:
+            routing.qid.disown(cloneroot)
+            trees.discard(cloneroot)
+            return encode_error(msg, RPCException(Error.ECTLLOST)), None
+        routing.fids[attreq9.fid] = attreq9.uname
+        routing.trees.append(cloneroot)
 
         # Otherwise, we are all sandboxed! Made a new fid for the
         # user as they request, so return it their way.
-        attresp : str = json.dumps(AttachResponse(attqid)._asdict())
-        attresp_bytes: bytes = attresp.encode('utf-8')
+        attresp_bytes = codec.encode(AttachResponse(attqid))
         return Message(MessageType.ATTACHR, msg.tag, attresp_bytes), cloneroot
 
     # From here on out, security is a non-issue
     # because of the way fids work. If we're worried
-    # about modern brute forces, just make the fids longer
+    # about modern brute forces, just make the fids longer.
+    # Everything below belongs to whichever worker owns the
+    # fid; all we track here is which worker that is. So we
+    # only ever peek at the fid(s) leading the body, and pass
+    # the body on to the worker untouched. (WALK, which has
+    # to know whether newfid got made, being the exception.)
     if msg.message_type == MessageType.WALK:
-        walkreq9 = WalkRequest(**data_json)
-
-        if contained or walkreq9.fid not in fidtable.keys():
-            print("9: walk")
+        walkreq9 = codec.decode(WalkRequest, msg.data)
+        try:
+            walkuname = routing.fids[walkreq9.fid]
+        except KeyError:
+            return encode_error(msg, RPCException(Error.ENOSCHFD)), None
+
+        walkresp = await proxy9(walkuname, routing.conid, msg)
+        if walkresp.message_type != MessageType.WALKR:
+            return walkresp, None
+        # A walk cut short leaves newfid unmade
+        walkqids = codec.decode(WalkResponse, walkresp.data).qids
+        if len(walkqids) != len(walkreq9.wnames):
+            return walkresp, None
+
+        routing.fids[walkreq9.newfid] = walkuname
+        # Lazily cloned endpoints get their pipes the
+        # first time somebody walks to them; the worker
+        # can't make them itself, having dropped privs.
+        # Should that fail, APPENDs there fail in turn.
+        if routing.qid.lazy and walkqids:
             try:
-                walkqid = mk_walk_fid(walkreq9.newfid, walkreq9.fid, walkreq9.path, fidtable, qid)
-            except RPCException as ex:
-                return encode_error(msg, ex), None
-
-            walkresp = json.dumps(WalkResponse(walkqid)._asdict())
-            walkresp_bytes: bytes = walkresp.encode('utf-8')
-            return Message(MessageType.WALKR, msg.tag, walkresp_bytes), None
-        walkuname = fidtable[walkreq9.fid].uname
-        return await proxy9(walkuname, msg), None
+                routing.qid.materialize(walkqids[-1])
+            except OSError as ex:
+                print("9: couldn't materialize qid", walkqids[-1], ex)
+        return walkresp, None
 
     if msg.message_type == MessageType.STAT:
-        statreq9 = StatRequest(**data_json)
-
-        if contained or statreq9.fid not in fidtable.keys():
-            print("9: stat")
-            try:
-                stat = stat_fid(statreq9.fid, fidtable, qid)
-            except RPCException as ex:
-                return encode_error(msg, ex), None
+        statfid, = codec.peek(StatRequest, msg.data, 1)
+        try:
+            statuname = routing.fids[statfid]
+        except KeyError:
+            return encode_error(msg, RPCException(Error.ENOSCHFD)), None
+        return await proxy9(statuname, routing.conid, msg), None
 
-            stat_resp = StatResponse(stat.qid, stat.fname, stat.isdir, stat.children)
-            statresp_bytes = json.dumps(stat_resp._asdict()).encode('utf-8')
-            return Message(MessageType.STATR, msg.tag, statresp_bytes), None
-        uname = fidtable[statreq9.fid].uname
-        return await proxy9(uname, msg), None
+    if msg.message_type == MessageType.READDIR:
+        readdirfid, = codec.peek(ReaddirRequest, msg.data, 1)
+        try:
+            readdiruname = routing.fids[readdirfid]
+        except KeyError:
+            return encode_error(msg, RPCException(Error.ENOSCHFD)), None
+        return await proxy9(readdiruname, routing.conid, msg), None
+
+    if msg.message_type in (MessageType.SAPPEND, MessageType.SREAD):
+        if msg.message_type == MessageType.SAPPEND:
+            streamfid, = codec.peek(SappendRequest, msg.data, 1)
+        else:
+            streamfid, = codec.peek(SreadRequest, msg.data, 1)
+        try:
+            streamuname = routing.fids[streamfid]
+        except KeyError:
+            return encode_error(msg, RPCException(Error.ENOSCHFD)), None
+        return await proxy9(streamuname, routing.conid, msg), None
+
+    # Held for as long as the subscription lasts, passing
+    # each NOTIFY from the worker on as it comes
+    if msg.message_type == MessageType.SUBSCRIBE:
+        print("9: subscribe")
+        subfid, = codec.peek(SubscribeRequest, msg.data, 1)
+        try:
+            subuname = routing.fids[subfid]
+        except KeyError:
+            return encode_error(msg, RPCException(Error.ENOSCHFD)), None
+        return await proxy9(subuname, routing.conid, msg, routing.out.send), None
 
     if msg.message_type == MessageType.APPEND:
-        apreq9 = AppendRequest(**data_json)
-
-        if contained or apreq9.fid not in fidtable.keys():
-            print("9: append")
-            try:
-                data = await write_fid(apreq9.fid, apreq9.data, fidtable, qid)
-            except RPCException as ex:
-                return encode_error(msg, ex), None
+        appendfid, = codec.peek(AppendRequest, msg.data, 1)
+        try:
+            appenduname = routing.fids[appendfid]
+        except KeyError:
+            pass
+        else:
+            return await proxy9(appenduname, routing.conid, msg), None
+
+        # Appends to a fid we don't route are afid writes
+        print("9: append")
+        apreq9 = codec.decode(AppendRequest, msg.data)
+        try:
+            data = await write_afid(apreq9.fid, apreq9.data)
+        except RPCException as ex:
+            return encode_error(msg, ex), None
 
-            wrresp = json.dumps(AppendResponse(data)._asdict())
-            wrresp_bytes = wrresp.encode('utf-8')
-            return Message(MessageType.APPENDR, msg.tag, wrresp_bytes), None
-        appuname = fidtable[apreq9.fid].uname
-        return await proxy9(appuname, msg), None
+        wrresp_bytes = codec.encode(AppendResponse(data))
+        return Message(MessageType.APPENDR, msg.tag, wrresp_bytes), None
 
     if msg.message_type == MessageType.CLUNK:
-        # Run this boi unconfined, since it never touches the qid layer
-        # and it just deals with fids
         print("9: clunk")
-        clunkreq9 = ClunkRequest(**data_json)
-        clunk_fid(clunkreq9.fid, fidtable)
-        clunkresp_bytes = json.dumps(ClunkResponse()._asdict()).encode('utf8')
+        # Read in full, as cheap as peeking at it, so that a
+        # malformed one fails before the fid is let go of here
+        clunkfid = codec.decode(ClunkRequest, msg.data).fid
+        clunkuname = routing.fids.pop(clunkfid, None)
+        if clunkuname is not None:
+            return await proxy9(clunkuname, routing.conid, msg), None
+
+        clunk_afid(clunkfid)
+        clunkresp_bytes = codec.encode(ClunkResponse())
         return Message(MessageType.CLUNKR, msg.tag, clunkresp_bytes), None
 
-    raise RuntimeError("invalid message type")
-
-async def proxy9(uname: str, message: Message) -> Message:
+    if msg.message_type == MessageType.COMPOUND:
+        print("9: compound")
+        return await compound9(msg, codec.decode(CompoundRequest, msg.data), rpcroot,
+            routing), None
+
+    # Includes the parent <-> worker control messages,
+    # which clients have no business sending
+    return encode_error(msg, RPCException(Error.EILLEGAL)), None
+
+# What a FLUSH may cut short. Everything else changes what
+# the parent or worker keep track of, so is let finish.
+# A COMPOUND is cut short between requests, or during
+# one that may be (see compound9).
+FLUSHABLE = {
+    MessageType.COMPOUND,
+    MessageType.APPEND,
+    MessageType.SAPPEND,
+    MessageType.SREAD,
+    MessageType.SUBSCRIBE,
+    MessageType.STAT,
+    MessageType.READDIR,
+}
+
+# Keep track of a request's task until it is done
+def track9(running: Running, msg: Message, task: "asyncio.Task[None]") -> None:
+    running[msg.tag] = (msg.message_type, task)
+
+    def untrack(_: "asyncio.Task[None]") -> None:
+        if running.get(msg.tag, (None, None))[1] is task:
+            del running[msg.tag]
+    task.add_done_callback(untrack)
+
+# FLUSH is handled per connection (and per ctl channel),
+# ahead of dispatch9: cancel the request if we may, then
+# answer once it is done with either way
+async def flush9(msg: Message, running: Running) -> Message:
+    print("9: flush")
+    codec = codec_for(msg.data)
+    flushreq9 = codec.decode(FlushRequest, msg.data)
+    old = running.get(flushreq9.oldtag)
+    if old is not None and flushreq9.oldtag != msg.tag:
+        message_type, task = old
+        if message_type in FLUSHABLE:
+            task.cancel()
+        await asyncio.wait({task})
+    return Message(MessageType.FLUSHR, msg.tag, codec.encode(FlushResponse()))
+
+# What may go into a COMPOUND, and the request each carries.
+# Every one of them leads with the fid it acts on.
+COMPOUNDABLE: Dict[MessageType, Type[NamedTuple]] = {
+    MessageType.WALK: WalkRequest,
+    MessageType.STAT: StatRequest,
+    MessageType.READDIR: ReaddirRequest,
+    MessageType.APPEND: AppendRequest,
+    MessageType.CLUNK: ClunkRequest,
+}
+
+# Run each request of a COMPOUND through dispatch9 in turn,
+# as if it had come in on its own under the same tag, until
+# one of them fails
+async def compound9(
+    msg: Message,
+    compreq9: CompoundRequest,
+    rpcroot: str,
+    routing: Routing
+) -> Message:
+    codec = codec_for(msg.data)
+    if len(compreq9.types) != len(compreq9.bodies):
+        return encode_error(msg, RPCException(Error.EILLEGAL))
+
+    types: List[int] = []
+    bodies: List[bytes] = []
+    curfid: Optional[int] = None
+    for typeno, body in zip(compreq9.types, compreq9.bodies):
+        try:
+            optype = MessageType(typeno)
+            opcls = COMPOUNDABLE[optype]
+            opfid, = codec_for(body).peek(opcls, body, 1)
+            if opfid == CURFID:
+                if curfid is None:
+                    raise RPCException(Error.ENOSCHFD)
+                opcodec = codec_for(body)
+                body = opcodec.encode(opcodec.decode(opcls, body)._replace(fid=curfid))
+                opfid = curfid
+        except (ValueError, KeyError):
+            response = encode_error(msg, RPCException(Error.EILLEGAL))
+        except RPCException as ex:
+            response = encode_error(msg, ex)
+        else:
+            step = asyncio.ensure_future(
+                dispatch9(Message(optype, msg.tag, body), rpcroot, routing))
+            if optype in FLUSHABLE:
+                response, _ = await step
+            else:
+                # Flushed or not, see it through, lest what it
+                # changes go unrecorded
+                try:
+                    response, _ = await asyncio.shield(step)
+                except asyncio.CancelledError:
+                    await asyncio.wait({step})
+                    raise
+
+        types.append(response.message_type.value)
+        bodies.append(response.data)
+        if response.message_type == MessageType.ERROR:
+            break
+        if optype == MessageType.WALK:
+            # A walk cut short stops the lot, as an error would
+            opcodec = codec_for(body)
+            walkreq9 = opcodec.decode(WalkRequest, body)
+            if len(opcodec.decode(WalkResponse, response.data).qids) != len(walkreq9.wnames):
+                break
+            curfid = walkreq9.newfid
+        else:
+            curfid = opfid
+
+    compresp_bytes = codec.encode(CompoundResponse(types, bodies))
+    return Message(MessageType.COMPOUNDR, msg.tag, compresp_bytes)
+
+# The connection is gone: let every worker it
+# used forget about its fids
+async def detach9(routing: Routing) -> None:
+    for uname in set(routing.fids.values()):
+        ctldetreq = BINARY.encode(CtlDetachRequest())
+        await proxy9(uname, routing.conid, Message(MessageType.CTLDETACH, 0, ctldetreq))
+    routing.fids.clear()
+
+# notify, if given, gets any NOTIFYs ahead of the response
+async def proxy9(
+    uname: str,
+    conid: int,
+    message: Message,
+    notify: Optional[Callable[[Message], Awaitable[None]]] = None
+) -> Message:
     print("9: proxy")
-    ctl = "/srv/ctl/" + str(Relays[uname])
-
-    reader, writer = await asyncio.open_unix_connection(ctl)
-    writer.write(encode_message(message))
-    await writer.drain()
+    try:
+        ctl = Relays[uname]
+    except KeyError:
+        # The worker has been reaped from under us
+        return encode_error(message, RPCException(Error.ECTLLOST))
+    try:
+        if notify is not None:
+            return await channel_for(ctl).subscribe(conid, message, notify)
+        return await channel_for(ctl).call(conid, message)
+    except RPCException as ex:
+        return encode_error(message, ex)
 
-    rmessage = await decode_message(reader)
-    writer.close()
-    await writer.wait_closed()
-    return rmessage
+# What decoding a body we can't make sense of raises, to be
+# answered with EILLEGAL rather than left unanswered
+MALFORMED = (ValueError, TypeError, KeyError)
 
 def encode_error(original_msg: Message, ex: RPCException) -> Message:
     print("9: error code", ex.err)
-    err_resp = json.dumps(ErrorResponse(ex.err.value)._asdict())
-    err_bytes = err_resp.encode('utf-8')
+    err_bytes = codec_for(original_msg.data).encode(ErrorResponse(ex.err.value))
     return Message(MessageType.ERROR, original_msg.tag, err_bytes)
 
-# 9AUTH: PRIVILEGE DROPPING LOGIC #
-# Have we descended to an unprivileged user yet?
-ctlcount : int = 1
-
-# Actually perform the descent
-def drop_privileges(uname: str, fidtable: Dict[int, FidData], rpcroot: str, qid: Qid) -> None:
-    global ctlcount
-
-    # We are about to descend to the new user through a fork
-    # operation. Once forked, permissions will get lowered
-    # and the child will initiate a server to catch further
-    # stuff from us.
+# VERSION is handled per connection, ahead of dispatch9: settle
+# on the smaller of the two msizes, and on the codec the client
+# asked for if we speak it, json otherwise. Returns the response
+# alongside the msize that now applies to the connection.
+def version9(msg: Message) -> Tuple[Message, int]:
+    print("9: version")
+    verreq9 = JSON.decode(VersionRequest, msg.data)
+    if not isinstance(verreq9.msize, int) or verreq9.msize < MIN_MSIZE:
+        raise ValueError(f"msize {verreq9.msize!r} below {MIN_MSIZE}")
+    msize = min(verreq9.msize, MSIZE)
+    version = verreq9.version if verreq9.version in CODECS else VERSION_JSON
+    verresp_bytes = JSON.encode(VersionResponse(msize, version))
+    return Message(MessageType.VERSIONR, msg.tag, verresp_bytes), msize
 
-    if uname in Relays.keys():
-        return
-    Relays[uname] = ctlcount
-    ctlcount += 1
-
-    child = multiprocessing.Process(target=mpenter, args=(Relays[uname], uname, rpcroot, fidtable, qid))
-    child.start()
+# 9AUTH: PRIVILEGE DROPPING LOGIC #
+# Actually perform the descent. Workers are started ahead
+# of time (see nine/pool.py); claiming one tells it which
+# user to become, and returns once it is ready for us.
+async def drop_privileges(uname: str, rpcroot: str) -> None:
+    await workers.checkout(uname, rpcroot)
 
-    print(f"9auth: successfully dropped privs on attach, root -> {uname}")
+# The most names a single READDIR hands out, whatever
+# the client asks for, so as to keep pages well within
+# any reasonable msize
+READDIR_MAX = 4096
 
 # MULTIUSER SHIM LAYER #
-myfidtable: Dict[int, FidData] = {}
+# Every connection this user has open gets a session
+# here, holding the fids it made and the qids of the
+# trees it attached to. The worker owns these outright;
+# the parent only knows which worker a fid lives in.
+mysessions: Dict[int, Session] = {}
 myrpcroot = ""
 myctl = 0
-myqid = Qid()
-
-# On initialization, receives a reference
-# to the master fid dictionary for this connection,
-# in addition to the user to downgrade to and
-# the ctl to utilize.
-def mpenter(ctl: int, uname: str, rpcroot: str, fidtable: Dict[int, FidData], qid: Qid) -> None:
-    global myfidtable
+
+# Entry point of a pooled worker. We start out as root
+# and idle; once claimed, we learn which user to downgrade
+# to and the ctl to utilize.
+def mpenter(conn: WorkerConn) -> None:
     global myrpcroot
     global myctl
-    global myqid
+
+    try:
+        ctl, uname, rpcroot = conn.recv()
+    except (EOFError, KeyboardInterrupt):
+        # The pool is shutting down without us
+        return
 
     # First, drop privileges and store proc-specific vars
     newuid : int = pwd.getpwnam(uname)[2]
@@ -226,41 +432,233 @@ def mpenter(ctl: int, uname: str, rpcroot: str, fidtable: Dict[int, FidData], qi
     os.setgid(newgid)
     os.setuid(newuid)
 
-    myfidtable = fidtable
     myrpcroot = rpcroot
     myctl = ctl
-    myqid = qid
 
-    asyncio.run(start9fs())
+    asyncio.run(start9fs(conn))
 
-# Asynchronous entry point. Start up a server
-async def start9fs() -> None:
+# Asynchronous entry point. Start up a server, and tell
+# the parent once it can reach us
+async def start9fs(conn: WorkerConn) -> None:
     global myctl
 
+    # Only the parent (root) should be able to reach us
+    os.umask(0o077)
     server = await asyncio.start_unix_server(
         fs9,
-        f"/srv/ctl/{myctl}"
+        f"{CTLDIR}{myctl}"
     )
+    print("9: ctl file started with reduced permissions")
+    conn.send("ready")
+    conn.close()
 
     await server.serve_forever()
 
-    print("9: ctl file started with reduced permissions")
+workers = WorkerPool(mpenter)
+
+# Clone trees for ATTACH, built ahead of time by the parent
+trees = TreePool()
+
+# Confined handlers for everything the parent relays to us.
+# notify sends a message ahead of the response, for SUBSCRIBE.
+async def confined9(
+    msg: Message,
+    conid: int,
+    notify: Callable[[Message], Awaitable[None]]
+) -> Message:
+    codec = codec_for(msg.data)
+
+    if msg.message_type == MessageType.CTLATTACH:
+        print("9: ctl attach")
+        ctlattreq = codec.decode(CtlAttachRequest, msg.data)
+        session = mysessions.setdefault(
+            conid, Session({}, Qid(framed=ctlattreq.framed), {}, {}, {}))
+        for qidno, fname in zip(ctlattreq.qids, ctlattreq.fnames):
+            session.qid.install_qid(qidno, fname, qidno in ctlattreq.dirs)
+        try:
+            mk_attach_fid(ctlattreq.fid, ctlattreq.uname, ctlattreq.aname,
+                session.fidtable, session.qid)
+        except RPCException as ex:
+            return encode_error(msg, ex)
+        return Message(MessageType.CTLATTACHR, msg.tag, codec.encode(CtlAttachResponse()))
+
+    if msg.message_type == MessageType.CTLDETACH:
+        print("9: ctl detach")
+        oldsession = mysessions.pop(conid, None)
+        if oldsession is not None:
+            close_cursors(oldsession.cursors)
+            close_streams(oldsession.streams)
+            close_subscriptions(oldsession.subscriptions)
+            oldsession.qid.close()
+        return Message(MessageType.CTLDETACHR, msg.tag, codec.encode(CtlDetachResponse()))
+
+    try:
+        session = mysessions[conid]
+    except KeyError:
+        return encode_error(msg, RPCException(Error.ENOSCHFD))
+
+    if msg.message_type == MessageType.WALK:
+        print("9: walk")
+        walkreq9 = codec.decode(WalkRequest, msg.data)
+        try:
+            walkqids = mk_walk_fid(walkreq9.newfid, walkreq9.fid, walkreq9.wnames,
+                session.fidtable, session.qid)
+        except RPCException as ex:
+            return encode_error(msg, ex)
 
-# One time confined fs access
+        walkversions = [session.qid.version(walkqid) for walkqid in walkqids]
+        walkresp_bytes = codec.encode(WalkResponse(walkqids, walkversions))
+        return Message(MessageType.WALKR, msg.tag, walkresp_bytes)
+
+    if msg.message_type == MessageType.STAT:
+        print("9: stat")
+        statreq9 = codec.decode(StatRequest, msg.data)
+        try:
+            stat = stat_fid(statreq9.fid, session.fidtable, session.qid)
+        except RPCException as ex:
+            return encode_error(msg, ex)
+
+        if statreq9.version == stat.version:
+            stat_resp = StatResponse(stat.qid, stat.fname, stat.isdir, [], stat.version, True)
+        else:
+            stat_resp = StatResponse(stat.qid, stat.fname, stat.isdir, stat.children,
+                stat.version, False)
+        statresp_bytes = codec.encode(stat_resp)
+        return Message(MessageType.STATR, msg.tag, statresp_bytes)
+
+    if msg.message_type == MessageType.READDIR:
+        print("9: readdir")
+        readdirreq9 = codec.decode(ReaddirRequest, msg.data)
+        try:
+            names, eof = readdir_fid(readdirreq9.fid, readdirreq9.offset,
+                min(readdirreq9.nnames, READDIR_MAX), session.fidtable, session.qid,
+                session.cursors)
+        except RPCException as ex:
+            return encode_error(msg, ex)
+
+        readdir_resp = ReaddirResponse(names, readdirreq9.offset + len(names), eof,
+            session.qid.version(session.fidtable[readdirreq9.fid].qid))
+        return Message(MessageType.READDIRR, msg.tag, codec.encode(readdir_resp))
+
+    if msg.message_type == MessageType.APPEND:
+        print("9: append")
+        apreq9 = codec.decode(AppendRequest, msg.data)
+        call = write_fid(apreq9.fid, apreq9.data, session.fidtable, session.qid)
+        try:
+            if apreq9.timeout > 0:
+                # Which cancels the call, and so tells the application
+                data = await asyncio.wait_for(call, apreq9.timeout / 1000)
+            else:
+                data = await call
+        except asyncio.TimeoutError:
+            return encode_error(msg, RPCException(Error.ETIMEOUT))
+        except RPCException as ex:
+            return encode_error(msg, ex)
+
+        wrresp_bytes = codec.encode(AppendResponse(data))
+        return Message(MessageType.APPENDR, msg.tag, wrresp_bytes)
+
+    if msg.message_type == MessageType.SAPPEND:
+        print("9: sappend")
+        sapreq9 = codec.decode(SappendRequest, msg.data)
+        try:
+            await sappend_fid(sapreq9.fid, sapreq9.data, sapreq9.eof, session.fidtable,
+                session.qid, session.streams)
+        except RPCException as ex:
+            return encode_error(msg, ex)
+        return Message(MessageType.SAPPENDR, msg.tag, codec.encode(SappendResponse()))
+
+    if msg.message_type == MessageType.SREAD:
+        print("9: sread")
+        srdreq9 = codec.decode(SreadRequest, msg.data)
+        try:
+            data, eof = await sread_fid(srdreq9.fid, session.streams)
+        except RPCException as ex:
+            return encode_error(msg, ex)
+        return Message(MessageType.SREADR, msg.tag, codec.encode(SreadResponse(data, eof)))
+
+    if msg.message_type == MessageType.SUBSCRIBE:
+        print("9: subscribe")
+        subreq9 = codec.decode(SubscribeRequest, msg.data)
+        try:
+            subscription = await subscribe_fid(subreq9.fid, session.fidtable, session.qid,
+                session.subscriptions)
+        except RPCException as ex:
+            return encode_error(msg, ex)
+
+        # Notifications too big to pass on count as missed
+        missed = 0
+        try:
+            while True:
+                note = await subscription.next()
+                if note is None:
+                    break
+                data, notemissed = note
+                notify_bytes = codec.encode(NotifyResponse(data, missed + notemissed))
+                if len(notify_bytes) > MSIZE:
+                    missed += notemissed + 1
+                    continue
+                missed = 0
+                await notify(Message(MessageType.NOTIFY, msg.tag, notify_bytes))
+        except RPCException as ex:
+            return encode_error(msg, ex)
+        finally:
+            if session.subscriptions.get(subreq9.fid) is subscription:
+                del session.subscriptions[subreq9.fid]
+                subscription.close()
+        return Message(MessageType.SUBSCRIBER, msg.tag, codec.encode(SubscribeResponse()))
+
+    if msg.message_type == MessageType.CLUNK:
+        print("9: clunk")
+        clunkreq9 = codec.decode(ClunkRequest, msg.data)
+        clunk_fid(clunkreq9.fid, session.fidtable, session.cursors, session.streams,
+            session.subscriptions)
+        clunkresp_bytes = codec.encode(ClunkResponse())
+        return Message(MessageType.CLUNKR, msg.tag, clunkresp_bytes)
+
+    return encode_error(msg, RPCException(Error.EILLEGAL))
+
+# Confined fs access. The parent keeps a single channel
+# open to us and multiplexes requests over it by tag, so
+# serve every request as it arrives and answer in whatever
+# order they finish. Subscriptions have no end of their
+# own, so they go once the channel does.
 async def fs9(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-    global myfidtable
-    global myrpcroot
-    global myctl
-    global myqid
+    frames = FrameReader(reader, RELAY_MSIZE)
+    out = FrameWriter(writer)
+    tasks: Set[asyncio.Task[None]] = set()
+    running: Running = {}
+
+    async def serve(conid: int, request: Message) -> None:
+        try:
+            if request.message_type == MessageType.FLUSH:
+                response = await flush9(request, running)
+            else:
+                response = await confined9(request, conid, out.send)
+        except MALFORMED as ex:
+            # The parent only peeks at what it passes on
+            print(f"9: malformed {request.message_type.name}: {ex!r}")
+            response = encode_error(request, RPCException(Error.EILLEGAL))
+        if len(response.data) > MSIZE:
+            # e.g. an APPEND answered at length, once encoded;
+            # no client could take it
+            response = encode_error(request, RPCException(Error.ETOOBIG))
+        await out.send(response)
 
     try:
-        request = await decode_message(reader)
-    except asyncio.IncompleteReadError:
+        while True:
+            try:
+                conid, request = await decode_relayed(frames)
+            except (asyncio.IncompleteReadError, ValueError):
+                return
+            task = asyncio.create_task(serve(conid, request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            track9(running, request, task)
+    finally:
+        for message_type, task in running.values():
+            if message_type == MessageType.SUBSCRIBE:
+                task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
         writer.close()
-        await writer.wait_closed()
-        return None
-
-    response, linedir = await dispatch9(request, myrpcroot, myfidtable, myqid, True)
-    writer.write(encode_message(response))
-    await writer.drain()
-    writer.close()
@@ -0,0 +1,179 @@
+# Pool of pre-started per-user workers.
+
+# Starting a worker used to happen right on the ATTACH
+# path: fork, setgid/setuid, spin up an event loop and
+# bind /srv/ctl/N, with the parent free to start proxying
+# before the socket even existed. Instead we keep a few
+# workers started ahead of time, still root and idle,
+# each waiting on a pipe for somebody to claim it. A
+# claim tells the worker which user to become and which
+# ctl to serve; the worker answers once it is listening,
+# and only then do we route anything its way.
+
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.process import BaseProcess
+from typing import Callable, Dict, List, Optional, Tuple, TypeAlias
+
+from srpc.auth.dat import Relays
+from srpc.nine.dat import Error, RPCException
+
+# Workers are forked from a clean forkserver rather than
+# from the parent, which by now has an event loop, TLS
+# state and open client sockets we'd rather not copy.
+# As with any forkserver, the server's main module has to
+# be importable without starting the server all over again
+# (i.e. guard it with if __name__ == "__main__").
+PRELOAD = ["srpc.nine.dispatch"]
+
+# How many idle workers to keep on hand, by default
+POOLSIZE = 2
+
+# How long a claimed worker gets to come up
+READY_TIMEOUT = 10.0
+
+# Starting a worker blocks on the forkserver, so it happens on
+# a thread of our own; the loop's default executor may be
+# tied up by the application
+SPAWNERS = 1
+
+# What a claimed worker is told: its ctl, uname and rpcroot.
+# It answers "ready" once it is listening.
+Assignment = Tuple[int, str, str]
+PoolConn: TypeAlias = "multiprocessing.connection.Connection[Assignment, str]"
+WorkerConn: TypeAlias = "multiprocessing.connection.Connection[str, Assignment]"
+
+class WorkerPool:
+    def __init__(self, target: Callable[[WorkerConn], None]) -> None:
+        self._target = target
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(PRELOAD)
+        self._size = 0
+        self._idle: List[Tuple[BaseProcess, PoolConn]] = []
+        self._starting: Dict[str, asyncio.Future[int]] = {}
+        self._refill: Optional[asyncio.Task[None]] = None
+        self._procs: Dict[int, BaseProcess] = {}
+        self._ctlcount = 1
+        # When each user's worker was last checked out
+        self._lastused: Dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=SPAWNERS, thread_name_prefix="pool")
+
+    # Fill the pool up to size, in the background
+    def start(self, size: int = POOLSIZE) -> None:
+        self._size = size
+        self._schedule_refill()
+
+    @property
+    def procs(self) -> Dict[int, BaseProcess]:
+        return self._procs
+
+    def lastused(self, uname: str) -> float:
+        return self._lastused.get(uname, 0.0)
+
+    # Is uname's worker on its way up?
+    def starting(self, uname: str) -> bool:
+        return uname in self._starting
+
+    # Find (or bring up) the worker for uname, returning its ctl
+    async def checkout(self, uname: str, rpcroot: str) -> int:
+        self._lastused[uname] = time.monotonic()
+        if uname in Relays.keys():
+            return Relays[uname]
+
+        # Somebody else is already bringing this user's worker up
+        if uname in self._starting:
+            return await asyncio.shield(self._starting[uname])
+
+        loop = asyncio.get_running_loop()
+        ready: asyncio.Future[int] = loop.create_future()
+        self._starting[uname] = ready
+        try:
+            ctl = await self._claim(uname, rpcroot)
+        except BaseException as ex:
+            ready.set_exception(RPCException(Error.ECTLLOST))
+            # Nobody else may be waiting on it; don't warn about it
+            ready.exception()
+            if isinstance(ex, (OSError, EOFError, asyncio.TimeoutError)):
+                raise RPCException(Error.ECTLLOST) from ex
+            raise
+        finally:
+            del self._starting[uname]
+
+        ready.set_result(ctl)
+        print(f"9auth: successfully dropped privs on attach, root -> {uname}")
+        return ctl
+
+    async def _claim(self, uname: str, rpcroot: str) -> int:
+        ctl = self._ctlcount
+        self._ctlcount += 1
+        if self._idle:
+            proc, conn = self._idle.pop()
+        else:
+            proc, conn = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._spawn)
+        self._schedule_refill()
+
+        try:
+            assignment: Assignment = (ctl, uname, rpcroot)
+            conn.send(assignment)
+            await self._wait_ready(conn)
+        except BaseException:
+            proc.terminate()
+            raise
+        finally:
+            conn.close()
+
+        self._procs[ctl] = proc
+        Relays[uname] = ctl
+        return ctl
+
+    # Forget about a worker, e.g. once it exits
+    def release(self, uname: str) -> Optional[BaseProcess]:
+        self._lastused.pop(uname, None)
+        try:
+            ctl = Relays.pop(uname)
+        except KeyError:
+            return None
+        return self._procs.pop(ctl, None)
+
+    def _spawn(self) -> Tuple[BaseProcess, PoolConn]:
+        parent_conn, child_conn = self._context.Pipe()
+        proc = self._context.Process(target=self._target, args=(child_conn,), daemon=True)
+        proc.start()
+        child_conn.close()
+        return proc, parent_conn
+
+    async def _wait_ready(self, conn: PoolConn) -> None:
+        loop = asyncio.get_running_loop()
+        readable: asyncio.Future[None] = loop.create_future()
+
+        def on_readable() -> None:
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(conn.fileno(), on_readable)
+        try:
+            await asyncio.wait_for(readable, READY_TIMEOUT)
+        finally:
+            loop.remove_reader(conn.fileno())
+        if conn.recv() != "ready":
+            raise EOFError("worker did not come up")
+
+    def _schedule_refill(self) -> None:
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.get_running_loop().create_task(self._do_refill())
+
+    async def _do_refill(self) -> None:
+        while len(self._idle) < self._size:
+            self._idle.append(await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._spawn))
+
+    # Shut down whatever is sitting idle
+    def stop(self) -> None:
+        for proc, conn in self._idle:
+            conn.close()
+            proc.terminate()
+        self._idle.clear()
@@ -0,0 +1,258 @@
+# Parent <-> worker control channels.
+
+# After ATTACH, everything a client does with its fids is
+# carried out by that user's worker process, which listens
+# on /srv/ctl/N. Rather than dialing that socket for every
+# proxied request, the parent keeps one long-lived channel
+# per worker and multiplexes requests over it by tag, the
+# same way clients multiplex requests over their connection.
+#
+# Tags on the channel belong to the channel: the client's
+# tag is swapped out on the way in and restored on the way
+# back, since many client connections share a channel and
+# their tags may well collide. Requests carry the id of
+# the client connection they came in on ahead of the body,
+# since the worker keeps separate fids for each of them:
+#
+# 64 bits - connection id
+# Variable length - the request body, untouched
+#
+# A SUBSCRIBE is answered with any number of NOTIFYs
+# before its response proper, all under the same tag,
+# and the channel hands each on as it comes (see Notes).
+#
+# Should whoever is waiting on a request give up on it
+# (the client FLUSHed it, or went away), the worker is
+# sent a FLUSH of its own for the channel tag, so that
+# it may stop work nobody will hear the end of.
+
+import asyncio
+import struct
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from srpc.fs.unix import NOTIFY_BACKLOG
+from srpc.nine.dat import Error, FlushRequest, MessageType, NotifyResponse, RPCException
+from srpc.nine.codec import BINARY, MSIZE, codec_for
+from srpc.srv.dat import FrameReader, FrameWriter, Message
+
+CTLDIR = "/srv/ctl/"
+
+# A freshly started worker may not have bound its
+# socket yet, so give it a moment before giving up
+CONNECT_RETRIES = 50
+CONNECT_BACKOFF = 0.01
+
+CONID = struct.Struct("!Q")
+
+# Relayed frames may run a connection id over the msize
+RELAY_MSIZE = MSIZE + CONID.size
+
+# The connection id is read off on its own, so that the
+# body that follows can be handed on without slicing it
+async def decode_relayed(frames: FrameReader) -> Tuple[int, Message]:
+    message_type, tag, payload_length = await frames.read_header()
+    if payload_length < CONID.size:
+        raise ValueError("relayed frame without a connection id")
+    conid, = CONID.unpack(await frames.readexactly(CONID.size))
+    return conid, Message(message_type, tag, await frames.readexactly(payload_length - CONID.size))
+
+# Whatever has come in for a SUBSCRIBE and not yet gone on
+# to the client, None marking the channel going down. The
+# channel can't wait on any one client, so past
+# NOTIFY_BACKLOG the oldest NOTIFYs are dropped here, as in
+# the worker, and counted against the next one.
+class Notes:
+    def __init__(self) -> None:
+        self._notes: Deque[Optional[Message]] = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, message: Optional[Message]) -> None:
+        self._notes.append(message)
+        # Nothing follows the response proper, so what
+        # goes is always a NOTIFY
+        if len(self._notes) > NOTIFY_BACKLOG:
+            dropped = self._notes.popleft()
+            head = self._notes[0]
+            if dropped is not None and head is not None and \
+                    head.message_type == MessageType.NOTIFY:
+                codec = codec_for(head.data)
+                missed = codec.decode(NotifyResponse, dropped.data).missed + 1
+                note = codec.decode(NotifyResponse, head.data)
+                note = note._replace(missed=note.missed + missed)
+                self._notes[0] = Message(head.message_type, head.tag, codec.encode(note))
+        self._ready.set()
+
+    async def get(self) -> Optional[Message]:
+        while not self._notes:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._notes.popleft()
+
+class CtlChannel:
+    def __init__(self, ctl: int) -> None:
+        self._path = CTLDIR + str(ctl)
+        self._reader: Optional[FrameReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._frames: Optional[FrameWriter] = None
+        self._loop_task: Optional[asyncio.Task[None]] = None
+        self._connecting = asyncio.Lock()
+        self._tag = 0
+        self._tag_to_response: Dict[int, asyncio.Future[Message]] = {}
+        self._tag_to_notes: Dict[int, Notes] = {}
+        self._flushes: Set[asyncio.Task[None]] = set()
+
+    @property
+    def connected(self) -> bool:
+        return self._loop_task is not None and not self._loop_task.done()
+
+    async def _connect(self) -> None:
+        async with self._connecting:
+            if self.connected:
+                return
+
+            for attempt in range(CONNECT_RETRIES):
+                try:
+                    reader, self._writer = await asyncio.open_unix_connection(self._path)
+                    self._reader = FrameReader(reader, RELAY_MSIZE)
+                    self._frames = FrameWriter(self._writer)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError) as ex:
+                    if attempt == CONNECT_RETRIES - 1:
+                        raise RPCException(Error.ECTLLOST) from ex
+                    await asyncio.sleep(CONNECT_BACKOFF)
+
+            self._loop_task = asyncio.create_task(self._loop())
+            print(f"9: ctl channel up on {self._path}")
+
+    async def call(self, conid: int, message: Message) -> Message:
+        if not self.connected:
+            await self._connect()
+        assert self._frames is not None
+        frames = self._frames
+
+        tag = self._tag
+        self._tag += 1
+        response_future: asyncio.Future[Message] = asyncio.get_running_loop().create_future()
+        self._tag_to_response[tag] = response_future
+        try:
+            relayed = Message(message.message_type, tag, message.data)
+            await frames.send(relayed, CONID.pack(conid))
+            response = await response_future
+        except asyncio.CancelledError:
+            self._flush(conid, tag)
+            raise
+        except ConnectionError as ex:
+            raise RPCException(Error.ECTLLOST) from ex
+        finally:
+            self._tag_to_response.pop(tag, None)
+
+        return Message(response.message_type, message.tag, response.data)
+
+    # call(), for a SUBSCRIBE: notify gets each NOTIFY in turn,
+    # under the original tag, until the response comes
+    async def subscribe(
+        self,
+        conid: int,
+        message: Message,
+        notify: Callable[[Message], Awaitable[None]]
+    ) -> Message:
+        if not self.connected:
+            await self._connect()
+        assert self._frames is not None
+        frames = self._frames
+
+        tag = self._tag
+        self._tag += 1
+        notes = Notes()
+        self._tag_to_notes[tag] = notes
+        try:
+            relayed = Message(message.message_type, tag, message.data)
+            await frames.send(relayed, CONID.pack(conid))
+            while True:
+                note = await notes.get()
+                if note is None:
+                    raise RPCException(Error.ECTLLOST)
+                if note.message_type != MessageType.NOTIFY:
+                    return Message(note.message_type, message.tag, note.data)
+                await notify(Message(note.message_type, message.tag, note.data))
+        except asyncio.CancelledError:
+            self._flush(conid, tag)
+            raise
+        except ConnectionError as ex:
+            raise RPCException(Error.ECTLLOST) from ex
+        finally:
+            self._tag_to_notes.pop(tag, None)
+
+    # Tell the worker to drop the request under tag. Its
+    # FLUSHR, like anything else under a tag nobody waits
+    # on any more, is dropped on arrival.
+    def _flush(self, conid: int, tag: int) -> None:
+        frames = self._frames
+        if frames is None:
+            return
+        flush = Message(MessageType.FLUSH, self._tag, BINARY.encode(FlushRequest(tag)))
+        self._tag += 1
+
+        async def send() -> None:
+            try:
+                await frames.send(flush, CONID.pack(conid))
+            except ConnectionError:
+                pass
+
+        task = asyncio.get_running_loop().create_task(send())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._frames = None
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+
+    def _fail_pending(self) -> None:
+        for response_future in self._tag_to_response.values():
+            if not response_future.done():
+                response_future.set_exception(RPCException(Error.ECTLLOST))
+        self._tag_to_response.clear()
+        for notes in self._tag_to_notes.values():
+            notes.put(None)
+
+    async def _loop(self) -> None:
+        assert self._reader is not None
+        try:
+            while True:
+                message = await self._reader.read()
+                notes = self._tag_to_notes.get(message.tag)
+                if notes is not None:
+                    notes.put(message)
+                    continue
+                response_future = self._tag_to_response.get(message.tag)
+                if response_future is not None and not response_future.done():
+                    response_future.set_result(message)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # The next call through this channel dials back in
+            print(f"9: ctl channel on {self._path} went down")
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+                self._frames = None
+            self._fail_pending()
+
+# One channel per worker, keyed by ctl number
+Channels: Dict[int, CtlChannel] = {}
+
+def channel_for(ctl: int) -> CtlChannel:
+    try:
+        return Channels[ctl]
+    except KeyError:
+        Channels[ctl] = CtlChannel(ctl)
+        return Channels[ctl]
@@ -3,10 +3,14 @@
 # posted connections, not the actual files themselves
 
 import ssl
-from typing import NamedTuple, Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 import asyncio
 import struct
 
+from srpc.fs.dat import DirCursor, FidData
+from srpc.fs.qid import Qid
+from srpc.fs.unix import Stream, Subscription
+from srpc.nine.codec import MSIZE
 from srpc.nine.dat import MessageType
 
 
@@ -20,11 +24,53 @@ class Message(NamedTuple):
     tag: int
     data: bytes
 
+# How long, in seconds, the reaper lets things sit
+# unused before cleaning them up (see srv/reaper.py)
+class ReapTTLs(NamedTuple):
+    trees: float = 60.0
+    afids: float = 600.0
+    workers: float = 300.0
+    # How often it goes looking
+    interval: float = 5.0
+
 class Con(NamedTuple):
     hostname: str
     port: int
     ssl: ssl.SSLContext
-
+    maxinflight: int
+    workers: int
+    authttl: float
+    lazy: bool
+    trees: int
+    reap: ReapTTLs
+    maxpending: int
+    framed: bool
+
+# What the parent keeps per client connection: which
+# worker (by uname) owns each of the connection's fids,
+# plus the qids and roots of the trees cloned for it,
+# and the connection's writer, for NOTIFYs to go out on.
+class Routing(NamedTuple):
+    conid: int
+    fids: Dict[int, str]
+    qid: Qid
+    trees: List[str]
+    out: "FrameWriter"
+
+# The requests a connection (or ctl channel) has in
+# flight, by tag, so that they may be FLUSHed
+Running = Dict[int, Tuple[MessageType, "asyncio.Task[None]"]]
+
+# What a worker keeps per client connection: the fid
+# table proper, the qids the parent handed over, and
+# the directory listings, streamed APPENDs and
+# subscriptions underway per fid.
+class Session(NamedTuple):
+    fidtable: Dict[int, FidData]
+    qid: Qid
+    cursors: Dict[int, DirCursor]
+    streams: Dict[int, Stream]
+    subscriptions: Dict[int, Subscription]
 
 Q_SIZE = struct.calcsize("Q")
 I_SIZE = struct.calcsize("i")
@@ -32,22 +78,109 @@ BITS_PER_BYTE = 8
 Q_MIN = 0
 Q_MAX = 2 ** (Q_SIZE * BITS_PER_BYTE) - 1
 
+HEADER = struct.Struct("!iQQ")
+
+def encode_header(message: Message, extra: int = 0) -> bytes:
+    assert message.tag >= Q_MIN
+    assert message.tag <= Q_MAX
+    return HEADER.pack(message.message_type.value, message.tag, len(message.data) + extra)
+
 def encode_message(message: Message) -> bytes:
-    message_type = message.message_type.value
-    tag = message.tag
-    data = message.data
-    assert tag >= Q_MIN
-    assert tag <= Q_MAX
-    data_len = len(data)
-    return struct.pack(f"!iQQ{data_len}s", message_type, tag, len(data), data)
-
-async def decode_message(reader: asyncio.StreamReader) -> Message:
-    header_bytes = await reader.readexactly(I_SIZE + Q_SIZE + Q_SIZE)
-    message_type_id, tag, payload_length = struct.unpack("!iQQ", header_bytes)
-    data_bytes = await reader.readexactly(payload_length)
-    data, = struct.unpack(f"!{payload_length}s", data_bytes)
-    message_type = MessageType(message_type_id)
-    return Message(message_type, tag, data)
+    return encode_header(message) + message.data
+
+# Frames are read with a ceiling on their size, which is
+# the msize agreed on through VERSION (or the largest we'd
+# ever agree to, until then). A frame claiming to be any
+# larger is refused before anything is allocated for it.
+# The payload handed back is the very buffer readexactly
+# filled in; nothing is copied out of it after the fact.
+class FrameReader:
+    def __init__(self, reader: asyncio.StreamReader, maxsize: int = MSIZE) -> None:
+        self._reader = reader
+        self.maxsize = maxsize
+
+    async def read_header(self) -> Tuple[MessageType, int, int]:
+        message_type_id, tag, payload_length = HEADER.unpack(
+            await self._reader.readexactly(HEADER.size))
+        if payload_length > self.maxsize:
+            raise ValueError(f"frame of {payload_length} bytes exceeds {self.maxsize}")
+        return MessageType(message_type_id), tag, payload_length
+
+    async def read(self) -> Message:
+        message_type, tag, payload_length = await self.read_header()
+        return Message(message_type, tag, await self._reader.readexactly(payload_length))
+
+    async def readexactly(self, n: int) -> bytes:
+        return await self._reader.readexactly(n)
+
+# Frames go out as a header and a payload in a vectored
+# write. Small frames written in the same pass of the event
+# loop are gathered up and handed to the transport together
+# once it's over, so a burst of small responses costs one
+# write (and one TLS record) rather than one each; larger
+# ones go straight out. Since frames are only ever written
+# whole, they never interleave on the wire. send() waits
+# for the transport to drain before writing, and only when
+# it (plus whatever is gathered up) is over its high-water
+# mark, so that a crowd of senders can't pile up behind it.
+COALESCE_MAX = 16 * 1024
+
+class FrameWriter:
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+        self._pending: List[bytes] = []
+        self._pending_size = 0
+        self._scheduled = False
+        self._draining = asyncio.Lock()
+
+    # prefix, if any, goes out ahead of the payload as part of it
+    def write(self, message: Message, prefix: bytes = b"") -> None:
+        header = encode_header(message, len(prefix))
+        if len(message.data) > COALESCE_MAX:
+            self._flush()
+            if not self._writer.is_closing():
+                self._writer.writelines((header, prefix, message.data))
+            return
+        if prefix:
+            self._pending.extend((header, prefix, message.data))
+        else:
+            self._pending.extend((header, message.data))
+        self._pending_size += len(header) + len(prefix) + len(message.data)
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _over_high(self) -> bool:
+        transport = self._writer.transport
+        _, high = transport.get_write_buffer_limits()
+        return self._pending_size + transport.get_write_buffer_size() > high
+
+    # Senders held up by a full transport queue up here one
+    # at a time, rather than all waking up together each
+    # time it drains only for all but one to wait again
+    async def drain(self) -> None:
+        if not self._over_high():
+            return
+        async with self._draining:
+            while self._over_high():
+                self._flush()
+                await self._writer.drain()
+
+    async def send(self, message: Message, prefix: bytes = b"") -> None:
+        await self.drain()
+        self.write(message, prefix)
+
+    def _flush(self) -> None:
+        self._scheduled = False
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._pending_size = 0
+        if not self._writer.is_closing():
+            self._writer.writelines(pending)
+
+async def decode_message(reader: asyncio.StreamReader, maxsize: int = MSIZE) -> Message:
+    return await FrameReader(reader, maxsize).read()
 
 
 # SSL context helpers
@@ -0,0 +1,158 @@
+# Cleaning up after clients.
+
+# A connection leaves a good deal behind once it goes
+# away: the clone trees under /srv it attached to, any
+# afids it never clunked, and a per-user worker that may
+# now have nobody left to serve. The reaper keeps track
+# of which connections are still around and, every so
+# often, gets rid of whatever has sat unused for longer
+# than its TTL:
+#
+# - clone trees, a while after their connection closed
+#   (long enough for the application to finish up there)
+# - afids, a while after they were made, and remembered
+#   PAM authentications once they run out (see auth/afid.py)
+# - workers, once no connection has routed anything their
+#   way for a while
+#
+# A TTL of 0 turns that kind of reaping off. Counts of
+# everything reclaimed so far are kept in counters.
+
+import asyncio
+import os
+import time
+from multiprocessing.process import BaseProcess
+from typing import Dict, List, Optional, Tuple
+
+from srpc.auth.afid import expire_afids, expire_pam_cache
+from srpc.auth.dat import Relays
+from srpc.nine.dispatch import trees, workers
+from srpc.nine.relay import CTLDIR, Channels
+from srpc.srv.dat import ReapTTLs, Routing
+
+# How long to wait for a worker to exit before moving on
+RETIRE_TIMEOUT = 1.0
+
+class Reaper:
+    def __init__(self, ttls: ReapTTLs = ReapTTLs()) -> None:
+        self.ttls = ttls
+        self._live: Dict[int, Routing] = {}
+        # (when the connection closed, the trees it left)
+        self._closed: List[Tuple[float, List[str]]] = []
+        self._idle_since: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task[None]] = None
+        self.counters: Dict[str, int] = {
+            "connections": 0,
+            "trees": 0,
+            "afids": 0,
+            "workers": 0,
+        }
+
+    def connected(self, routing: Routing) -> None:
+        self._live[routing.conid] = routing
+
+    def disconnected(self, routing: Routing) -> None:
+        self._live.pop(routing.conid, None)
+        self.counters["connections"] += 1
+        # Nobody would ever take them off again
+        if routing.trees and self.ttls.trees > 0:
+            self._closed.append((time.monotonic(), list(routing.trees)))
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttls.interval)
+            try:
+                await self.sweep()
+            except OSError as ex:
+                print("9reap: sweep failed:", ex)
+
+    async def sweep(self) -> None:
+        now = time.monotonic()
+        if self.ttls.trees > 0:
+            self._reap_trees(now - self.ttls.trees)
+        if self.ttls.afids > 0:
+            self.counters["afids"] += expire_afids(self.ttls.afids)
+        expire_pam_cache()
+        if self.ttls.workers > 0:
+            await self._reap_workers(now)
+
+    def _reap_trees(self, cutoff: float) -> None:
+        # Connections close in order, so the oldest come first
+        while self._closed and self._closed[0][0] <= cutoff:
+            _, cloneroots = self._closed.pop(0)
+            for cloneroot in cloneroots:
+                trees.discard(cloneroot)
+                self.counters["trees"] += 1
+                print(f"9reap: removed {cloneroot}")
+
+    async def _reap_workers(self, now: float) -> None:
+        busy = {uname for routing in self._live.values() for uname in routing.fids.values()}
+        for uname in list(self._idle_since):
+            if uname not in Relays:
+                del self._idle_since[uname]
+
+        retiring: List[str] = []
+        for uname in Relays:
+            if uname in busy or workers.starting(uname):
+                self._idle_since.pop(uname, None)
+                continue
+            # An ATTACH that has just checked the worker out
+            # hasn't routed anything to it yet; give it time
+            since = max(self._idle_since.setdefault(uname, now), workers.lastused(uname))
+            if now - since >= self.ttls.workers:
+                retiring.append(uname)
+
+        for uname in retiring:
+            del self._idle_since[uname]
+            await self._retire(uname)
+
+    async def _retire(self, uname: str) -> None:
+        ctl = Relays.get(uname)
+        if ctl is None:
+            return
+        # Off the books first, so that nothing new is sent its way
+        proc = workers.release(uname)
+        channel = Channels.pop(ctl, None)
+        if channel is not None:
+            await channel.close()
+        if proc is not None:
+            proc.terminate()
+            await self._wait_exit(proc)
+        try:
+            os.unlink(CTLDIR + str(ctl))
+        except FileNotFoundError:
+            pass
+        self.counters["workers"] += 1
+        print(f"9reap: retired worker for {uname}")
+
+    # Wait on the worker's sentinel rather than block in join()
+    @staticmethod
+    async def _wait_exit(proc: BaseProcess) -> None:
+        loop = asyncio.get_running_loop()
+        exited: asyncio.Future[None] = loop.create_future()
+
+        def on_exit() -> None:
+            if not exited.done():
+                exited.set_result(None)
+
+        loop.add_reader(proc.sentinel, on_exit)
+        try:
+            await asyncio.wait_for(exited, RETIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("9reap: worker slow to exit")
+        finally:
+            loop.remove_reader(proc.sentinel)
+        proc.join(0)
@@ -1,13 +1,25 @@
 import ssl
 import asyncio
-from multiprocessing import Manager
-from typing import Dict, AsyncIterator, Optional
+import itertools
+from typing import AsyncIterator, Optional, Set
 
-from srpc.fs.dat import FidData
+from srpc.auth.afid import configure_pam
 from srpc.fs.qid import Qid
-from srpc.nine.dispatch import dispatch9
-from srpc.nine.dat import MessageType
-from srpc.srv.dat import encode_message, decode_message
+from srpc.fs.trees import TREEPOOLSIZE
+from srpc.nine.codec import MSIZE
+from srpc.nine.dispatch import MALFORMED, dispatch9, detach9, encode_error, flush9, track9, \
+    version9, trees, workers
+from srpc.nine.pool import POOLSIZE
+from srpc.nine.dat import Error, MessageType, RPCException
+from srpc.srv.reaper import Reaper
+from srpc.srv.dat import FrameReader, FrameWriter, Message, ReapTTLs, Routing, Running
+
+# Default cap on the number of requests a single
+# connection may have in flight at once
+MAXINFLIGHT = 64
+
+# Connection ids, which the workers key their fid tables by
+conids = itertools.count(1)
 
 class RPCServer:
     """
@@ -22,22 +34,41 @@ class RPCServer:
             # or directory created by root. This is handled
             # by preparecon
     """
-    def __init__(self, rpcroot: str, hostname: str, port: int, ssl_context: ssl.SSLContext):
+    def __init__(
+        self,
+        rpcroot: str,
+        hostname: str,
+        port: int,
+        ssl_context: ssl.SSLContext,
+        maxinflight: int = MAXINFLIGHT,
+        poolsize: int = POOLSIZE,
+        authttl: float = 0.0,
+        lazy: bool = False,
+        treepoolsize: int = TREEPOOLSIZE,
+        reapttls: ReapTTLs = ReapTTLs(),
+        maxpending: int = 0,
+        framed: bool = True
+    ):
         self.rpcroot = rpcroot
         self.hostname = hostname
         self.port = port
         self.ssl_context = ssl_context
-        self.newdata : Optional[str] = ""
+        self.maxinflight = maxinflight
+        self.poolsize = poolsize
+        self.authttl = authttl
+        self.lazy = lazy
+        self.framed = framed
+        self.treepoolsize = treepoolsize
+        self.reaper = Reaper(reapttls)
+        # Linedirs of fresh ATTACHes, on their way out of
+        # dolisten. If bounded, ATTACHes wait for room.
+        self.linedirs: asyncio.Queue[Optional[str]] = asyncio.Queue(maxpending)
 
     # Get connections for a client. This is
     # to be clear pre-auth, will probably
     # abstract this somehow if we ever go with
     # server-defined authentication.
 
-    async def waitfordata(self) -> None:
-        while not self.newdata:
-            await asyncio.sleep(0)
-
     async def callback9(
         self,
         reader: asyncio.StreamReader,
@@ -48,27 +79,104 @@ class RPCServer:
         # Each new connection gets a new set of data structures...
         # Three cheers to python being pass by reference.
 
-        # Additionally, wrap the dict so it's accessible across
-        # processes. This way, for this connection, everyone holds
-        # onto an up to date set of fids. Might not be totally
-        # needed, but it's nice and comfy.
-        mpmanager = Manager()
-        myfidtable: Dict[int, FidData] = mpmanager.dict()
-        myqid = Qid()
+        # The fids themselves live in the worker of whoever attaches;
+        # all we keep is which worker that is, updated as responses
+        # come back through us.
+        out = FrameWriter(writer)
+        routing = Routing(next(conids), {}, Qid(lazy=self.lazy, framed=self.framed), [], out)
+        self.reaper.connected(routing)
 
-        # Do the thing
-        while True:
+        # Requests are dispatched concurrently, and responses go
+        # back out in whatever order they complete; the client
+        # matches them up by tag. Frames are never interleaved on the
+        # wire (see FrameWriter), and the number of requests in flight
+        # is bounded by maxinflight. Frames the client sends us are
+        # bounded by msize: our own, until it says otherwise through
+        # VERSION.
+        #
+        # Requests wait for room once read, rather than being left
+        # unread, so that a FLUSH (which needs no room) can get past
+        # them and free some up. Only once as many again are
+        # waiting do we stop reading.
+        inflight = asyncio.Semaphore(self.maxinflight)
+        waiting = asyncio.Semaphore(self.maxinflight)
+        frames = FrameReader(reader, MSIZE)
+        tasks: Set[asyncio.Task[None]] = set()
+        # What is in flight, by tag, for FLUSH to find.
+        # SUBSCRIBEs hold on until flushed or cancelled,
+        # each taking up one of maxinflight all the while.
+        running: Running = {}
+
+        async def serve(request: Message) -> None:
+            try:
+                await inflight.acquire()
+            finally:
+                waiting.release()
             try:
-                request = await decode_message(reader)
-            except asyncio.IncompleteReadError:
-                return
-            response, linedir = await dispatch9(request, self.rpcroot, myfidtable, myqid, False)
-            if response.message_type == MessageType.ATTACHR:
-                self.newdata = linedir
+                try:
+                    response, linedir = await dispatch9(request, self.rpcroot, routing)
+                except MALFORMED as ex:
+                    print(f"9srv: malformed {request.message_type.name}: {ex!r}")
+                    response, linedir = encode_error(request, RPCException(Error.EILLEGAL)), None
+                if len(response.data) > frames.maxsize:
+                    # More than the client agreed to take
+                    response = encode_error(request, RPCException(Error.ETOOBIG))
+                if response.message_type == MessageType.ATTACHR:
+                    await self.linedirs.put(linedir)
+                await out.send(response)
+            finally:
+                inflight.release()
 
-            writer.write(encode_message(response))
-            await writer.drain()
-            await asyncio.sleep(0)
+        async def flush(request: Message) -> None:
+            try:
+                response = await flush9(request, running)
+            except MALFORMED as ex:
+                print(f"9srv: malformed FLUSH: {ex!r}")
+                response = encode_error(request, RPCException(Error.EILLEGAL))
+            await out.send(response)
+
+        # Do the thing
+        try:
+            while True:
+                await waiting.acquire()
+                try:
+                    request = await frames.read()
+                except asyncio.IncompleteReadError:
+                    waiting.release()
+                    return
+                except ValueError as ex:
+                    # Oversized, or not a frame of ours at all
+                    print(f"9srv: dropping client: {ex}")
+                    waiting.release()
+                    return
+                if request.message_type == MessageType.VERSION:
+                    try:
+                        response, frames.maxsize = version9(request)
+                    except MALFORMED as ex:
+                        print(f"9srv: malformed VERSION: {ex!r}")
+                        response = encode_error(request, RPCException(Error.EILLEGAL))
+                    await out.send(response)
+                    waiting.release()
+                    continue
+                if request.message_type == MessageType.FLUSH:
+                    waiting.release()
+                    task = asyncio.create_task(flush(request))
+                else:
+                    task = asyncio.create_task(serve(request))
+                    track9(running, request, task)
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # Let whatever is still running finish up before
+            # the connection's state goes away, bar the
+            # subscriptions, which would never finish
+            for message_type, task in list(running.values()):
+                if message_type == MessageType.SUBSCRIBE:
+                    task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await detach9(routing)
+            self.reaper.disconnected(routing)
 
     # The meat of listen(), which is modified somewhat from the 9 API
     async def dolisten(self) -> AsyncIterator[Optional[str]]:
@@ -80,10 +188,13 @@ class RPCServer:
            ssl=self.ssl_context
         )
         print("9: server created")
+        workers.start(self.poolsize)
+        trees.configure(self.treepoolsize, self.lazy)
+        trees.start(self.rpcroot + "/")
+        self.reaper.start()
+        configure_pam(ttl=self.authttl)
         await server.start_serving()
         print("9: server listening")
 
         while True:
-            await self.waitfordata()
-            yield self.newdata
-            self.newdata = ""
+            yield await self.linedirs.get()